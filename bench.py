@@ -0,0 +1,386 @@
+"""Нагрузочный тест бота-планировщика без Telegram и боевой MongoDB.
+
+Запускает настоящее приложение из bot.py со всеми обработчиками из build_application()
+против локального поддельного Bot API и MongoDB в памяти (mongomock) или отдельной
+тестовой базы на сервере MongoDB; задачи и записи можно хранить во временной базе SQLite
+(--storage sqlite). N чатов одновременно проходят диалоги добавления,
+просмотра и обновления задач, в базу заранее загружаются задачи, а часть из них
+имеет дедлайн во время теста, чтобы измерить опоздание напоминаний.
+
+Результаты (p50/p95/p99 задержки обработчиков, обновлений в секунду, опоздание
+напоминаний, число операций MongoDB на обновление) пишутся в JSON-файл, который
+удобно сравнивать между запусками.
+
+Пример:
+    python bench.py --chats 50 --rounds 3 --seed-tasks 100000 --reminders 200 --output bench_results.json
+"""
+import argparse
+import asyncio
+import importlib
+import itertools
+import json
+import logging
+import os
+import random
+import tempfile
+import time
+import warnings
+from collections import Counter
+from datetime import date, datetime, timedelta
+from urllib.parse import parse_qsl
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота-планировщика")
+    parser.add_argument("--chats", type=int, default=50, help="число одновременно работающих чатов")
+    parser.add_argument("--rounds", type=int, default=3, help="сколько раз каждый чат проходит все диалоги")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза пользователя между сообщениями, с")
+    parser.add_argument("--seed-tasks", type=int, default=10000, help="сколько задач загрузить в базу заранее")
+    parser.add_argument("--seed-chats", type=int, default=100, help="между сколькими чатами распределить эти задачи")
+    parser.add_argument("--reminders", type=int, default=200, help="сколько напоминаний наступает во время теста")
+    parser.add_argument("--reminder-window", type=float, default=5.0,
+                        help="за сколько секунд от старта наступают эти напоминания")
+    parser.add_argument("--mongo", choices=["memory", "server"], default="memory",
+                        help="memory — mongomock в памяти, server — база MONGO_DB на MONGO_URI")
+    parser.add_argument("--storage", choices=["mongo", "sqlite"], default="mongo",
+                        help="где хранить задачи и записи: в MongoDB или во временном файле SQLite")
+    parser.add_argument("--no-change-stream", action="store_true",
+                        help="обновлять расписание напоминаний только опросом, без change stream")
+    parser.add_argument("--no-rate-limit", action="store_true", help="отключить лимиты отправки Telegram")
+    parser.add_argument("--api-port", type=int, default=18081, help="порт поддельного Bot API")
+    parser.add_argument("--output", default="bench_results.json", help="файл для результатов")
+    return parser.parse_args()
+
+
+def configure_environment(args):
+    # Настройки bot.py читаются при импорте, поэтому задаются заранее
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{args.api_port}"
+    os.environ.setdefault("MONGO_DB", "task_planner_bench")
+    os.environ["RUN_MODE"] = "polling"
+    os.environ["STORAGE_BACKEND"] = args.storage
+    # В mongomock нет change streams; на сервере они работают, если это набор реплик
+    if args.no_change_stream or args.mongo == "memory":
+        os.environ["REMINDER_CHANGE_STREAM"] = "0"
+    if args.storage == "sqlite":
+        os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(prefix="task_planner_bench_"), "bench.db")
+    os.environ.setdefault("METRICS_PORT", "0")
+    if args.no_rate_limit:
+        os.environ["TELEGRAM_GLOBAL_RATE"] = "1000000"
+        os.environ["TELEGRAM_CHAT_RATE"] = "1000000"
+    warnings.filterwarnings("ignore")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("telegram").setLevel(logging.WARNING)
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    return {
+        "count": len(ordered),
+        "p50_ms": round(pick(0.50) * 1000, 3),
+        "p95_ms": round(pick(0.95) * 1000, 3),
+        "p99_ms": round(pick(0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3),
+    }
+
+
+# --------------- Подсчёт операций MongoDB ---------------
+class OpCounter:
+    def __init__(self):
+        self.counts = Counter()
+
+    def total(self) -> int:
+        return sum(self.counts.values())
+
+
+class CountingCollection:
+    """Обёртка коллекции, считающая вызовы её методов (одно обращение к базе на вызов)."""
+
+    def __init__(self, collection, counter: OpCounter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counter.counts[f"{self._collection.name}.{name}"] += 1
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+def mongomock_union_with(collection, database, options):
+    # В mongomock нет стадии $unionWith (ею считается календарь месяца)
+    return list(collection) + list(database[options["coll"]].aggregate(options.get("pipeline", [])))
+
+
+def install_mongo(bot, mode: str, counter: OpCounter):
+    if mode == "memory":
+        import mongomock
+        from mongomock import aggregate
+        aggregate._PIPELINE_HANDLERS.setdefault("$unionWith", mongomock_union_with)
+        bot.db = mongomock.MongoClient()[bot.MONGO_DB]
+    else:
+        bot.get_mongo_client().drop_database(bot.MONGO_DB)
+    for name in dir(bot):
+        if name.endswith("_collection"):
+            collection = bot.db[getattr(bot, name).name]
+            setattr(bot, name, CountingCollection(collection, counter))
+
+
+# --------------- Поддельный Bot API ---------------
+class FakeBotApi:
+    def __init__(self, bot_module, reminder_due: dict):
+        self.bot = bot_module
+        self.message_ids = itertools.count(1)
+        self.keyboards = {}
+        self.last_message = {}
+        self.calls = Counter()
+        self.reminder_due = reminder_due
+        self.reminder_lateness = []
+
+    def routes(self):
+        methods = ["getMe", "sendMessage", "editMessageText", "answerCallbackQuery", "deleteWebhook",
+                   "setWebhook", "sendDocument", "editMessageReplyMarkup"]
+        return {("POST", f"/bot{self.bot.BOT_TOKEN}/{method}"): self.handle for method in methods}
+
+    async def handle(self, request):
+        method = request.path.rsplit("/", 1)[1]
+        self.calls[method] += 1
+        params = {}
+        for name, value in parse_qsl(request.body.decode("utf-8", "replace")):
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            result = self._record_message(method, params)
+        else:
+            result = True
+        return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+
+    def _record_message(self, method: str, params: dict) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        text = str(params.get("text", ""))
+        message_id = params.get("message_id") or next(self.message_ids)
+        markup = params.get("reply_markup")
+        if isinstance(markup, dict) and "inline_keyboard" in markup:
+            self.keyboards[chat_id] = [button.get("callback_data", "") for row in markup["inline_keyboard"]
+                                       for button in row]
+            self.last_message[chat_id] = message_id
+        if "Сейчас наступил дедлайн задачи" in text:
+            name = text.split("дедлайн задачи: <b>", 1)[1].split("</b>", 1)[0]
+            due = self.reminder_due.pop(name, None)
+            if due is not None:
+                self.reminder_lateness.append((datetime.now() - due).total_seconds())
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"}, "text": text or "document"}
+
+
+# --------------- Клиенты ---------------
+class Bench:
+    def __init__(self, bot_module, api: FakeBotApi, args):
+        self.bot = bot_module
+        self.api = api
+        self.args = args
+        self.update_ids = itertools.count(1)
+        self.pending = {}
+        self.latencies = []
+        self.app = None
+
+    def make_processor(self):
+        bench = self
+
+        class TimedUpdateProcessor(self.bot.ChatOrderedUpdateProcessor):
+            async def do_process_update(self, update, coroutine):
+                async def timed():
+                    started = time.perf_counter()
+                    try:
+                        await coroutine
+                    finally:
+                        bench.latencies.append(time.perf_counter() - started)
+                        future = bench.pending.pop(update.update_id, None)
+                        if future is not None and not future.done():
+                            future.set_result(None)
+
+                await super().do_process_update(update, timed())
+
+        return TimedUpdateProcessor(self.bot.HANDLER_CONCURRENCY)
+
+    async def submit(self, data: dict):
+        from telegram import Update
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[data["update_id"]] = future
+        await self.app.update_queue.put(Update.de_json(data, self.app.bot))
+        await future
+        if self.args.think_time:
+            await asyncio.sleep(self.args.think_time)
+
+    async def send_text(self, chat_id: int, text: str):
+        update_id = next(self.update_ids)
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+        await self.submit({"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+            "from": user, "text": text,
+        }})
+
+    async def press(self, chat_id: int, prefix: str) -> bool:
+        data = next((d for d in self.api.keyboards.get(chat_id, []) if d.startswith(prefix)), None)
+        if data is None:
+            return False
+        update_id = next(self.update_ids)
+        user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+        bot_user = {"id": 1, "is_bot": True, "first_name": "Bench"}
+        await self.submit({"update_id": update_id, "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": str(chat_id), "data": data,
+            "message": {"message_id": self.api.last_message.get(chat_id, 1), "date": int(time.time()),
+                        "chat": {"id": chat_id, "type": "private"}, "from": bot_user, "text": "..."},
+        }})
+        return True
+
+    async def run_chat(self, chat_id: int):
+        for round_no in range(self.args.rounds):
+            # Добавить задачу
+            await self.send_text(chat_id, "Добавить задачу")
+            await self.send_text(chat_id, f"bench task {chat_id}-{round_no}")
+            await self.send_text(chat_id, "2030")
+            await self.press(chat_id, "month_")
+            await self.press(chat_id, "day_")
+            await self.send_text(chat_id, "18:00")
+            # Просмотреть задачи и все данные
+            await self.send_text(chat_id, "Просмотреть задачи")
+            await self.send_text(chat_id, date.today().isoformat())
+            await self.press(chat_id, "pg:")
+            await self.send_text(chat_id, "Просмотреть все данные")
+            # Обновить задачу
+            await self.send_text(chat_id, "Обновить задачу")
+            if await self.press(chat_id, "upd_"):
+                await self.press(chat_id, "text_keep")
+                await self.press(chat_id, "status_выполнено")
+
+
+def seed_tasks(bot, args, reminder_due: dict):
+    """Загружает задачи напрямую в хранилище (в обход add_task, чтобы не засорять счётчики)."""
+    now = datetime.now()
+    batch = []
+    for i in range(args.seed_tasks):
+        batch.append({
+            "text": f"seed {i}",
+            "deadline": (now + timedelta(days=30 + i % 365)).replace(microsecond=0),
+            "status": random.choice(["не выполнено", "выполнено"]),
+            "date_created": (date.today() - timedelta(days=i % 365)).isoformat(),
+            "chat_id": 1_000_000 + i % max(args.seed_chats, 1),
+            "reminders": {"day": False, "hour": False, "on_time": False},
+        })
+        if len(batch) >= 10000:
+            bot.repository.add_tasks(batch)
+            batch = []
+    # Напоминания во время теста: ранние уже отправлены, ждём только напоминание в момент дедлайна
+    for i in range(args.reminders):
+        name = f"reminder {i}"
+        deadline_dt = now + timedelta(seconds=2 + args.reminder_window * i / max(args.reminders, 1))
+        deadline_dt = deadline_dt.replace(microsecond=deadline_dt.microsecond // 1000 * 1000)
+        reminder_due[name] = deadline_dt
+        batch.append({
+            "text": name,
+            "deadline": deadline_dt,
+            "status": "не выполнено",
+            "date_created": date.today().isoformat(),
+            "chat_id": 2_000_000 + i,
+            "reminders": {"day": True, "hour": True, "on_time": False},
+        })
+    if batch:
+        bot.repository.add_tasks(batch)
+
+
+async def run(args) -> dict:
+    bot = importlib.import_module("bot")
+    counter = OpCounter()
+    install_mongo(bot, args.mongo, counter)
+    # Таблицы SQLite нужны уже для загрузки задач; индексы MongoDB создаёт serve() после неё
+    if args.storage == "sqlite":
+        bot.repository.ensure_schema()
+    reminder_due = {}
+    expected_reminders = args.reminders
+    seed_started = time.perf_counter()
+    seed_tasks(bot, args, reminder_due)
+    seed_seconds = time.perf_counter() - seed_started
+
+    api = FakeBotApi(bot, reminder_due)
+    api_server = await bot.start_http_server("127.0.0.1", args.api_port, api.routes())
+    bench = Bench(bot, api, args)
+    bench.app = bot.build_application(update_processor=bench.make_processor())
+    stop_event = asyncio.Event()
+    serve_task = asyncio.create_task(bot.serve(bench.app, stop_event, receive_updates=False))
+
+    # Ждём, пока координатор получит разделы и загрузит расписание
+    while not bot.partition_coordinator.partitions:
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.2)
+
+    ops_before = counter.total()
+    started = time.perf_counter()
+    await asyncio.gather(*(bench.run_chat(chat_id) for chat_id in range(1, args.chats + 1)))
+    workload_seconds = time.perf_counter() - started
+    workload_ops = counter.total() - ops_before
+    updates = len(bench.latencies)
+
+    # Ждём оставшиеся напоминания (но не бесконечно)
+    wait_until = time.perf_counter() + args.reminder_window + 30
+    while reminder_due and time.perf_counter() < wait_until:
+        await asyncio.sleep(0.1)
+
+    stop_event.set()
+    await serve_task
+    api_server.close()
+    await api_server.wait_closed()
+    bot.db_executor.shutdown(wait=False)
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": vars(args),
+        "results": {
+            "seed_seconds": round(seed_seconds, 3),
+            "workload_seconds": round(workload_seconds, 3),
+            "updates": updates,
+            "updates_per_second": round(updates / workload_seconds, 2) if workload_seconds else None,
+            "handler_latency": percentiles(bench.latencies),
+            "reminder_lateness": {**percentiles(api.reminder_lateness), "expected": expected_reminders,
+                                  "missed": len(reminder_due)},
+            "mongo_ops_per_update": round(workload_ops / updates, 3) if updates else None,
+            "mongo_ops": dict(counter.counts.most_common()),
+            "bot_api_calls": dict(api.calls.most_common()),
+            "send_queue_retries": bot.send_queue.retries,
+            "cache": bot.query_cache.stats(),
+        },
+    }
+
+
+def main():
+    args = parse_args()
+    configure_environment(args)
+    report = asyncio.run(run(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    results = report["results"]
+    print(f"Обновлений: {results['updates']}, {results['updates_per_second']} в секунду")
+    print(f"Задержка обработчиков: {results['handler_latency']}")
+    print(f"Опоздание напоминаний: {results['reminder_lateness']}")
+    print(f"Операций MongoDB на обновление: {results['mongo_ops_per_update']}")
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
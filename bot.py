@@ -1,8 +1,28 @@
+import os
+import sys
+import socket
+import uuid
 import logging
 import asyncio
-import nest_asyncio
+import contextlib
+import functools
+import heapq
+import html
+import itertools
+import json
+import math
+import re
+import signal
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
 import calendar
-from datetime import datetime, date, timedelta
+import csv
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, date, timedelta, timezone
 
 from telegram import (
     Update,
@@ -17,138 +37,3535 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    BaseUpdateProcessor,
+    BaseRateLimiter,
+    BasePersistence,
+    PersistenceInput,
     filters,
 )
-from pymongo import MongoClient
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from pymongo import MongoClient, UpdateOne, ReplaceOne, DeleteOne, CursorType, ReturnDocument, monitoring
+from pymongo import timeout as mongo_timeout
+from pymongo.errors import BulkWriteError, CollectionInvalid, DuplicateKeyError, OperationFailure
+import bson
 from bson.objectid import ObjectId
 
 
-nest_asyncio.apply()
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Настройки (можно переопределить переменными окружения)
+# Токен бота от BotFather (обязателен для запуска бота; служебным командам не нужен)
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
+# Адрес Bot API (например, локальный сервер Bot API); по умолчанию — api.telegram.org
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "")
+# Режим получения обновлений: polling или webhook
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+# Встроенный HTTP-сервер для режима webhook
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+# Публичный адрес webhook; если пуст, setWebhook не вызывается (удобно для локальной отладки)
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Где хранятся задачи, записи журнала, повторяющиеся задачи, статистика и outbox напоминаний:
+# mongo или sqlite (встроенная база в файле SQLITE_PATH)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "mongo")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "task_planner.db")
+MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/")
+MONGO_DB = os.environ.get("MONGO_DB", "task_planner")
+# Размер пула соединений с MongoDB и число потоков для запросов к ней
+MONGO_POOL_SIZE = int(os.environ.get("MONGO_POOL_SIZE", "20"))
+# Таймаут одного обращения к данным из асинхронного кода, в секундах: ограничивает и ожидание результата,
+# и сами операции MongoDB внутри обращения (в SQLite — ожидание блокировки базы)
+DB_CALL_TIMEOUT = float(os.environ.get("DB_CALL_TIMEOUT", "10"))
+# Сколько обновлений Telegram обрабатывается одновременно (в разных чатах)
+HANDLER_CONCURRENCY = int(os.environ.get("HANDLER_CONCURRENCY", "64"))
+# Лимиты Telegram на исходящие сообщения: всего и в один чат, сообщений в секунду
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+# Кэш списков задач и записей: время жизни (с) и предельный объём (байт)
+CACHE_TTL = float(os.environ.get("CACHE_TTL", "60"))
+CACHE_MAX_BYTES = int(os.environ.get("CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Рассылать сброс кэша другим экземплярам бота через MongoDB
+CACHE_SHARED_INVALIDATION = os.environ.get("CACHE_SHARED_INVALIDATION", "0") == "1"
+# Напоминания делятся между экземплярами бота по chat_id на REMINDER_PARTITIONS разделов
+REMINDER_PARTITIONS = int(os.environ.get("REMINDER_PARTITIONS", "16"))
+# Срок аренды раздела (с) и период её продления
+LEASE_TTL = float(os.environ.get("LEASE_TTL", "30"))
+LEASE_RENEW_INTERVAL = float(os.environ.get("LEASE_RENEW_INTERVAL", "10"))
+# Сохранение состояния диалогов в MongoDB (по умолчанию — только с хранилищем mongo):
+# период записи (с) и срок хранения неактивного состояния (с)
+PERSISTENCE_ENABLED = os.environ.get("PERSISTENCE_ENABLED", "1" if STORAGE_BACKEND == "mongo" else "0") == "1"
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", "5"))
+STATE_IDLE_TTL = int(os.environ.get("STATE_IDLE_TTL", str(24 * 3600)))
+# Таймаут неактивного диалога (с); работает, если установлен python-telegram-bot[job-queue]
+try:
+    import apscheduler  # noqa: F401
+    CONVERSATION_TIMEOUT = float(os.environ.get("CONVERSATION_TIMEOUT", "3600"))
+except ImportError:
+    CONVERSATION_TIMEOUT = None
+# HTTP-эндпоинт метрик в формате Prometheus (METRICS_PORT=0 — отключить)
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+# Вызовы обработчиков и функций работы с данными дольше этого порога (с) пишутся в журнал
+SLOW_CALL_THRESHOLD = float(os.environ.get("SLOW_CALL_THRESHOLD", "1"))
+
+# Архив: через сколько дней выполненные и отработавшие задачи переносятся в архив,
+# как часто (с) запускается перенос и через сколько дней архив очищается (0 — хранить всегда)
+ARCHIVE_AFTER_DAYS = float(os.environ.get("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_PURGE_DAYS = float(os.environ.get("ARCHIVE_PURGE_DAYS", "0"))
+# Период (с) пересчёта статистики чатов агрегацией по задачам (0 — не пересчитывать)
+STATS_REBUILD_INTERVAL = float(os.environ.get("STATS_REBUILD_INTERVAL", str(24 * 3600)))
+# Обновлять расписание напоминаний по change stream коллекции tasks (нужен набор реплик MongoDB);
+# 0 — только опрос по updated_at
+REMINDER_CHANGE_STREAM = os.environ.get("REMINDER_CHANGE_STREAM", "1") == "1"
+# Число одновременных отправителей напоминаний
+REMINDER_SENDER_WORKERS = int(os.environ.get("REMINDER_SENDER_WORKERS", "8"))
+# Уникальный идентификатор этого процесса бота
+INSTANCE_ID = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+# --------------- Метрики ---------------
+# Границы корзин гистограмм длительности (с)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Опоздание напоминаний измеряется в более крупном масштабе
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 300, 900)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(labels: tuple, le: str = None) -> str:
+    parts = [f'{name}="{escape_label(value)}"' for name, value in labels]
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Metrics:
+    """Счётчики, гистограммы и вычисляемые показатели в памяти процесса.
+
+    Обновляются и из event loop, и из пула потоков MongoDB, поэтому защищены
+    блокировкой. ``render()`` выдаёт текстовый формат Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: tuple = LATENCY_BUCKETS):
+        self._meta[name] = (kind, help_text, buckets)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                # Счётчики по корзинам, затем сумма и общее число наблюдений
+                series = self._histograms[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def gauge(self, name: str, help_text: str, func, kind: str = "gauge"):
+        """Показатель, вычисляемый при каждом запросе метрик."""
+        self.describe(name, kind, help_text)
+        self._gauges[name] = func
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        series = {}
+        for (name, labels), value in counters:
+            series.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+        for (name, labels), values in histograms:
+            buckets = self._meta[name][2]
+            lines = series.setdefault(name, [])
+            for bound, count in zip(buckets, values):
+                lines.append(f"{name}_bucket{format_labels(labels, bound)} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels, '+Inf')} {values[-1]}")
+            lines.append(f"{name}_sum{format_labels(labels)} {values[-2]}")
+            lines.append(f"{name}_count{format_labels(labels)} {values[-1]}")
+        for name, func in self._gauges.items():
+            try:
+                series[name] = [f"{name} {float(func())}"]
+            except Exception as e:
+                logger.error(f"Ошибка при вычислении метрики {name}: {e}")
+        out = []
+        for name, lines in series.items():
+            kind, help_text, _ = self._meta[name]
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_handler_seconds", "histogram", "Длительность обработчиков обновлений")
+metrics.describe("bot_handler_errors_total", "counter", "Исключения в обработчиках обновлений")
+metrics.describe("bot_db_call_seconds", "histogram", "Длительность функций работы с данными (с ожиданием пула)")
+metrics.describe("bot_db_call_errors_total", "counter", "Ошибки и таймауты функций работы с данными")
+metrics.describe("bot_mongo_command_seconds", "histogram", "Длительность команд MongoDB по коллекциям")
+metrics.describe("bot_mongo_command_errors_total", "counter", "Неудачные команды MongoDB по коллекциям")
+metrics.describe("bot_sweep_seconds", "histogram", "Длительность одного прохода проверки дедлайнов")
+metrics.describe("bot_sweep_tasks_scanned_total", "counter", "Задачи, прочитанные при проверке дедлайнов")
+metrics.describe("bot_sweep_errors_total", "counter", "Проходы проверки дедлайнов, завершившиеся ошибкой")
+metrics.describe("bot_reminder_lag_seconds", "histogram", "Опоздание напоминания: отправка минус положенное время",
+                 buckets=LAG_BUCKETS)
+metrics.describe("bot_send_failures_total", "counter", "Запросы к Bot API, завершившиеся ошибкой")
+metrics.describe("bot_reminder_deliveries_total", "counter", "Попытки доставки напоминаний из outbox по исходу")
+
+
+def record_call(kind: str, name: str, elapsed: float):
+    """Журнал медленных вызовов."""
+    if elapsed >= SLOW_CALL_THRESHOLD:
+        logger.warning(f"Медленный вызов ({kind}) {name}: {elapsed:.3f} с")
+
+
+def timed_handler(callback):
+    """Оборачивает обработчик обновления замером длительности и подсчётом ошибок."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.inc("bot_handler_errors_total", handler=name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            metrics.observe("bot_handler_seconds", elapsed, handler=name)
+            record_call("обработчик", name, elapsed)
+
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_handlers(handlers):
+    """Подменяет callback всех обработчиков, включая вложенные в ConversationHandler."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        elif not getattr(handler.callback, "instrumented", False):
+            handler.callback = timed_handler(handler.callback)
+
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Число и длительность команд MongoDB по коллекциям (служебные команды без коллекции не учитываются)."""
+
+    def __init__(self):
+        self._collections = {}
+
+    def started(self, event):
+        command = event.command
+        collection = command.get("collection") if event.command_name == "getMore" else command.get(event.command_name)
+        if isinstance(collection, str):
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event):
+        self._record(event, failed=False)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+    def _record(self, event, failed: bool):
+        collection = self._collections.pop((event.connection_id, event.request_id), None)
+        if collection is None:
+            return
+        metrics.observe("bot_mongo_command_seconds", event.duration_micros / 1e6,
+                        collection=collection, command=event.command_name)
+        if failed:
+            metrics.inc("bot_mongo_command_errors_total", collection=collection, command=event.command_name)
+
+
+async def metrics_endpoint(request):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode("utf-8")
+
+
+# Подключение к MongoDB создаётся при первом обращении к коллекции: с STORAGE_BACKEND=sqlite
+# и выключенными подсистемами на MongoDB (см. README) сервер MongoDB не нужен
+mongo_client = None
+mongo_client_lock = threading.Lock()
+
+
+def get_mongo_client() -> MongoClient:
+    global mongo_client
+    with mongo_client_lock:
+        if mongo_client is None:
+            mongo_client = MongoClient(MONGO_URI, maxPoolSize=MONGO_POOL_SIZE,
+                                       waitQueueTimeoutMS=int(DB_CALL_TIMEOUT * 1000),
+                                       event_listeners=[MongoCommandMetrics()])
+        return mongo_client
+
+
+class LazyDatabase:
+    """База MONGO_DB: ``db[name]`` — ленивая коллекция, остальные атрибуты — у настоящей базы."""
+
+    def __getitem__(self, name: str):
+        return LazyCollection(name)
+
+    def __getattr__(self, attr):
+        return getattr(get_mongo_client()[MONGO_DB], attr)
+
+
+class LazyCollection:
+    """Коллекция MongoDB, которая подключается к серверу при первом вызове своего метода."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._collection = None
+
+    def __getattr__(self, attr):
+        if self._collection is None:
+            self._collection = get_mongo_client()[MONGO_DB][self.name]
+        return getattr(self._collection, attr)
+
+
+db = LazyDatabase()
+entries_collection = db["entries"]
+tasks_collection = db["tasks"]
+tasks_archive_collection = db["tasks_archive"]
+recurring_collection = db["recurring_tasks"]
+occurrence_states_collection = db["occurrence_states"]
+cache_invalidations_collection = db["cache_invalidations"]
+instances_collection = db["scheduler_instances"]
+leases_collection = db["scheduler_leases"]
+conversations_collection = db["conversations"]
+user_data_collection = db["user_data"]
+reminder_outbox_collection = db["reminder_outbox"]
+stats_collection = db["chat_stats"]
+change_stream_tokens_collection = db["change_stream_tokens"]
+
+# Синхронный pymongo выполняется в ограниченном пуле потоков, чтобы не блокировать event loop
+db_executor = ThreadPoolExecutor(max_workers=MONGO_POOL_SIZE, thread_name_prefix="mongo")
+
+
+def call_with_deadline(call, timeout):
+    # pymongo.timeout задаёт общий срок всем операциям внутри вызова (maxTimeMS на сервере и таймауты
+    # сокетов), поэтому по таймауту освобождается и поток пула, а не только ожидающий его обработчик
+    with mongo_timeout(timeout):
+        return call()
+
+
+async def run_db(func, *args, timeout=DB_CALL_TIMEOUT, **kwargs):
+    """Асинхронно выполняет функцию работы с данными в пуле потоков MongoDB.
+
+    ``timeout`` (None — без ограничения) ограничивает и ожидание, и операции MongoDB внутри функции.
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(call_with_deadline, functools.partial(func, *args, **kwargs), timeout)
+    name = getattr(func, "__name__", repr(func))
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(loop.run_in_executor(db_executor, call), timeout=timeout)
+    except Exception:
+        metrics.inc("bot_db_call_errors_total", helper=name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe("bot_db_call_seconds", elapsed, helper=name)
+        record_call("данные", name, elapsed)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления разных чатов параллельно, а одного чата — строго по порядку.
+
+    Порядок внутри чата нужен диалогам ConversationHandler.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, "effective_chat", None)
+        if chat is None:
+            await coroutine
+            return
+        # Для каждого чата хранится [замок, число ожидающих обновлений]
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chat_locks.clear()
+
+
+# Функция для формирования главного меню (клавиатура)
+def get_main_keyboard():
+    keyboard = [
+        ["Добавить запись", "Просмотреть записи"],
+        ["Добавить задачу", "Просмотреть задачи"],
+        ["Добавить повторяющуюся задачу", "Повторяющиеся задачи"],
+        ["Обновить задачу", "Обновить несколько задач"],
+        ["Просмотреть все данные", "Поиск"],
+        ["Удалить задачи за дату", "Статистика"],
+        ["Удалить все записи", "Удалить все задачи"],
+        ["Отмена"],
+    ]
+    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+
+
+# --------------- Планировщик напоминаний ---------------
+# Смещения напоминаний относительно дедлайна в порядке срабатывания
+REMINDER_OFFSETS = (
+    ("day", timedelta(days=1)),
+    ("hour", timedelta(hours=1)),
+    ("on_time", timedelta(0)),
+)
+# Фильтр задач, по которым ещё может сработать хотя бы одно напоминание
+PENDING_REMINDERS_FILTER = {"reminders.on_time": False}
+# Максимальный сон планировщика (защита от перевода системных часов)
+SCHEDULER_MAX_SLEEP = 300
+# Размер пачки идентификаторов в одном запросе к MongoDB
+SCHEDULER_BATCH_SIZE = 500
+# Через сколько повторить напоминания, которые не удалось записать в outbox
+SWEEP_RETRY_DELAY = timedelta(seconds=30)
+
+
+def next_reminder_time(deadline_dt: datetime, reminders: dict):
+    """Возвращает момент ближайшего неотправленного напоминания или None."""
+    if reminders.get("on_time"):
+        return None
+    for kind, offset in REMINDER_OFFSETS:
+        if not reminders.get(kind):
+            return deadline_dt - offset
+    return None
+
+
+class ReminderScheduler:
+    """Очередь с приоритетом: для каждой задачи хранится время ближайшего напоминания.
+
+    Устаревшие элементы кучи не удаляются сразу, а пропускаются при извлечении
+    (актуальное время задачи хранится в словаре ``_fire_at``). Методы изменения
+    расписания потокобезопасны: их вызывают функции работы с данными из пула потоков.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._fire_at = {}
+        self._lock = threading.Lock()
+        self._wakeup = asyncio.Event()
+        self._loop = None
+
+    def __len__(self):
+        return len(self._fire_at)
+
+    def schedule(self, task_id, fire_at):
+        if fire_at is None:
+            self.unschedule(task_id)
+            return
+        with self._lock:
+            if self._fire_at.get(task_id) == fire_at:
+                return
+            head = self._head()
+            self._fire_at[task_id] = fire_at
+            heapq.heappush(self._heap, (fire_at, task_id))
+            self._compact()
+        if head is None or fire_at < head:
+            self._notify()
+
+    def unschedule(self, task_id):
+        with self._lock:
+            self._fire_at.pop(task_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._heap.clear()
+            self._fire_at.clear()
+        self._notify()
+
+    def next_fire_time(self):
+        with self._lock:
+            return self._head()
+
+    def _head(self):
+        while self._heap:
+            fire_at, task_id = self._heap[0]
+            if self._fire_at.get(task_id) == fire_at:
+                return fire_at
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: datetime):
+        """Извлекает идентификаторы задач, время напоминания которых уже наступило."""
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, task_id = heapq.heappop(self._heap)
+                if self._fire_at.get(task_id) == fire_at:
+                    del self._fire_at[task_id]
+                    due.append(task_id)
+        return due
+
+    async def wait_until_due(self):
+        """Спит ровно до ближайшего напоминания или до появления более раннего."""
+        self._loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            fire_at = self.next_fire_time()
+            if fire_at is None:
+                timeout = SCHEDULER_MAX_SLEEP
+            else:
+                timeout = (fire_at - datetime.now()).total_seconds()
+                if timeout <= 0:
+                    return
+                timeout = min(timeout, SCHEDULER_MAX_SLEEP)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _notify(self):
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._wakeup.set()
+        else:
+            loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _compact(self):
+        # Перестраиваем кучу, если устаревших элементов стало слишком много
+        if len(self._heap) > 2 * len(self._fire_at) + 1024:
+            self._heap = [(fire_at, task_id) for task_id, fire_at in self._fire_at.items()]
+            heapq.heapify(self._heap)
+
+
+reminder_scheduler = ReminderScheduler()
+metrics.gauge("bot_scheduled_reminders", "Задачи в расписании напоминаний", lambda: len(reminder_scheduler))
+
+
+def parse_deadline(value):
+    """Дедлайн хранится как BSON datetime; строки ISO остаются только в ещё не мигрированных документах."""
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+
+def schedule_task_reminders(task: dict):
+    # Задачами чужих разделов занимаются другие экземпляры бота
+    if not partition_coordinator.owns(task.get("chat_id")):
+        reminder_scheduler.unschedule(task["_id"])
+        return
+    try:
+        deadline_dt = parse_deadline(task["deadline"])
+    except Exception:
+        reminder_scheduler.unschedule(task["_id"])
+        return
+    reminders = task.get("reminders", {"day": False, "hour": False, "on_time": False})
+    reminder_scheduler.schedule(task["_id"], next_reminder_time(deadline_dt, reminders))
+
+
+def ensure_indexes():
+    repository.ensure_schema()
+    if PERSISTENCE_ENABLED:
+        conversations_collection.create_index([("n", 1)], name="name")
+        conversations_collection.create_index([("t", 1)], name="idle_ttl", expireAfterSeconds=STATE_IDLE_TTL)
+        user_data_collection.create_index([("t", 1)], name="idle_ttl", expireAfterSeconds=STATE_IDLE_TTL)
+
+
+MIGRATION_BATCH_SIZE = 1000
+
+
+def migrate_deadlines(batch_size: int = MIGRATION_BATCH_SIZE):
+    """Переводит строковые дедлайны в BSON datetime пачками по возрастанию _id (хранилище mongo).
+
+    Бот может работать во время миграции: обновление выполняется только если
+    документ всё ещё содержит ту же строку, а чтение понимает оба формата.
+    """
+    converted = 0
+    last_id = None
+    while True:
+        query = {"deadline": {"$type": "string"}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        batch = list(tasks_collection.find(query, {"deadline": 1}).sort("_id", 1).limit(batch_size))
+        if not batch:
+            break
+        last_id = batch[-1]["_id"]
+        requests = []
+        for task in batch:
+            try:
+                deadline_dt = parse_deadline(task["deadline"])
+            except ValueError:
+                logger.warning(f"Не удалось разобрать дедлайн задачи {task['_id']}: {task['deadline']!r}")
+                continue
+            requests.append(UpdateOne({"_id": task["_id"], "deadline": task["deadline"]},
+                                      {"$set": {"deadline": deadline_dt}}))
+        if requests:
+            converted += tasks_collection.bulk_write(requests, ordered=False).modified_count
+        logger.info(f"Миграция дедлайнов: обработано до {last_id}, преобразовано {converted}")
+    return converted
+
+
+def backfill_entry_chats(chat_id: int, batch_size: int = MIGRATION_BATCH_SIZE):
+    """Присваивает чат ``chat_id`` записям журнала без chat_id (созданным до разделения по чатам; хранилище mongo).
+
+    Из какого чата пришла старая запись, не сохранялось, поэтому владельца указывают явно.
+    Записи обходятся пачками по возрастанию _id, бот можно не останавливать.
+    """
+    updated = 0
+    last_id = None
+    while True:
+        query = {"chat_id": {"$exists": False}}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        ids = [entry["_id"] for entry in entries_collection.find(query, {"_id": 1}).sort("_id", 1).limit(batch_size)]
+        if not ids:
+            break
+        last_id = ids[-1]
+        updated += entries_collection.update_many({"_id": {"$in": ids}, "chat_id": {"$exists": False}},
+                                                  {"$set": {"chat_id": chat_id}}).modified_count
+        logger.info(f"Перенос записей в чат {chat_id}: обработано до {last_id}, обновлено {updated}")
+    return updated
+
+
+SCHEDULE_PROJECTION = {"deadline": 1, "reminders": 1, "chat_id": 1}
+RULE_SCHEDULE_PROJECTION = {"chat_id": 1, "next_fire": 1}
+
+
+def load_reminder_schedule():
+    """Перестраивает расписание по задачам своих разделов с неотправленными напоминаниями."""
+    reminder_scheduler.clear()
+    partitions = partition_coordinator.partitions
+    if not partitions:
+        return
+    for task in repository.find_schedule_tasks(partitions):
+        schedule_task_reminders(task)
+    for rule in repository.find_schedule_rules(partitions):
+        schedule_rule_reminders(rule)
+    logger.info(f"Планировщик напоминаний загружен: {len(reminder_scheduler)} задач, "
+                f"разделов: {len(partitions)} из {REMINDER_PARTITIONS}")
+
+
+# Запас по времени при досинхронизации расписания (на случай расхождения часов экземпляров)
+SYNC_OVERLAP = timedelta(seconds=10)
+
+
+def sync_reminder_schedule(since: datetime):
+    """Добавляет в расписание задачи, созданные или изменённые после ``since`` (в т.ч. другими экземплярами).
+
+    Задачи опрашиваются, только пока расписание не обновляет поток изменений (TaskChangeWatcher).
+    Возвращает отметку времени для следующего вызова.
+    """
+    started = datetime.now(timezone.utc)
+    partitions = partition_coordinator.partitions
+    if partitions:
+        if not task_change_watcher.active:
+            for task in repository.find_schedule_tasks(partitions, updated_since=since):
+                schedule_task_reminders(task)
+        for rule in repository.find_schedule_rules(partitions, updated_since=since):
+            schedule_rule_reminders(rule)
+    return started - SYNC_OVERLAP
+
+
+# --------------- Координация нескольких экземпляров ---------------
+def chat_partition(chat_id: int) -> int:
+    return chat_id % REMINDER_PARTITIONS
+
+
+def partition_filter(partitions) -> dict:
+    """Условие на chat_id для набора разделов.
+
+    $mod в MongoDB для отрицательных chat_id (группы) даёт отрицательный остаток,
+    поэтому для каждого раздела проверяются оба варианта.
+    """
+    if len(partitions) == REMINDER_PARTITIONS:
+        return {}
+    conditions = []
+    for partition in sorted(partitions):
+        conditions.append({"chat_id": {"$mod": [REMINDER_PARTITIONS, partition]}})
+        if partition:
+            conditions.append({"chat_id": {"$mod": [REMINDER_PARTITIONS, partition - REMINDER_PARTITIONS]}})
+    return {"$or": conditions}
+
+
+class PartitionCoordinator:
+    """Распределяет разделы напоминаний между живыми экземплярами через аренды в MongoDB.
+
+    Каждый экземпляр пишет сердцебиение в ``scheduler_instances`` и держит не больше
+    своей честной доли аренд в ``scheduler_leases``. Аренды упавшего экземпляра
+    истекают через LEASE_TTL и забираются остальными. С ``shared=False`` (хранилище sqlite —
+    база одного процесса) экземпляр один и владеет всеми разделами без аренд.
+    """
+
+    def __init__(self, instance_id: str = INSTANCE_ID, partitions: int = REMINDER_PARTITIONS,
+                 shared: bool = STORAGE_BACKEND == "mongo"):
+        self.instance_id = instance_id
+        self.total = partitions
+        self.shared = shared
+        self.partitions = frozenset()
+
+    def owns(self, chat_id) -> bool:
+        return chat_id is not None and chat_partition(chat_id) in self.partitions
+
+    def rebalance(self):
+        """Продлевает, освобождает и захватывает аренды. Возвращает (полученные, потерянные) разделы."""
+        if not self.shared:
+            acquired = frozenset(range(self.total)) - self.partitions
+            self.partitions = frozenset(range(self.total))
+            return acquired, frozenset()
+        now = datetime.now(timezone.utc)
+        expires_at = now + timedelta(seconds=LEASE_TTL)
+        instances_collection.update_one({"_id": self.instance_id}, {"$set": {"expires_at": expires_at}}, upsert=True)
+        alive = max(1, instances_collection.count_documents({"expires_at": {"$gt": now}}))
+        fair_share = math.ceil(self.total / alive)
+
+        owned = set()
+        for partition in self.partitions:
+            result = leases_collection.update_one({"_id": partition, "owner": self.instance_id},
+                                                  {"$set": {"expires_at": expires_at}})
+            if result.matched_count:
+                owned.add(partition)
+        for partition in sorted(owned, reverse=True)[:max(0, len(owned) - fair_share)]:
+            self._release(partition)
+            owned.discard(partition)
+        for partition in range(self.total):
+            if len(owned) >= fair_share:
+                break
+            if partition not in owned and self._acquire(partition, now, expires_at):
+                owned.add(partition)
+
+        acquired = owned - self.partitions
+        lost = self.partitions - owned
+        self.partitions = frozenset(owned)
+        return acquired, lost
+
+    def release_all(self):
+        if not self.shared:
+            self.partitions = frozenset()
+            return
+        for partition in self.partitions:
+            self._release(partition)
+        self.partitions = frozenset()
+        instances_collection.delete_one({"_id": self.instance_id})
+
+    def _acquire(self, partition: int, now: datetime, expires_at: datetime) -> bool:
+        try:
+            leases_collection.find_one_and_update(
+                {"_id": partition, "$or": [{"owner": None}, {"expires_at": {"$lte": now}}]},
+                {"$set": {"owner": self.instance_id, "expires_at": expires_at}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Аренда существует и принадлежит живому экземпляру
+            return False
+        return True
+
+    def _release(self, partition: int):
+        leases_collection.update_one({"_id": partition, "owner": self.instance_id},
+                                     {"$set": {"owner": None, "expires_at": datetime.now(timezone.utc)}})
+
+
+partition_coordinator = PartitionCoordinator()
+metrics.gauge("bot_owned_partitions", "Разделы напоминаний, арендованные экземпляром",
+              lambda: len(partition_coordinator.partitions))
+
+
+async def coordination_loop():
+    """Держит аренды разделов и досинхронизирует расписание с изменениями других экземпляров."""
+    since = datetime.now(timezone.utc)
+    while True:
+        try:
+            acquired, lost = await run_db(partition_coordinator.rebalance)
+            if acquired or lost:
+                logger.info(f"Разделы напоминаний: получено {sorted(acquired)}, потеряно {sorted(lost)}")
+                since = datetime.now(timezone.utc) - SYNC_OVERLAP
+                await run_db(load_reminder_schedule, timeout=None)
+            else:
+                since = await run_db(sync_reminder_schedule, since)
+        except Exception as e:
+            logger.error(f"Ошибка координации экземпляров: {e}")
+        await asyncio.sleep(LEASE_RENEW_INTERVAL)
+
+
+# --------------- Поток изменений задач ---------------
+# Коды ошибок MongoDB: change streams не поддерживаются (standalone mongod)
+# и потоком изменений нельзя продолжить с сохранённого токена
+CHANGE_STREAM_UNSUPPORTED = 40573
+CHANGE_STREAM_RESUME_FAILED = (260, 280, 286)
+# Как долго сервер держит пустой getMore потока и как часто сохраняется токен возобновления (с)
+CHANGE_STREAM_AWAIT_MS = 1000
+CHANGE_STREAM_TOKEN_INTERVAL = 5
+# Изменения, от которых зависит расписание: новые, заменённые и удалённые задачи и смена
+# дедлайна, статуса или всех флагов напоминаний (поштучные флаги ставит сам sweep при захвате)
+TASK_CHANGES_PIPELINE = [
+    {"$match": {"$or": [
+        {"operationType": {"$in": ["insert", "replace", "delete"]}},
+        {"operationType": "update", "$or": [
+            {"updateDescription.updatedFields.deadline": {"$exists": True}},
+            {"updateDescription.updatedFields.status": {"$exists": True}},
+            {"updateDescription.updatedFields.reminders": {"$exists": True}},
+        ]},
+    ]}},
+    {"$project": {"operationType": 1, "documentKey": 1, "fullDocument._id": 1, "fullDocument.chat_id": 1,
+                  "fullDocument.deadline": 1, "fullDocument.reminders": 1}},
+]
+
+
+class TaskChangeWatcher:
+    """Обновляет расписание напоминаний по change stream коллекции tasks сразу после изменения задачи.
+
+    Так замечаются и задачи, созданные или изменённые другими экземплярами, импортом или
+    сторонними программами. Токен возобновления хранится в change_stream_tokens, поэтому после
+    перезапуска или обрыва соединения поток продолжается с места остановки. Пока поток не работает
+    (standalone mongod, хранилище SQLite, REMINDER_CHANGE_STREAM=0 или ошибка), задачи
+    досинхронизирует опрос по updated_at в sync_reminder_schedule.
+    """
+
+    def __init__(self, name: str = "tasks"):
+        self.name = name
+        self.active = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not REMINDER_CHANGE_STREAM or not isinstance(repository, MongoRepository):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="task-changes", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.active = False
+
+    def run(self):
+        token = self._load_token()
+        while not self._stop.is_set():
+            try:
+                with tasks_collection.watch(TASK_CHANGES_PIPELINE, full_document="updateLookup",
+                                            resume_after=token, max_await_time_ms=CHANGE_STREAM_AWAIT_MS) as stream:
+                    if not self.active:
+                        logger.info("Расписание напоминаний обновляется по потоку изменений задач")
+                    self.active = True
+                    saved_at = 0.0
+                    while stream.alive and not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self.apply(change)
+                        token = stream.resume_token
+                        if token is not None and time.monotonic() - saved_at >= CHANGE_STREAM_TOKEN_INTERVAL:
+                            self._save_token(token)
+                            saved_at = time.monotonic()
+                    if token is not None:
+                        self._save_token(token)
+            except OperationFailure as e:
+                self.active = False
+                if e.code == CHANGE_STREAM_UNSUPPORTED:
+                    logger.info("Change streams недоступны (MongoDB без набора реплик): "
+                                "расписание напоминаний досинхронизируется опросом")
+                    return
+                if e.code in CHANGE_STREAM_RESUME_FAILED and token is not None:
+                    # Пропущенных изменений в oplog уже нет — начинаем заново и перечитываем расписание
+                    logger.warning(f"Поток изменений задач нельзя продолжить ({e}), расписание перезагружается")
+                    token = None
+                    self._save_token(None)
+                    load_reminder_schedule()
+                    continue
+                logger.error(f"Ошибка потока изменений задач: {e}")
+            except Exception as e:
+                self.active = False
+                logger.error(f"Ошибка потока изменений задач: {e}")
+            self._stop.wait(1)
+
+    def apply(self, change: dict):
+        metrics.inc("bot_task_change_events_total", operation=change["operationType"])
+        task = change.get("fullDocument")
+        # При updateLookup удалённой к этому времени задачи fullDocument пуст
+        if change["operationType"] == "delete" or task is None:
+            reminder_scheduler.unschedule(change["documentKey"]["_id"])
+        else:
+            schedule_task_reminders(task)
+
+    def _load_token(self):
+        doc = change_stream_tokens_collection.find_one({"_id": self.name})
+        return doc.get("token") if doc else None
+
+    def _save_token(self, token):
+        change_stream_tokens_collection.update_one(
+            {"_id": self.name}, {"$set": {"token": token, "updated_at": datetime.now(timezone.utc)}}, upsert=True)
+
+
+task_change_watcher = TaskChangeWatcher()
+metrics.describe("bot_task_change_events_total", "counter", "События потока изменений задач по виду операции")
+metrics.gauge("bot_task_change_stream_active", "Расписание обновляется по потоку изменений задач (1) или опросом (0)",
+              lambda: task_change_watcher.active)
+
+
+# --------------- Очередь исходящих сообщений ---------------
+# Классы приоритета: меньшее значение отправляется раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_REMINDER = 1
+# Сколько раз повторять запрос после ответа 429 (RetryAfter)
+SEND_MAX_RETRIES = 3
+# Короткий всплеск фоновых сообщений в один чат, который допускается без ожидания
+CHAT_BURST = 3
+# Сколько корзин отдельных чатов держать в памяти
+CHAT_BUCKETS_LIMIT = 10000
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Забирает токен (возможно, в долг) и возвращает, сколько секунд нужно подождать."""
+        self._refill()
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def time_until_token(self) -> float:
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class SendQueue(BaseRateLimiter):
+    """Центральная очередь всех запросов к Bot API.
+
+    Фоновый запрос (напоминание) сначала ждёт корзину своего чата, затем встаёт в общую
+    очередь с приоритетом, из которой запросы выпускаются не быстрее глобального лимита.
+    Интерактивные запросы (ответы, редактирование сообщений, answerCallbackQuery) идут
+    в общую очередь сразу: их темп задаёт сам пользователь, а редкий 429 обрабатывается повтором.
+    Так ответы пользователям не ждут ни лимита чата, ни пачки напоминаний.
+    Приоритет передаётся через ``rate_limit_args`` (по умолчанию — интерактивный).
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 max_retries: int = SEND_MAX_RETRIES):
+        self._global = TokenBucket(global_rate, max(global_rate, 1))
+        self._chat_rate = chat_rate
+        self._chat_buckets = {}
+        self._max_retries = max_retries
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._dispatcher = None
+        self._paused_until = 0.0
+        self.retries = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """Число запросов, ожидающих своей очереди."""
+        return len(self._heap)
+
+    async def initialize(self):
+        # ExtBot.initialize вызывается и приложением, и Updater — второй диспетчер не нужен
+        if self._dispatcher is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        while self._heap:
+            future = heapq.heappop(self._heap)[2]
+            if not future.done():
+                future.cancel()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = rate_limit_args if isinstance(rate_limit_args, int) else PRIORITY_INTERACTIVE
+        chat_id = data.get("chat_id")
+        attempt = 0
+        while True:
+            await self._acquire(priority, chat_id)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self._max_retries:
+                    metrics.inc("bot_send_failures_total", endpoint=endpoint)
+                    raise
+                attempt += 1
+                self.retries += 1
+                delay = e.retry_after
+                if isinstance(delay, timedelta):
+                    delay = delay.total_seconds()
+                logger.warning(f"Telegram просит подождать {delay} с ({endpoint}), попытка {attempt}")
+                # Ограничение флуда действует на весь бот — приостанавливаем всю очередь
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                await asyncio.sleep(delay)
+            except Exception:
+                metrics.inc("bot_send_failures_total", endpoint=endpoint)
+                raise
+
+    async def _acquire(self, priority: int, chat_id):
+        if chat_id is not None and priority != PRIORITY_INTERACTIVE:
+            await asyncio.sleep(self._chat_bucket(chat_id).reserve())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), future))
+        self._wakeup.set()
+        await future
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.pop(chat_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, CHAT_BURST)
+            if len(self._chat_buckets) >= CHAT_BUCKETS_LIMIT:
+                # Вытесняем самую давно использованную корзину
+                del self._chat_buckets[next(iter(self._chat_buckets))]
+        self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _dispatch(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = max(self._paused_until - time.monotonic(), self._global.time_until_token())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            future = heapq.heappop(self._heap)[2]
+            if future.done():
+                continue
+            self._global.reserve()
+            future.set_result(None)
+
+
+send_queue = SendQueue()
+metrics.gauge("bot_send_queue_depth", "Запросы к Bot API, ожидающие очереди", lambda: send_queue.queue_depth)
+metrics.gauge("bot_send_retries_total", "Повторы запросов после ответа 429", lambda: send_queue.retries, kind="counter")
+
+
+# --------------- Кэш списков задач и записей ---------------
+# Размер ограниченной (capped) коллекции для рассылки сброса кэша
+CACHE_INVALIDATIONS_SIZE = 1024 * 1024
+
+
+class ChatQueryCache:
+    """LRU-кэш результатов запросов по чату с TTL и ограничением объёма.
+
+    Ключ — (chat_id, описание запроса). Запись в чат сбрасывает все его ключи.
+    Поколение чата защищает от сохранения результата, прочитанного до сброса.
+    Возвращаемые значения общие для всех вызывающих, изменять их нельзя.
+    """
+
+    def __init__(self, ttl: float = CACHE_TTL, max_bytes: int = CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._chat_keys = {}
+        self._generations = {}
+        self._global_generation = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_or_load(self, chat_id, key, loader):
+        full_key = (chat_id, key)
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(full_key)
+            if item is not None and item[0] > now:
+                self._data.move_to_end(full_key)
+                self.hits += 1
+                return item[2]
+            self.misses += 1
+            generation = self._generation(chat_id)
+        value = loader()
+        size = len(bson.encode({"v": value}))
+        with self._lock:
+            if self._generation(chat_id) == generation and size <= self.max_bytes:
+                self._remove(full_key)
+                self._data[full_key] = (now + self.ttl, size, value)
+                self._chat_keys.setdefault(chat_id, set()).add(full_key)
+                self._bytes += size
+                while self._bytes > self.max_bytes:
+                    self._remove(next(iter(self._data)))
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, chat_id, publish: bool = True):
+        with self._lock:
+            self._generations[chat_id] = self._generations.get(chat_id, 0) + 1
+            for full_key in self._chat_keys.pop(chat_id, ()):
+                self._remove(full_key)
+            self.invalidations += 1
+        if publish and CACHE_SHARED_INVALIDATION:
+            cache_invalidations_collection.insert_one({"chat_id": chat_id, "origin": INSTANCE_ID})
+
+    def invalidate_all(self, publish: bool = True):
+        with self._lock:
+            self._global_generation += 1
+            self._data.clear()
+            self._chat_keys.clear()
+            self._bytes = 0
+            self.invalidations += 1
+        if publish and CACHE_SHARED_INVALIDATION:
+            cache_invalidations_collection.insert_one({"all": True, "origin": INSTANCE_ID})
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": len(self._data),
+                "bytes": self._bytes,
+            }
+
+    def _generation(self, chat_id):
+        return self._global_generation, self._generations.get(chat_id, 0)
+
+    def _remove(self, full_key):
+        item = self._data.pop(full_key, None)
+        if item is None:
+            return
+        self._bytes -= item[1]
+        keys = self._chat_keys.get(full_key[0])
+        if keys is not None:
+            keys.discard(full_key)
+            if not keys:
+                del self._chat_keys[full_key[0]]
+
+
+query_cache = ChatQueryCache()
+metrics.gauge("bot_cache_hits_total", "Попадания в кэш списков", lambda: query_cache.stats()["hits"], kind="counter")
+metrics.gauge("bot_cache_misses_total", "Промахи кэша списков", lambda: query_cache.stats()["misses"], kind="counter")
+metrics.gauge("bot_cache_bytes", "Объём кэша списков", lambda: query_cache.stats()["bytes"])
+
+
+def listen_cache_invalidations():
+    """Применяет сбросы кэша, опубликованные другими экземплярами (выполняется в отдельном потоке)."""
+    try:
+        db.create_collection("cache_invalidations", capped=True, size=CACHE_INVALIDATIONS_SIZE)
+    except CollectionInvalid:
+        pass
+    # Начинаем с текущего конца коллекции: старые сбросы уже не важны
+    last = cache_invalidations_collection.find_one(sort=[("$natural", -1)])
+    last_id = last["_id"] if last else ObjectId.from_datetime(datetime(1970, 1, 1))
+    while True:
+        try:
+            cursor = cache_invalidations_collection.find({"_id": {"$gt": last_id}},
+                                                         cursor_type=CursorType.TAILABLE_AWAIT)
+            for message in cursor:
+                last_id = message["_id"]
+                if message.get("origin") == INSTANCE_ID:
+                    continue
+                if message.get("all"):
+                    query_cache.invalidate_all(publish=False)
+                else:
+                    query_cache.invalidate(message.get("chat_id"), publish=False)
+        except Exception as e:
+            logger.error(f"Ошибка при чтении сбросов кэша: {e}")
+        time.sleep(1)
+
+
+def start_cache_invalidation_listener():
+    if CACHE_SHARED_INVALIDATION:
+        threading.Thread(target=listen_cache_invalidations, name="cache-invalidations", daemon=True).start()
+
+
+# --------------- Хранилище данных ---------------
+# Размер страницы при постраничном просмотре
+PAGE_SIZE = 10
+TASK_LIST_PROJECTION = {"text": 1, "deadline": 1, "status": 1}
+ENTRY_LIST_PROJECTION = {"date": 1, "text": 1}
+# Полнотекстовый поиск: текстовые индексы MongoDB со стеммингом русского языка
+SEARCH_LANGUAGE = "russian"
+SEARCH_SCORE = {"score": {"$meta": "textScore"}}
+
+
+class Repository(ABC):
+    """Хранилище рабочих и архивных задач, записей журнала, повторяющихся задач, счётчиков
+    статистики и outbox напоминаний.
+
+    Функции работы с данными обращаются к этим данным только через ``repository``;
+    кэш и расписание напоминаний остаются в них и от хранилища не зависят.
+    Документы передаются словарями в том виде, в каком их хранит MongoDB: _id — ObjectId,
+    deadline и completed_at — локальное время, updated_at — UTC, reminders — словарь флагов.
+
+    Задачи отбираются именованными фильтрами ``**filters``: ids, chat_id, date_created, status,
+    status_ne, deadline_from, deadline_before, deadlines, pending_reminders. С ``archived=True``
+    операция выполняется над архивом.
+    """
+
+    @abstractmethod
+    def ensure_schema(self):
+        """Создаёт таблицы (коллекции) и индексы."""
+
+    @abstractmethod
+    def add_entries(self, entries: list):
+        """Сохраняет записи, присваивая им _id."""
+
+    @abstractmethod
+    def find_entries(self, chat_id: int, dates: list) -> list:
+        ...
+
+    @abstractmethod
+    def find_entries_page(self, chat_id: int, anchor: ObjectId, backward: bool, limit: int) -> list:
+        """До ``limit`` записей чата после ``anchor`` по _id, в порядке листания."""
+
+    @abstractmethod
+    def iter_entries(self, chat_id: int):
+        """Записи чата по возрастанию _id."""
+
+    @abstractmethod
+    def delete_entries(self, chat_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def add_tasks(self, tasks: list):
+        """Сохраняет задачи, присваивая им _id."""
+
+    @abstractmethod
+    def find_tasks(self, archived: bool = False, **filters) -> list:
+        ...
+
+    @abstractmethod
+    def find_tasks_page(self, anchor: tuple, backward: bool, limit: int, archived: bool = False, **filters) -> list:
+        """До ``limit`` задач по (deadline, _id) после ключа ``anchor``, в порядке листания."""
+
+    @abstractmethod
+    def iter_tasks(self, chat_id: int):
+        """Рабочие, затем архивные задачи чата по возрастанию _id."""
+
+    @abstractmethod
+    def find_schedule_tasks(self, partitions, updated_since: datetime = None):
+        """Задачи разделов ``partitions`` с неотправленными напоминаниями
+        или (если задано ``updated_since``) изменённые после этого времени."""
+
+    @abstractmethod
+    def update_task(self, task_id: ObjectId, fields: dict, unset: tuple = ()):
+        """Меняет поля задачи и возвращает её документ до изменения (None, если задачи нет)."""
+
+    @abstractmethod
+    def set_completed_at(self, task_id: ObjectId, status: str, completed_at: datetime):
+        """Ставит время выполнения, если у задачи всё ещё статус ``status`` и время не выставлено."""
+
+    @abstractmethod
+    def update_tasks(self, fields: dict, unset: tuple = (), **filters) -> int:
+        ...
+
+    @abstractmethod
+    def shift_deadlines(self, changes: list) -> int:
+        """Применяет пары (задача, новые поля) к задачам, дедлайн которых не изменился с момента чтения."""
+
+    @abstractmethod
+    def delete_tasks(self, archived: bool = False, **filters) -> int:
+        ...
+
+    @abstractmethod
+    def claim_reminders(self, transitions: dict) -> set:
+        """Выставляет флаги напоминаний ({_id: {"reminders.<вид>": True}}), если они ещё не выставлены,
+        и возвращает _id задач, которые удалось пометить."""
+
+    @abstractmethod
+    def month_counts(self, chat_id: int, first: date, end: date) -> dict:
+        """Число задач (включая архивные) и записей чата по дням [first, end): {"ГГГГ-ММ-ДД": (задачи, записи)}."""
+
+    @abstractmethod
+    def search(self, chat_id: int, query: str, top: int) -> tuple:
+        """До ``top`` лучших совпадений среди задач и среди записей чата — два списка по убыванию поля score."""
+
+    @abstractmethod
+    def archive_batch(self, now: datetime, partitions, batch_size: int) -> tuple:
+        """Переносит в архив до ``batch_size`` подходящих задач разделов ``partitions``.
+
+        Возвращает прочитанные задачи и множество _id тех из них, что изменились во время переноса
+        и остались рабочими.
+        """
+
+    @abstractmethod
+    def purge_archive(self, before: datetime) -> int:
+        """Удаляет задачи, перенесённые в архив раньше ``before``."""
+
+    @abstractmethod
+    def chat_stats(self, partitions=None) -> dict:
+        """Документы chat_stats, посчитанные по рабочим и архивным задачам чатов разделов ``partitions``
+        (None — всех чатов)."""
+
+    @abstractmethod
+    def inc_chat_stats(self, deltas: dict):
+        """Прибавляет к счётчикам чатов изменения {chat_id: {поле: число}}; поля недель — "weeks.<неделя>.<поле>"."""
+
+    @abstractmethod
+    def find_chat_stats(self, chat_id: int):
+        ...
+
+    @abstractmethod
+    def replace_chat_stats(self, docs: list, partitions=None):
+        """Заменяет счётчики чатов разделов ``partitions`` (None — всех) документами ``docs``;
+        счётчики чатов этих разделов, которых нет в ``docs``, удаляются."""
+
+    @abstractmethod
+    def delete_chat_stats(self, chat_id: int):
+        ...
+
+    @abstractmethod
+    def add_rule(self, rule: dict):
+        """Сохраняет правило повторяющейся задачи, присваивая ему _id."""
+
+    @abstractmethod
+    def find_rules(self, chat_id: int = None, ids: list = None) -> list:
+        """Правила чата или правила с _id из ``ids`` по возрастанию _id."""
+
+    @abstractmethod
+    def find_rules_page(self, chat_id: int, anchor: ObjectId, backward: bool, limit: int) -> list:
+        """До ``limit`` правил чата после ``anchor`` по _id, в порядке листания."""
+
+    @abstractmethod
+    def find_schedule_rules(self, partitions, updated_since: datetime = None):
+        """Правила разделов ``partitions`` с ближайшим напоминанием
+        или (если задано ``updated_since``) изменённые после этого времени."""
+
+    @abstractmethod
+    def claim_rule_reminders(self, claims: dict) -> set:
+        """Сдвигает отметки правил ({_id: (прежняя reminded_until, новая, next_fire)}), если отметка
+        не изменилась с момента чтения, и возвращает _id правил, которые удалось сдвинуть."""
+
+    @abstractmethod
+    def delete_rules(self, chat_id: int, rule_id: ObjectId = None) -> list:
+        """Удаляет правила чата (или одно правило) вместе с состояниями вхождений; возвращает их _id."""
+
+    @abstractmethod
+    def find_occurrence_states(self, keys: list) -> dict:
+        """Статусы вхождений с ключами ``keys``: {ключ: статус}; хранятся только выполненные."""
+
+    @abstractmethod
+    def toggle_occurrence(self, rule_id: ObjectId, chat_id: int, key: str, occurrence: datetime):
+        """Переключает статус вхождения; возвращает новый статус или None, если правила в чате нет."""
+
+    @abstractmethod
+    def enqueue_reminders(self, items: list):
+        """Добавляет сообщения в outbox; сообщения с уже существующим _id пропускаются."""
+
+    @abstractmethod
+    def claim_outbox(self, limit: int, now: datetime, lease_until: datetime) -> list:
+        """Захватывает до ``limit`` готовых сообщений outbox до ``lease_until`` и возвращает их с меткой claim."""
+
+    @abstractmethod
+    def update_outbox_item(self, item: dict, fields: dict):
+        """Меняет поля сообщения outbox, если его захват (claim) не перехвачен."""
+
+    @abstractmethod
+    def purge_outbox(self, before: datetime) -> int:
+        """Удаляет доставленные и отброшенные сообщения, завершённые раньше ``before``."""
+
+
+class MongoRepository(Repository):
+    """Коллекции MongoDB: entries, tasks, tasks_archive, recurring_tasks, occurrence_states, chat_stats
+    и reminder_outbox."""
+
+    @staticmethod
+    def _tasks(archived: bool):
+        return tasks_archive_collection if archived else tasks_collection
+
+    @staticmethod
+    def _task_query(filters: dict) -> dict:
+        query = {}
+        if filters.get("ids") is not None:
+            query["_id"] = {"$in": list(filters["ids"])}
+        for field in ("chat_id", "date_created", "status"):
+            if filters.get(field) is not None:
+                query[field] = filters[field]
+        if filters.get("status_ne") is not None:
+            query["status"] = {"$ne": filters["status_ne"]}
+        deadline = {}
+        for name, op in (("deadline_from", "$gte"), ("deadline_before", "$lt"), ("deadlines", "$in")):
+            if filters.get(name) is not None:
+                deadline[op] = filters[name]
+        if deadline:
+            query["deadline"] = deadline
+        if filters.get("pending_reminders"):
+            query.update(PENDING_REMINDERS_FILTER)
+        return query
+
+    def ensure_schema(self):
+        tasks_collection.create_index([("chat_id", 1), ("date_created", 1), ("deadline", 1), ("_id", 1)],
+                                      name="chat_date_created_deadline")
+        tasks_collection.create_index([("chat_id", 1), ("deadline", 1), ("_id", 1)], name="chat_deadline")
+        tasks_collection.create_index([("chat_id", 1), ("status", 1), ("deadline", 1), ("_id", 1)],
+                                      name="chat_status_deadline")
+        tasks_collection.create_index(
+            [("deadline", 1)],
+            name="pending_reminders",
+            partialFilterExpression=PENDING_REMINDERS_FILTER,
+        )
+        tasks_collection.create_index([("updated_at", 1)], name="updated_at")
+        # Кандидаты в архив: выполненные (по времени изменения) и отработавшие (по дедлайну)
+        tasks_collection.create_index([("updated_at", 1)], name="done_updated_at",
+                                      partialFilterExpression={"status": "выполнено"})
+        tasks_collection.create_index([("deadline", 1)], name="fired_deadline",
+                                      partialFilterExpression={"reminders.on_time": True})
+        tasks_archive_collection.create_index([("chat_id", 1), ("date_created", 1), ("deadline", 1), ("_id", 1)],
+                                              name="chat_date_created_deadline")
+        tasks_archive_collection.create_index([("chat_id", 1), ("deadline", 1), ("_id", 1)], name="chat_deadline")
+        ensure_archive_purge_index()
+        # Записи разделены по чатам: chat_id — префикс всех индексов (и ключ шардирования {chat_id: 1, _id: 1})
+        for name in ("date", "text"):
+            # Индексы журнала без chat_id из прежних версий; второй текстовый индекс MongoDB не создаст
+            if name in entries_collection.index_information():
+                entries_collection.drop_index(name)
+        entries_collection.create_index([("chat_id", 1), ("date", 1), ("_id", 1)], name="chat_date")
+        entries_collection.create_index([("chat_id", 1), ("_id", 1)], name="chat")
+        # Текстовые индексы для поиска; поиск всегда идёт в пределах чата
+        tasks_collection.create_index([("chat_id", 1), ("text", "text")], name="chat_text",
+                                      default_language=SEARCH_LANGUAGE)
+        entries_collection.create_index([("chat_id", 1), ("text", "text")], name="chat_text",
+                                        default_language=SEARCH_LANGUAGE)
+        recurring_collection.create_index([("chat_id", 1), ("_id", 1)], name="chat")
+        recurring_collection.create_index([("updated_at", 1)], name="updated_at")
+        occurrence_states_collection.create_index([("rule_id", 1)], name="rule")
+        reminder_outbox_collection.create_index([("status", 1), ("next_attempt", 1)], name="ready")
+        reminder_outbox_collection.create_index([("claim", 1)], name="claim")
+        reminder_outbox_collection.create_index([("finished_at", 1)], name="retention",
+                                                expireAfterSeconds=OUTBOX_RETENTION)
+
+    def add_entries(self, entries: list):
+        entries_collection.insert_many(entries, ordered=False)
+
+    def find_entries(self, chat_id: int, dates: list) -> list:
+        return list(entries_collection.find({"chat_id": chat_id, "date": {"$in": list(dates)}}))
+
+    def find_entries_page(self, chat_id: int, anchor: ObjectId, backward: bool, limit: int) -> list:
+        query = {"chat_id": chat_id}
+        if anchor is not None:
+            query["_id"] = {"$lt" if backward else "$gt": anchor}
+        order = -1 if backward else 1
+        return list(entries_collection.find(query, ENTRY_LIST_PROJECTION).sort("_id", order).limit(limit))
+
+    def iter_entries(self, chat_id: int):
+        return entries_collection.find({"chat_id": chat_id}, ENTRY_LIST_PROJECTION).sort("_id", 1)
+
+    def delete_entries(self, chat_id: int) -> int:
+        return entries_collection.delete_many({"chat_id": chat_id}).deleted_count
+
+    def add_tasks(self, tasks: list):
+        tasks_collection.insert_many(tasks, ordered=False)
+
+    def find_tasks(self, archived: bool = False, **filters) -> list:
+        return list(self._tasks(archived).find(self._task_query(filters)))
+
+    def find_tasks_page(self, anchor: tuple, backward: bool, limit: int, archived: bool = False, **filters) -> list:
+        # Каждая страница — один ограниченный запрос по индексу, без skip
+        query = self._task_query(filters)
+        if anchor is not None:
+            deadline_dt, task_id = anchor
+            op = "$lt" if backward else "$gt"
+            query = {"$and": [query, {"$or": [{"deadline": {op: deadline_dt}},
+                                              {"deadline": deadline_dt, "_id": {op: task_id}}]}]}
+        order = -1 if backward else 1
+        cursor = self._tasks(archived).find(query, TASK_LIST_PROJECTION).sort([("deadline", order), ("_id", order)])
+        return list(cursor.limit(limit))
+
+    def iter_tasks(self, chat_id: int):
+        return itertools.chain(
+            tasks_collection.find({"chat_id": chat_id}, TASK_EXPORT_PROJECTION).sort("_id", 1),
+            tasks_archive_collection.find({"chat_id": chat_id}, TASK_EXPORT_PROJECTION).sort("_id", 1),
+        )
+
+    def find_schedule_tasks(self, partitions, updated_since: datetime = None):
+        if updated_since is None:
+            query = {**PENDING_REMINDERS_FILTER, **partition_filter(partitions)}
+        else:
+            query = {"updated_at": {"$gte": updated_since}, **partition_filter(partitions)}
+        return tasks_collection.find(query, SCHEDULE_PROJECTION)
+
+    def update_task(self, task_id: ObjectId, fields: dict, unset: tuple = ()):
+        update = {"$set": fields}
+        if unset:
+            update["$unset"] = {field: "" for field in unset}
+        return tasks_collection.find_one_and_update({"_id": task_id}, update, projection=STATS_PROJECTION)
+
+    def set_completed_at(self, task_id: ObjectId, status: str, completed_at: datetime):
+        tasks_collection.update_one({"_id": task_id, "status": status, "completed_at": {"$exists": False}},
+                                    {"$set": {"completed_at": completed_at}})
+
+    def update_tasks(self, fields: dict, unset: tuple = (), **filters) -> int:
+        update = {"$set": fields}
+        if unset:
+            update["$unset"] = {field: "" for field in unset}
+        return tasks_collection.update_many(self._task_query(filters), update).modified_count
+
+    def shift_deadlines(self, changes: list) -> int:
+        # У каждой задачи свой новый дедлайн, поэтому это отдельные UpdateOne одним bulk_write
+        requests = [UpdateOne({"_id": task["_id"], "deadline": task["deadline"]}, {"$set": fields})
+                    for task, fields in changes]
+        return tasks_collection.bulk_write(requests, ordered=False).modified_count
+
+    def delete_tasks(self, archived: bool = False, **filters) -> int:
+        return self._tasks(archived).delete_many(self._task_query(filters)).deleted_count
+
+    def claim_reminders(self, transitions: dict) -> set:
+        # Все условные обновления уходят одним неупорядоченным bulk_write, а выигравшие определяются по метке захвата
+        claim_id = ObjectId()
+        requests = []
+        for task_id, changed in transitions.items():
+            flags_unset = {field: False for field in changed}
+            requests.append(UpdateOne({"_id": task_id, **flags_unset},
+                                      {"$set": {**changed, "reminder_claim": claim_id}}))
+        tasks_collection.bulk_write(requests, ordered=False)
+        claimed = tasks_collection.find({"_id": {"$in": list(transitions)}, "reminder_claim": claim_id}, {"_id": 1})
+        return {task["_id"] for task in claimed}
+
+    def month_counts(self, chat_id: int, first: date, end: date) -> dict:
+        # Диапазон дат идёт по индексам chat_date_created_deadline и chat_date,
+        # архив и записи присоединяются через $unionWith
+        days = {"$gte": first.isoformat(), "$lt": end.isoformat()}
+        tasks_stage = [{"$match": {"chat_id": chat_id, "date_created": days}},
+                       {"$project": {"_id": 0, "day": "$date_created", "tasks": {"$literal": 1}}}]
+        pipeline = [
+            *tasks_stage,
+            {"$unionWith": {"coll": tasks_archive_collection.name, "pipeline": tasks_stage}},
+            {"$unionWith": {"coll": entries_collection.name, "pipeline": [
+                {"$match": {"chat_id": chat_id, "date": days}},
+                {"$project": {"_id": 0, "day": "$date", "entries": {"$literal": 1}}},
+            ]}},
+            {"$group": {"_id": "$day", "tasks": {"$sum": "$tasks"}, "entries": {"$sum": "$entries"}}},
+        ]
+        return {row["_id"]: (row["tasks"], row["entries"]) for row in tasks_collection.aggregate(pipeline)}
+
+    def search(self, chat_id: int, query: str, top: int) -> tuple:
+        text_filter = {"$text": {"$search": query, "$language": SEARCH_LANGUAGE}}
+        by_score = [("score", SEARCH_SCORE["score"])]
+        tasks = tasks_collection.find({"chat_id": chat_id, **text_filter}, {**TASK_LIST_PROJECTION, **SEARCH_SCORE})
+        entries = entries_collection.find({"chat_id": chat_id, **text_filter},
+                                          {**ENTRY_LIST_PROJECTION, **SEARCH_SCORE})
+        return list(tasks.sort(by_score).limit(top)), list(entries.sort(by_score).limit(top))
+
+    def archive_batch(self, now: datetime, partitions, batch_size: int) -> tuple:
+        # Пачка сначала копируется в архив (с upsert, поэтому повтор после сбоя безопасен), затем
+        # удаляется из рабочей коллекции с повторной проверкой условия. Задачи, изменённые за это
+        # время (например, статус вернули в «не выполнено»), остаются рабочими и убираются из архива.
+        eligible = {"$and": [archive_filter(now), partition_filter(partitions)]}
+        tasks = list(tasks_collection.find(eligible).limit(batch_size))
+        if not tasks:
+            return tasks, set()
+        archived_at = datetime.now(timezone.utc)
+        tasks_archive_collection.bulk_write(
+            [ReplaceOne({"_id": task["_id"]}, {**task, "archived_at": archived_at}, upsert=True) for task in tasks],
+            ordered=False,
+        )
+        ids = [task["_id"] for task in tasks]
+        tasks_collection.delete_many({"$and": [{"_id": {"$in": ids}}, archive_filter(now)]})
+        kept = [task["_id"] for task in tasks_collection.find({"_id": {"$in": ids}}, {"_id": 1})]
+        if kept:
+            tasks_archive_collection.delete_many({"_id": {"$in": kept}})
+        return tasks, set(kept)
+
+    def purge_archive(self, before: datetime) -> int:
+        # Архив чистит сама MongoDB по TTL-индексу purge (ensure_archive_purge_index)
+        return 0
+
+    def chat_stats(self, partitions=None) -> dict:
+        match = partition_filter(partitions) if partitions else {}
+        stats = {}
+        for collection in (tasks_collection, tasks_archive_collection):
+            self._aggregate_stats(collection, match, stats)
+        return stats
+
+    @staticmethod
+    def _aggregate_stats(collection, match: dict, stats: dict):
+        """Считает счётчики задач ``collection`` по чатам тремя агрегациями и добавляет их в ``stats``.
+
+        Недели группируются по дням, а дни переводятся в недели в add_week_stats: строк получается
+        не больше, чем дней с задачами, а week_key остаётся единственным определением недели.
+        """
+        done = {"$eq": ["$status", "выполнено"]}
+
+        def count(condition):
+            return {"$sum": {"$cond": [condition, 1, 0]}}
+
+        totals = collection.aggregate([
+            {"$match": match},
+            {"$group": {"_id": "$chat_id", "total": {"$sum": 1}, "completed": count(done),
+                        "overdue": count({"$and": [{"$ne": ["$status", "выполнено"]},
+                                                   {"$eq": ["$reminders.on_time", True]}]})}},
+        ], allowDiskUse=True)
+        for row in totals:
+            counters = chat_stats_doc(stats, row["_id"])
+            for field in ("total", "completed", "overdue"):
+                counters[field] += row[field]
+        created = collection.aggregate([
+            {"$match": match},
+            {"$group": {"_id": {"chat_id": "$chat_id", "day": "$date_created"}, "n": {"$sum": 1}}},
+        ], allowDiskUse=True)
+        for row in created:
+            add_week_stats(stats, row["_id"]["chat_id"], row["_id"]["day"], "created", row["n"])
+        completed = collection.aggregate([
+            {"$match": {"$and": [match, {"status": "выполнено", "completed_at": {"$type": "date"}}]}},
+            {"$group": {"_id": {"chat_id": "$chat_id",
+                                "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$completed_at"}}},
+                        "n": {"$sum": 1}, "on_time": count({"$lte": ["$completed_at", "$deadline"]})}},
+        ], allowDiskUse=True)
+        for row in completed:
+            add_completed_stats(stats, row["_id"]["chat_id"], row["_id"]["day"], row["n"], row["on_time"])
+
+    def inc_chat_stats(self, deltas: dict):
+        # Один $inc с upsert на чат, все чаты — одним bulk_write
+        requests = [UpdateOne({"_id": chat_id}, {"$inc": counters, "$setOnInsert": {"chat_id": chat_id}}, upsert=True)
+                    for chat_id, counters in deltas.items()]
+        if requests:
+            stats_collection.bulk_write(requests, ordered=False)
+
+    def find_chat_stats(self, chat_id: int):
+        return stats_collection.find_one({"_id": chat_id})
+
+    def replace_chat_stats(self, docs: list, partitions=None):
+        rebuilt_at = datetime.now(timezone.utc)
+        docs = [{**doc, "rebuilt_at": rebuilt_at} for doc in docs]
+        for start in range(0, len(docs), STATS_BATCH_SIZE):
+            stats_collection.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                                         for doc in docs[start:start + STATS_BATCH_SIZE]], ordered=False)
+        # Не заменённые сейчас документы прежних пересчётов — чаты без задач
+        match = partition_filter(partitions) if partitions else {}
+        stats_collection.delete_many({"$and": [match, {"rebuilt_at": {"$lt": rebuilt_at}}]})
+
+    def delete_chat_stats(self, chat_id: int):
+        stats_collection.delete_one({"_id": chat_id})
+
+    def add_rule(self, rule: dict):
+        recurring_collection.insert_one(rule)
+
+    def find_rules(self, chat_id: int = None, ids: list = None) -> list:
+        if ids is not None:
+            return list(recurring_collection.find({"_id": {"$in": list(ids)}}))
+        return list(recurring_collection.find({"chat_id": chat_id}, RULE_LIST_PROJECTION).sort("_id", 1))
+
+    def find_rules_page(self, chat_id: int, anchor: ObjectId, backward: bool, limit: int) -> list:
+        query = {"chat_id": chat_id}
+        if anchor is not None:
+            query["_id"] = {"$lt" if backward else "$gt": anchor}
+        order = -1 if backward else 1
+        return list(recurring_collection.find(query, RULE_LIST_PROJECTION).sort("_id", order).limit(limit))
+
+    def find_schedule_rules(self, partitions, updated_since: datetime = None):
+        if updated_since is None:
+            query = {"next_fire": {"$ne": None}, **partition_filter(partitions)}
+        else:
+            query = {"updated_at": {"$gte": updated_since}, **partition_filter(partitions)}
+        return recurring_collection.find(query, RULE_SCHEDULE_PROJECTION)
+
+    def claim_rule_reminders(self, claims: dict) -> set:
+        # Как и в claim_reminders, выигравшие обновления определяются по метке захвата
+        claim_id = ObjectId()
+        requests = [
+            UpdateOne({"_id": rule_id, "reminded_until": previous},
+                      {"$set": {"reminded_until": reminded_until, "next_fire": next_fire, "reminder_claim": claim_id}})
+            for rule_id, (previous, reminded_until, next_fire) in claims.items()
+        ]
+        recurring_collection.bulk_write(requests, ordered=False)
+        claimed = recurring_collection.find({"_id": {"$in": list(claims)}, "reminder_claim": claim_id}, {"_id": 1})
+        return {rule["_id"] for rule in claimed}
+
+    def delete_rules(self, chat_id: int, rule_id: ObjectId = None) -> list:
+        query = {"chat_id": chat_id} if rule_id is None else {"_id": rule_id, "chat_id": chat_id}
+        ids = [rule["_id"] for rule in recurring_collection.find(query, {"_id": 1})]
+        if ids:
+            recurring_collection.delete_many({"_id": {"$in": ids}})
+            occurrence_states_collection.delete_many({"rule_id": {"$in": ids}})
+        return ids
+
+    def find_occurrence_states(self, keys: list) -> dict:
+        if not keys:
+            return {}
+        return {state["_id"]: state["status"] for state in
+                occurrence_states_collection.find({"_id": {"$in": list(keys)}}, {"status": 1})}
+
+    def toggle_occurrence(self, rule_id: ObjectId, chat_id: int, key: str, occurrence: datetime):
+        if recurring_collection.count_documents({"_id": rule_id, "chat_id": chat_id}, limit=1) == 0:
+            return None
+        if occurrence_states_collection.delete_one({"_id": key}).deleted_count:
+            return "не выполнено"
+        occurrence_states_collection.update_one(
+            {"_id": key},
+            {"$set": {"rule_id": rule_id, "chat_id": chat_id, "occurrence": occurrence, "status": "выполнено"}},
+            upsert=True,
+        )
+        return "выполнено"
+
+    def enqueue_reminders(self, items: list):
+        try:
+            reminder_outbox_collection.insert_many(items, ordered=False)
+        except BulkWriteError as e:
+            # Сообщение с тем же ключом уже в outbox — это не ошибка
+            if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+    def claim_outbox(self, limit: int, now: datetime, lease_until: datetime) -> list:
+        ready = {"status": {"$in": ["pending", "sending"]}, "next_attempt": {"$lte": now}}
+        ids = [item["_id"] for item in
+               reminder_outbox_collection.find(ready, {"_id": 1}).sort("next_attempt", 1).limit(limit)]
+        if not ids:
+            return []
+        claim_id = ObjectId()
+        reminder_outbox_collection.update_many(
+            {"_id": {"$in": ids}, **ready},
+            {"$set": {"status": "sending", "claim": claim_id, "next_attempt": lease_until}},
+        )
+        return list(reminder_outbox_collection.find({"claim": claim_id}))
+
+    def update_outbox_item(self, item: dict, fields: dict):
+        reminder_outbox_collection.update_one({"_id": item["_id"], "claim": item["claim"]}, {"$set": fields})
+
+    def purge_outbox(self, before: datetime) -> int:
+        # Outbox чистит сама MongoDB по TTL-индексу retention
+        return 0
+
+
+def sql_time(value: datetime):
+    """datetime в текст для SQLite: с точностью до миллисекунд, как BSON; время с поясом — в UTC без пояса."""
+    if value is None:
+        return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(sep=" ", timespec="milliseconds")
+
+
+def parse_sql_time(value: str):
+    return None if value is None else datetime.fromisoformat(value)
+
+
+# Колонки флагов напоминаний в SQLite
+REMINDER_COLUMNS = {"day": "rem_day", "hour": "rem_hour", "on_time": "rem_on_time"}
+SQLITE_TASK_COLUMNS = ("id", "chat_id", "text", "deadline", "status", "date_created", "rem_day", "rem_hour",
+                       "rem_on_time", "updated_at", "completed_at")
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_chat_date ON entries (chat_id, date, id);
+CREATE INDEX IF NOT EXISTS entries_chat ON entries (chat_id, id);
+
+CREATE TABLE IF NOT EXISTS tasks (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    deadline TEXT NOT NULL,
+    status TEXT NOT NULL,
+    date_created TEXT NOT NULL,
+    rem_day INTEGER NOT NULL DEFAULT 0,
+    rem_hour INTEGER NOT NULL DEFAULT 0,
+    rem_on_time INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    completed_at TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_chat_date_created_deadline ON tasks (chat_id, date_created, deadline, id);
+CREATE INDEX IF NOT EXISTS tasks_chat_deadline ON tasks (chat_id, deadline, id);
+CREATE INDEX IF NOT EXISTS tasks_chat_status_deadline ON tasks (chat_id, status, deadline, id);
+CREATE INDEX IF NOT EXISTS tasks_pending_reminders ON tasks (deadline) WHERE rem_on_time = 0;
+CREATE INDEX IF NOT EXISTS tasks_updated_at ON tasks (updated_at);
+CREATE INDEX IF NOT EXISTS tasks_done_updated_at ON tasks (updated_at) WHERE status = 'выполнено';
+CREATE INDEX IF NOT EXISTS tasks_fired_deadline ON tasks (deadline) WHERE rem_on_time = 1;
+
+CREATE TABLE IF NOT EXISTS tasks_archive (
+    seq INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    deadline TEXT NOT NULL,
+    status TEXT NOT NULL,
+    date_created TEXT NOT NULL,
+    rem_day INTEGER NOT NULL DEFAULT 0,
+    rem_hour INTEGER NOT NULL DEFAULT 0,
+    rem_on_time INTEGER NOT NULL DEFAULT 0,
+    updated_at TEXT,
+    completed_at TEXT,
+    archived_at TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_archive_chat_date_created_deadline
+    ON tasks_archive (chat_id, date_created, deadline, id);
+CREATE INDEX IF NOT EXISTS tasks_archive_chat_deadline ON tasks_archive (chat_id, deadline, id);
+CREATE INDEX IF NOT EXISTS tasks_archive_purge ON tasks_archive (archived_at);
+
+-- Поиск: FTS5 с chat_id отдельной колонкой-токеном, чтобы совпадения отбирались в пределах чата по индексу
+CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5 (chat, text);
+CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5 (chat, text);
+CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+    INSERT INTO tasks_fts (rowid, chat, text) VALUES (new.seq, 'c' || replace(new.chat_id, '-', 'n'), new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+    DELETE FROM tasks_fts WHERE rowid = old.seq;
+END;
+CREATE TRIGGER IF NOT EXISTS tasks_fts_update AFTER UPDATE OF text ON tasks BEGIN
+    UPDATE tasks_fts SET text = new.text WHERE rowid = old.seq;
+END;
+CREATE TRIGGER IF NOT EXISTS entries_fts_insert AFTER INSERT ON entries BEGIN
+    INSERT INTO entries_fts (rowid, chat, text) VALUES (new.seq, 'c' || replace(new.chat_id, '-', 'n'), new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_fts_delete AFTER DELETE ON entries BEGIN
+    DELETE FROM entries_fts WHERE rowid = old.seq;
+END;
+
+CREATE TABLE IF NOT EXISTS recurring_tasks (
+    id TEXT PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    cron TEXT NOT NULL,
+    start TEXT NOT NULL,
+    date_created TEXT NOT NULL,
+    reminded_until TEXT NOT NULL,
+    next_fire TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS recurring_tasks_chat ON recurring_tasks (chat_id, id);
+CREATE INDEX IF NOT EXISTS recurring_tasks_updated_at ON recurring_tasks (updated_at);
+
+CREATE TABLE IF NOT EXISTS occurrence_states (
+    id TEXT PRIMARY KEY,
+    rule_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    occurrence TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS occurrence_states_rule ON occurrence_states (rule_id);
+
+-- Счётчики статистики: строка на поле документа chat_stats ("total", "weeks.2024-W05.created", ...)
+CREATE TABLE IF NOT EXISTS chat_stats (
+    chat_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (chat_id, field)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS reminder_outbox (
+    id TEXT PRIMARY KEY,
+    task_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    kinds TEXT NOT NULL,
+    text TEXT NOT NULL,
+    due_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    next_attempt TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    claim TEXT,
+    error TEXT,
+    finished_at TEXT
+);
+CREATE INDEX IF NOT EXISTS reminder_outbox_ready ON reminder_outbox (status, next_attempt);
+CREATE INDEX IF NOT EXISTS reminder_outbox_claim ON reminder_outbox (claim);
+CREATE INDEX IF NOT EXISTS reminder_outbox_retention ON reminder_outbox (finished_at);
+"""
+SQLITE_RULE_COLUMNS = ("id", "chat_id", "text", "cron", "start", "date_created", "reminded_until", "next_fire",
+                       "updated_at")
+SQLITE_OUTBOX_COLUMNS = ("id", "task_id", "chat_id", "kinds", "text", "due_at", "status", "attempts", "next_attempt",
+                         "created_at")
+
+
+class SqliteRepository(Repository):
+    """Встроенная база SQLite в файле ``path`` (режим WAL): без сервера и сетевых задержек.
+
+    Каждый поток пула run_db держит своё соединение; изменения из нескольких запросов
+    выполняются в одной транзакции. Поиск — FTS5 без стемминга: слова запроса ищутся как префиксы.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=DB_CALL_TIMEOUT, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _table(archived: bool) -> str:
+        return "tasks_archive" if archived else "tasks"
+
+    @staticmethod
+    def _partition_sql(partitions) -> tuple:
+        # Остаток в SQLite, как и $mod в MongoDB, отрицателен для отрицательных chat_id
+        if not partitions or len(partitions) == REMINDER_PARTITIONS:
+            return "1", []
+        placeholders = ", ".join("?" * len(partitions))
+        return (f"((chat_id % {REMINDER_PARTITIONS}) + {REMINDER_PARTITIONS}) % {REMINDER_PARTITIONS} "
+                f"IN ({placeholders})", sorted(partitions))
+
+    @staticmethod
+    def _task_where(filters: dict) -> tuple:
+        where, params = [], []
+        if filters.get("ids") is not None:
+            ids = [str(task_id) for task_id in filters["ids"]]
+            where.append(f"id IN ({', '.join('?' * len(ids))})" if ids else "0")
+            params += ids
+        for field in ("chat_id", "date_created", "status"):
+            if filters.get(field) is not None:
+                where.append(f"{field} = ?")
+                params.append(filters[field])
+        if filters.get("status_ne") is not None:
+            where.append("status != ?")
+            params.append(filters["status_ne"])
+        for name, op in (("deadline_from", ">="), ("deadline_before", "<")):
+            if filters.get(name) is not None:
+                where.append(f"deadline {op} ?")
+                params.append(sql_time(filters[name]))
+        if filters.get("deadlines") is not None:
+            deadlines = [sql_time(deadline_dt) for deadline_dt in filters["deadlines"]]
+            where.append(f"deadline IN ({', '.join('?' * len(deadlines))})" if deadlines else "0")
+            params += deadlines
+        if filters.get("pending_reminders"):
+            where.append("rem_on_time = 0")
+        return " AND ".join(where) or "1", params
+
+    @staticmethod
+    def _task_values(fields: dict) -> dict:
+        """Поля документа задачи -> значения колонок."""
+        values = {}
+        for field, value in fields.items():
+            if field == "_id":
+                values["id"] = str(value)
+            elif field == "reminders":
+                for kind, column in REMINDER_COLUMNS.items():
+                    values[column] = int(bool(value.get(kind)))
+            elif field.startswith("reminders."):
+                values[REMINDER_COLUMNS[field.split(".", 1)[1]]] = int(bool(value))
+            elif isinstance(value, datetime):
+                values[field] = sql_time(value)
+            else:
+                values[field] = value
+        return values
+
+    @staticmethod
+    def _task(row) -> dict:
+        task = {
+            "_id": ObjectId(row["id"]),
+            "chat_id": row["chat_id"],
+            "text": row["text"],
+            "deadline": parse_sql_time(row["deadline"]),
+            "status": row["status"],
+            "date_created": row["date_created"],
+            "reminders": {kind: bool(row[column]) for kind, column in REMINDER_COLUMNS.items()},
+            "updated_at": parse_sql_time(row["updated_at"]),
+        }
+        if row["completed_at"] is not None:
+            task["completed_at"] = parse_sql_time(row["completed_at"])
+        return task
+
+    @staticmethod
+    def _entry(row) -> dict:
+        return {"_id": ObjectId(row["id"]), "chat_id": row["chat_id"], "date": row["date"], "text": row["text"]}
+
+    def ensure_schema(self):
+        self._conn().executescript(SQLITE_SCHEMA)
+
+    def add_entries(self, entries: list):
+        for entry in entries:
+            entry.setdefault("_id", ObjectId())
+        with self._transaction() as conn:
+            conn.executemany("INSERT INTO entries (id, chat_id, date, text) VALUES (?, ?, ?, ?)",
+                             [(str(entry["_id"]), entry["chat_id"], entry["date"], entry["text"])
+                              for entry in entries])
+
+    def find_entries(self, chat_id: int, dates: list) -> list:
+        dates = list(dates)
+        rows = self._conn().execute(
+            f"SELECT * FROM entries WHERE chat_id = ? AND date IN ({', '.join('?' * len(dates))}) ORDER BY id",
+            [chat_id, *dates],
+        )
+        return [self._entry(row) for row in rows]
+
+    def find_entries_page(self, chat_id: int, anchor: ObjectId, backward: bool, limit: int) -> list:
+        where, params = "chat_id = ?", [chat_id]
+        if anchor is not None:
+            where += f" AND id {'<' if backward else '>'} ?"
+            params.append(str(anchor))
+        order = "DESC" if backward else "ASC"
+        rows = self._conn().execute(f"SELECT * FROM entries WHERE {where} ORDER BY id {order} LIMIT ?",
+                                    [*params, limit])
+        return [self._entry(row) for row in rows]
+
+    def iter_entries(self, chat_id: int):
+        for row in self._conn().execute("SELECT * FROM entries WHERE chat_id = ? ORDER BY id", (chat_id,)):
+            yield self._entry(row)
+
+    def delete_entries(self, chat_id: int) -> int:
+        return self._conn().execute("DELETE FROM entries WHERE chat_id = ?", (chat_id,)).rowcount
+
+    def add_tasks(self, tasks: list):
+        for task in tasks:
+            task.setdefault("_id", ObjectId())
+        rows = []
+        for task in tasks:
+            values = self._task_values({"reminders": {}, **task})
+            rows.append([values.get(column) for column in SQLITE_TASK_COLUMNS])
+        columns = ", ".join(SQLITE_TASK_COLUMNS)
+        with self._transaction() as conn:
+            conn.executemany(f"INSERT INTO tasks ({columns}) VALUES ({', '.join('?' * len(SQLITE_TASK_COLUMNS))})",
+                             rows)
+
+    def find_tasks(self, archived: bool = False, **filters) -> list:
+        where, params = self._task_where(filters)
+        rows = self._conn().execute(f"SELECT * FROM {self._table(archived)} WHERE {where}", params)
+        return [self._task(row) for row in rows]
+
+    def find_tasks_page(self, anchor: tuple, backward: bool, limit: int, archived: bool = False, **filters) -> list:
+        where, params = self._task_where(filters)
+        if anchor is not None:
+            deadline_dt, task_id = anchor
+            where += f" AND (deadline, id) {'<' if backward else '>'} (?, ?)"
+            params += [sql_time(deadline_dt), str(task_id)]
+        order = "DESC" if backward else "ASC"
+        rows = self._conn().execute(
+            f"SELECT * FROM {self._table(archived)} WHERE {where} ORDER BY deadline {order}, id {order} LIMIT ?",
+            [*params, limit],
+        )
+        return [self._task(row) for row in rows]
+
+    def iter_tasks(self, chat_id: int):
+        for table in ("tasks", "tasks_archive"):
+            for row in self._conn().execute(f"SELECT * FROM {table} WHERE chat_id = ? ORDER BY id", (chat_id,)):
+                yield self._task(row)
+
+    def find_schedule_tasks(self, partitions, updated_since: datetime = None):
+        where, params = self._partition_sql(partitions)
+        if updated_since is None:
+            where += " AND rem_on_time = 0"
+        else:
+            where += " AND updated_at >= ?"
+            params = [*params, sql_time(updated_since)]
+        return [self._task(row) for row in self._conn().execute(f"SELECT * FROM tasks WHERE {where}", params)]
+
+    def update_task(self, task_id: ObjectId, fields: dict, unset: tuple = ()):
+        values = {**self._task_values(fields), **{field: None for field in unset}}
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT * FROM tasks WHERE id = ?", (str(task_id),)).fetchone()
+            if row is None:
+                return None
+            conn.execute(f"UPDATE tasks SET {assignments} WHERE id = ?", [*values.values(), str(task_id)])
+        return self._task(row)
+
+    def set_completed_at(self, task_id: ObjectId, status: str, completed_at: datetime):
+        self._conn().execute("UPDATE tasks SET completed_at = ? WHERE id = ? AND status = ? AND completed_at IS NULL",
+                             (sql_time(completed_at), str(task_id), status))
+
+    def update_tasks(self, fields: dict, unset: tuple = (), **filters) -> int:
+        values = {**self._task_values(fields), **{field: None for field in unset}}
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        where, params = self._task_where(filters)
+        return self._conn().execute(f"UPDATE tasks SET {assignments} WHERE {where}",
+                                    [*values.values(), *params]).rowcount
+
+    def shift_deadlines(self, changes: list) -> int:
+        modified = 0
+        with self._transaction() as conn:
+            for task, fields in changes:
+                values = self._task_values(fields)
+                assignments = ", ".join(f"{column} = ?" for column in values)
+                modified += conn.execute(f"UPDATE tasks SET {assignments} WHERE id = ? AND deadline = ?",
+                                         [*values.values(), str(task["_id"]), sql_time(task["deadline"])]).rowcount
+        return modified
+
+    def delete_tasks(self, archived: bool = False, **filters) -> int:
+        where, params = self._task_where(filters)
+        return self._conn().execute(f"DELETE FROM {self._table(archived)} WHERE {where}", params).rowcount
+
+    def claim_reminders(self, transitions: dict) -> set:
+        # Условие «флаг ещё не выставлен» и rowcount внутри одной транзакции заменяют метку захвата
+        claimed = set()
+        with self._transaction() as conn:
+            for task_id, changed in transitions.items():
+                columns = list(self._task_values(changed))
+                assignments = ", ".join(f"{column} = 1" for column in columns)
+                unset = " AND ".join(f"{column} = 0" for column in columns)
+                if conn.execute(f"UPDATE tasks SET {assignments} WHERE id = ? AND {unset}",
+                                (str(task_id),)).rowcount:
+                    claimed.add(task_id)
+        return claimed
+
+    def month_counts(self, chat_id: int, first: date, end: date) -> dict:
+        days = (chat_id, first.isoformat(), end.isoformat())
+        rows = self._conn().execute(
+            "SELECT day, SUM(tasks) AS tasks, SUM(entries) AS entries FROM ("
+            " SELECT date_created AS day, COUNT(*) AS tasks, 0 AS entries FROM tasks"
+            " WHERE chat_id = ? AND date_created >= ? AND date_created < ? GROUP BY date_created"
+            " UNION ALL"
+            " SELECT date_created, COUNT(*), 0 FROM tasks_archive"
+            " WHERE chat_id = ? AND date_created >= ? AND date_created < ? GROUP BY date_created"
+            " UNION ALL"
+            " SELECT date, 0, COUNT(*) FROM entries WHERE chat_id = ? AND date >= ? AND date < ? GROUP BY date"
+            ") GROUP BY day",
+            days * 3,
+        )
+        return {row["day"]: (row["tasks"], row["entries"]) for row in rows}
+
+    def search(self, chat_id: int, query: str, top: int) -> tuple:
+        words = re.findall(r"\w+", query.lower())
+        if not words:
+            return [], []
+        # Любое из слов запроса, как и $text в MongoDB; вес колонки chat в bm25 нулевой
+        terms = " OR ".join(f'"{word}"*' for word in words)
+        match = f"chat : c{str(chat_id).replace('-', 'n')} AND text : ({terms})"
+        results = []
+        for table, convert in (("tasks", self._task), ("entries", self._entry)):
+            rows = self._conn().execute(
+                f"SELECT {table}.*, -bm25({table}_fts, 0.0, 1.0) AS score FROM {table}_fts"
+                f" JOIN {table} ON {table}.seq = {table}_fts.rowid"
+                f" WHERE {table}_fts MATCH ? ORDER BY score DESC LIMIT ?",
+                (match, top),
+            )
+            results.append([{**convert(row), "score": row["score"]} for row in rows])
+        return tuple(results)
+
+    def archive_batch(self, now: datetime, partitions, batch_size: int) -> tuple:
+        # Копирование и удаление идут в одной транзакции, поэтому задачи не меняются во время переноса
+        done_before, fired_before = archive_thresholds(now)
+        partition_sql, params = self._partition_sql(partitions)
+        columns = ", ".join(SQLITE_TASK_COLUMNS)
+        with self._transaction() as conn:
+            rows = conn.execute(
+                "SELECT * FROM tasks WHERE ((status = 'выполнено' AND updated_at < ?)"
+                f" OR (rem_on_time = 1 AND deadline < ?)) AND {partition_sql} LIMIT ?",
+                [sql_time(done_before), sql_time(fired_before), *params, batch_size],
+            ).fetchall()
+            if rows:
+                seqs = [row["seq"] for row in rows]
+                placeholders = ", ".join("?" * len(seqs))
+                conn.execute(f"INSERT OR REPLACE INTO tasks_archive ({columns}, archived_at)"
+                             f" SELECT {columns}, ? FROM tasks WHERE seq IN ({placeholders})",
+                             [sql_time(datetime.now(timezone.utc)), *seqs])
+                conn.execute(f"DELETE FROM tasks WHERE seq IN ({placeholders})", seqs)
+        return [self._task(row) for row in rows], set()
+
+    def purge_archive(self, before: datetime) -> int:
+        return self._conn().execute("DELETE FROM tasks_archive WHERE archived_at < ?", (sql_time(before),)).rowcount
+
+    def chat_stats(self, partitions=None) -> dict:
+        partition_sql, params = self._partition_sql(partitions)
+        stats = {}
+        conn = self._conn()
+        for table in ("tasks", "tasks_archive"):
+            totals = conn.execute(
+                "SELECT chat_id, COUNT(*) AS total, SUM(status = 'выполнено') AS completed,"
+                " SUM(status != 'выполнено' AND rem_on_time = 1) AS overdue"
+                f" FROM {table} WHERE {partition_sql} GROUP BY chat_id",
+                params,
+            )
+            for row in totals:
+                counters = chat_stats_doc(stats, row["chat_id"])
+                for field in ("total", "completed", "overdue"):
+                    counters[field] += row[field]
+            created = conn.execute(f"SELECT chat_id, date_created, COUNT(*) AS n FROM {table}"
+                                   f" WHERE {partition_sql} GROUP BY chat_id, date_created", params)
+            for row in created:
+                add_week_stats(stats, row["chat_id"], row["date_created"], "created", row["n"])
+            completed = conn.execute(
+                "SELECT chat_id, substr(completed_at, 1, 10) AS day, COUNT(*) AS n,"
+                " SUM(completed_at <= deadline) AS on_time"
+                f" FROM {table} WHERE status = 'выполнено' AND completed_at IS NOT NULL AND {partition_sql}"
+                " GROUP BY chat_id, day",
+                params,
+            )
+            for row in completed:
+                add_completed_stats(stats, row["chat_id"], row["day"], row["n"], row["on_time"])
+        return stats
+
+    @staticmethod
+    def _stats_rows(doc: dict) -> list:
+        """Документ chat_stats -> строки (chat_id, поле, значение)."""
+        rows = []
+        for field, value in doc.items():
+            if field == "weeks":
+                rows += [(doc["chat_id"], f"weeks.{week}.{name}", count)
+                         for week, counters in value.items() for name, count in counters.items()]
+            elif field not in ("_id", "chat_id", "rebuilt_at"):
+                rows.append((doc["chat_id"], field, value))
+        return rows
+
+    def inc_chat_stats(self, deltas: dict):
+        rows = [(chat_id, field, value) for chat_id, counters in deltas.items() for field, value in counters.items()]
+        with self._transaction() as conn:
+            conn.executemany("INSERT INTO chat_stats (chat_id, field, value) VALUES (?, ?, ?)"
+                             " ON CONFLICT (chat_id, field) DO UPDATE SET value = value + excluded.value", rows)
+
+    def find_chat_stats(self, chat_id: int):
+        rows = self._conn().execute("SELECT field, value FROM chat_stats WHERE chat_id = ?", (chat_id,)).fetchall()
+        if not rows:
+            return None
+        stats = {"_id": chat_id, "chat_id": chat_id}
+        for row in rows:
+            *path, name = row["field"].split(".")
+            counters = stats
+            for key in path:
+                counters = counters.setdefault(key, {})
+            counters[name] = row["value"]
+        return stats
+
+    def replace_chat_stats(self, docs: list, partitions=None):
+        partition_sql, params = self._partition_sql(partitions)
+        with self._transaction() as conn:
+            conn.execute(f"DELETE FROM chat_stats WHERE {partition_sql}", params)
+            conn.executemany("INSERT INTO chat_stats (chat_id, field, value) VALUES (?, ?, ?)",
+                             [row for doc in docs for row in self._stats_rows(doc)])
+
+    def delete_chat_stats(self, chat_id: int):
+        self._conn().execute("DELETE FROM chat_stats WHERE chat_id = ?", (chat_id,))
+
+    @staticmethod
+    def _rule(row) -> dict:
+        return {
+            "_id": ObjectId(row["id"]),
+            "chat_id": row["chat_id"],
+            "text": row["text"],
+            "cron": row["cron"],
+            "start": parse_sql_time(row["start"]),
+            "date_created": row["date_created"],
+            "reminded_until": parse_sql_time(row["reminded_until"]),
+            "next_fire": parse_sql_time(row["next_fire"]),
+            "updated_at": parse_sql_time(row["updated_at"]),
+        }
+
+    def add_rule(self, rule: dict):
+        rule.setdefault("_id", ObjectId())
+        values = {**rule, "id": str(rule["_id"])}
+        row = [sql_time(value) if isinstance(value, datetime) else value
+               for value in (values.get(column) for column in SQLITE_RULE_COLUMNS)]
+        self._conn().execute(f"INSERT INTO recurring_tasks ({', '.join(SQLITE_RULE_COLUMNS)})"
+                             f" VALUES ({', '.join('?' * len(SQLITE_RULE_COLUMNS))})", row)
+
+    def find_rules(self, chat_id: int = None, ids: list = None) -> list:
+        if ids is not None:
+            ids = [str(rule_id) for rule_id in ids]
+            where, params = (f"id IN ({', '.join('?' * len(ids))})" if ids else "0"), ids
+        else:
+            where, params = "chat_id = ?", [chat_id]
+        rows = self._conn().execute(f"SELECT * FROM recurring_tasks WHERE {where} ORDER BY id", params)
+        return [self._rule(row) for row in rows]
+
+    def find_rules_page(self, chat_id: int, anchor: ObjectId, backward: bool, limit: int) -> list:
+        where, params = "chat_id = ?", [chat_id]
+        if anchor is not None:
+            where += f" AND id {'<' if backward else '>'} ?"
+            params.append(str(anchor))
+        order = "DESC" if backward else "ASC"
+        rows = self._conn().execute(f"SELECT * FROM recurring_tasks WHERE {where} ORDER BY id {order} LIMIT ?",
+                                    [*params, limit])
+        return [self._rule(row) for row in rows]
+
+    def find_schedule_rules(self, partitions, updated_since: datetime = None):
+        where, params = self._partition_sql(partitions)
+        if updated_since is None:
+            where += " AND next_fire IS NOT NULL"
+        else:
+            where += " AND updated_at >= ?"
+            params = [*params, sql_time(updated_since)]
+        return [self._rule(row) for row in self._conn().execute(f"SELECT * FROM recurring_tasks WHERE {where}", params)]
+
+    def claim_rule_reminders(self, claims: dict) -> set:
+        claimed = set()
+        with self._transaction() as conn:
+            for rule_id, (previous, reminded_until, next_fire) in claims.items():
+                if conn.execute("UPDATE recurring_tasks SET reminded_until = ?, next_fire = ?"
+                                " WHERE id = ? AND reminded_until = ?",
+                                (sql_time(reminded_until), sql_time(next_fire), str(rule_id),
+                                 sql_time(previous))).rowcount:
+                    claimed.add(rule_id)
+        return claimed
+
+    def delete_rules(self, chat_id: int, rule_id: ObjectId = None) -> list:
+        where, params = "chat_id = ?", [chat_id]
+        if rule_id is not None:
+            where += " AND id = ?"
+            params.append(str(rule_id))
+        with self._transaction() as conn:
+            ids = [row["id"] for row in conn.execute(f"SELECT id FROM recurring_tasks WHERE {where}", params)]
+            conn.execute(f"DELETE FROM recurring_tasks WHERE {where}", params)
+            conn.executemany("DELETE FROM occurrence_states WHERE rule_id = ?", [(rule,) for rule in ids])
+        return [ObjectId(rule) for rule in ids]
+
+    def find_occurrence_states(self, keys: list) -> dict:
+        keys = list(keys)
+        if not keys:
+            return {}
+        placeholders = ", ".join("?" * len(keys))
+        rows = self._conn().execute(f"SELECT id, status FROM occurrence_states WHERE id IN ({placeholders})", keys)
+        return {row["id"]: row["status"] for row in rows}
+
+    def toggle_occurrence(self, rule_id: ObjectId, chat_id: int, key: str, occurrence: datetime):
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM recurring_tasks WHERE id = ? AND chat_id = ?",
+                            (str(rule_id), chat_id)).fetchone() is None:
+                return None
+            if conn.execute("DELETE FROM occurrence_states WHERE id = ?", (key,)).rowcount:
+                return "не выполнено"
+            conn.execute("INSERT INTO occurrence_states (id, rule_id, chat_id, occurrence, status)"
+                         " VALUES (?, ?, ?, ?, 'выполнено')", (key, str(rule_id), chat_id, sql_time(occurrence)))
+        return "выполнено"
+
+    @staticmethod
+    def _outbox_item(row) -> dict:
+        task_id = row["task_id"]
+        return {
+            "_id": row["id"],
+            # У вхождений повторяющихся задач ключ вместо ObjectId
+            "task_id": ObjectId(task_id) if ObjectId.is_valid(task_id) else task_id,
+            "chat_id": row["chat_id"],
+            "kinds": json.loads(row["kinds"]),
+            "text": row["text"],
+            "due_at": parse_sql_time(row["due_at"]),
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "next_attempt": parse_sql_time(row["next_attempt"]),
+            "created_at": parse_sql_time(row["created_at"]),
+            "claim": row["claim"],
+            "error": row["error"],
+            "finished_at": parse_sql_time(row["finished_at"]),
+        }
+
+    def enqueue_reminders(self, items: list):
+        rows = []
+        for item in items:
+            values = {**item, "id": item["_id"], "task_id": str(item["task_id"]), "kinds": json.dumps(item["kinds"])}
+            rows.append([sql_time(value) if isinstance(value, datetime) else value
+                         for value in (values.get(column) for column in SQLITE_OUTBOX_COLUMNS)])
+        with self._transaction() as conn:
+            conn.executemany(f"INSERT OR IGNORE INTO reminder_outbox ({', '.join(SQLITE_OUTBOX_COLUMNS)})"
+                             f" VALUES ({', '.join('?' * len(SQLITE_OUTBOX_COLUMNS))})", rows)
+
+    def claim_outbox(self, limit: int, now: datetime, lease_until: datetime) -> list:
+        claim_id = str(ObjectId())
+        with self._transaction() as conn:
+            ids = [row["id"] for row in conn.execute(
+                "SELECT id FROM reminder_outbox WHERE status IN ('pending', 'sending') AND next_attempt <= ?"
+                " ORDER BY next_attempt LIMIT ?", (sql_time(now), limit))]
+            if not ids:
+                return []
+            conn.execute(f"UPDATE reminder_outbox SET status = 'sending', claim = ?, next_attempt = ?"
+                         f" WHERE id IN ({', '.join('?' * len(ids))})", [claim_id, sql_time(lease_until), *ids])
+            rows = conn.execute("SELECT * FROM reminder_outbox WHERE claim = ?", (claim_id,)).fetchall()
+        return [self._outbox_item(row) for row in rows]
+
+    def update_outbox_item(self, item: dict, fields: dict):
+        values = {field: sql_time(value) if isinstance(value, datetime) else value for field, value in fields.items()}
+        assignments = ", ".join(f"{column} = ?" for column in values)
+        self._conn().execute(f"UPDATE reminder_outbox SET {assignments} WHERE id = ? AND claim = ?",
+                             [*values.values(), item["_id"], item["claim"]])
+
+    def purge_outbox(self, before: datetime) -> int:
+        return self._conn().execute("DELETE FROM reminder_outbox WHERE finished_at < ?", (sql_time(before),)).rowcount
+
+
+def create_repository() -> Repository:
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteRepository(SQLITE_PATH)
+    if STORAGE_BACKEND != "mongo":
+        raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={STORAGE_BACKEND!r}: ожидается mongo или sqlite")
+    return MongoRepository()
+
+
+repository = create_repository()
+
+
+# --------------- Функции работы с данными ---------------
+def add_entry(date_str: str, text: str, chat_id: int):
+    repository.add_entries([{"date": date_str, "text": text, "chat_id": chat_id}])
+    query_cache.invalidate(chat_id)
+
+
+def get_entries(date_str: str, chat_id: int):
+    return query_cache.get_or_load(chat_id, ("entries_by_date", date_str),
+                                   lambda: repository.find_entries(chat_id, [date_str]))
+
+
+def add_task(text: str, deadline: datetime, chat_id: int, status: str = "не выполнено", date_created: str = None):
+    if date_created is None:
+        date_created = date.today().isoformat()
+    task = {
+        "text": text,
+        "deadline": deadline,  # BSON datetime (локальное время)
+        "status": status,
+        "date_created": date_created,
+        "chat_id": chat_id,
+        "reminders": {"day": False, "hour": False, "on_time": False},
+        "updated_at": datetime.now(timezone.utc),
+    }
+    repository.add_tasks([task])
+    query_cache.invalidate(chat_id)
+    schedule_task_reminders(task)
+    deltas = {}
+    count_task_stats(deltas, task)
+    apply_stats_deltas(deltas)
+
+
+def get_tasks_page(anchor: tuple = None, backward: bool = False, limit: int = PAGE_SIZE, archived: bool = False,
+                   **filters):
+    """Страница задач, отсортированных по (deadline, _id), начиная после ключа ``anchor``.
+
+    Каждая страница — один ограниченный запрос по индексу, без skip. Возвращает
+    список задач и признак того, что в направлении листания есть ещё задачи.
+    ``filters`` — фильтры задач repository, ``archived`` — листать архив.
+    """
+    tasks = repository.find_tasks_page(anchor, backward, limit + 1, archived=archived, **filters)
+    has_more = len(tasks) > limit
+    tasks = tasks[:limit]
+    if backward:
+        tasks.reverse()
+    return tasks, has_more
+
+
+def get_entries_page(chat_id: int, anchor: ObjectId = None, backward: bool = False, limit: int = PAGE_SIZE):
+    """Страница записей чата по возрастанию _id; устроена так же, как get_tasks_page."""
+    return query_cache.get_or_load(chat_id, ("entries_page", anchor, backward, limit),
+                                   lambda: _load_entries_page(chat_id, anchor, backward, limit))
+
+
+def _load_entries_page(chat_id: int, anchor: ObjectId, backward: bool, limit: int):
+    entries = repository.find_entries_page(chat_id, anchor, backward, limit + 1)
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    if backward:
+        entries.reverse()
+    return entries, has_more
+
+
+def get_tasks_by_date(date_str: str, chat_id: int, anchor: tuple = None, backward: bool = False):
+    return query_cache.get_or_load(chat_id, ("tasks_by_date", date_str, anchor, backward),
+                                   lambda: get_tasks_page(anchor, backward, chat_id=chat_id, date_created=date_str))
+
+
+def get_tasks_by_chat(chat_id: int, pending_only: bool = False, anchor: tuple = None, backward: bool = False):
+    status = "не выполнено" if pending_only else None
+    return query_cache.get_or_load(chat_id, ("tasks_by_chat", pending_only, anchor, backward),
+                                   lambda: get_tasks_page(anchor, backward, chat_id=chat_id, status=status))
+
+
+def get_tasks_by_deadline(chat_id: int, start: datetime, end: datetime, anchor: tuple = None,
+                          backward: bool = False):
+    """Задачи чата с дедлайном в [start, end) — один диапазонный запрос по индексу chat_deadline."""
+    return query_cache.get_or_load(chat_id, ("tasks_by_deadline", start, end, anchor, backward),
+                                   lambda: get_tasks_page(anchor, backward, chat_id=chat_id,
+                                                          deadline_from=start, deadline_before=end))
+
+
+def get_overdue_tasks(chat_id: int, now: datetime, anchor: tuple = None, backward: bool = False):
+    """Невыполненные задачи чата с прошедшим дедлайном — по индексу chat_status_deadline.
+
+    Граница округляется до минуты, чтобы страницы одной минуты брались из кэша.
+    """
+    now = now.replace(second=0, microsecond=0)
+    return query_cache.get_or_load(chat_id, ("overdue_tasks", now, anchor, backward),
+                                   lambda: get_tasks_page(anchor, backward, chat_id=chat_id,
+                                                          status="не выполнено", deadline_before=now))
+
+
+def get_month_counts(chat_id: int, year: int, month: int) -> dict:
+    """Число задач (включая архивные) и записей по дням месяца: {"ГГГГ-ММ-ДД": (задачи, записи)}.
+
+    Весь месяц считается одним запросом к хранилищу. Результат кэшируется на чат и месяц.
+    """
+    first = date(year, month, 1)
+    end = first + timedelta(days=calendar.monthrange(year, month)[1])
+    return query_cache.get_or_load(chat_id, ("month_counts", year, month),
+                                   lambda: repository.month_counts(chat_id, first, end))
+
+
+# Сколько лучших совпадений можно пролистать
+SEARCH_MAX_RESULTS = 100
+
+
+def search_items(chat_id: int, query: str, offset: int = 0, limit: int = PAGE_SIZE):
+    """Записи и задачи чата, совпавшие с запросом, по убыванию релевантности.
+
+    Из каждой коллекции читается не больше offset + limit + 1 лучших совпадений —
+    этого достаточно для слияния двух списков. Возвращает пары (вид, документ),
+    где вид — "e" (запись) или "t" (задача), и признак следующей страницы.
+    """
+    top = offset + limit + 1
+    tasks, entries = repository.search(chat_id, query, top)
+    ranked = heapq.merge(
+        (("t", task) for task in tasks),
+        (("e", entry) for entry in entries),
+        key=lambda item: item[1]["score"],
+        reverse=True,
+    )
+    items = list(itertools.islice(ranked, offset, top))
+    return items[:limit], len(items) > limit
+
+
+def update_task(task_id: str, new_text: str = None, new_status: str = None, new_deadline: datetime = None):
+    update_fields = {}
+    if new_text is not None:
+        update_fields["text"] = new_text
+    if new_status is not None:
+        update_fields["status"] = new_status
+    if new_deadline is not None:
+        # Новый дедлайн — напоминания отправляются заново
+        update_fields["deadline"] = new_deadline
+        update_fields["reminders"] = {"day": False, "hour": False, "on_time": False}
+    if not update_fields:
+        return
+    update_fields["updated_at"] = datetime.now(timezone.utc)
+    unset = ("completed_at",) if new_status is not None and new_status != "выполнено" else ()
+    # Возвращается документ до изменения — по нему считается изменение статистики
+    task = repository.update_task(ObjectId(task_id), update_fields, unset)
+    if task is None:
+        return
+    updated = {**task, **update_fields}
+    if unset:
+        updated.pop("completed_at", None)
+    elif new_status is not None and "completed_at" not in task:
+        # Время выполнения ставится только при переходе в «выполнено» (локальное, как и дедлайн)
+        updated["completed_at"] = datetime.now().replace(microsecond=0)
+        repository.set_completed_at(task["_id"], new_status, updated["completed_at"])
+    query_cache.invalidate(task.get("chat_id"))
+    if new_deadline is not None:
+        schedule_task_reminders(updated)
+    deltas = {}
+    count_task_stats(deltas, task, -1)
+    count_task_stats(deltas, updated)
+    apply_stats_deltas(deltas)
+
+
+def get_archived_tasks(chat_id: int, date_str: str = None, anchor: tuple = None, backward: bool = False):
+    return query_cache.get_or_load(chat_id, ("archived_tasks", date_str, anchor, backward),
+                                   lambda: get_tasks_page(anchor, backward, archived=True, chat_id=chat_id,
+                                                          date_created=date_str))
+
+
+def delete_tasks_by_date(date_str: str, chat_id: int):
+    deltas = {}
+    for task in repository.find_tasks(chat_id=chat_id, date_created=date_str):
+        reminder_scheduler.unschedule(task["_id"])
+        count_task_stats(deltas, task, -1)
+    for task in repository.find_tasks(archived=True, chat_id=chat_id, date_created=date_str):
+        count_task_stats(deltas, task, -1)
+    repository.delete_tasks(chat_id=chat_id, date_created=date_str)
+    repository.delete_tasks(archived=True, chat_id=chat_id, date_created=date_str)
+    query_cache.invalidate(chat_id)
+    apply_stats_deltas(deltas)
+
+
+def delete_all_tasks(chat_id: int) -> int:
+    for task in repository.find_tasks(chat_id=chat_id, pending_reminders=True):
+        reminder_scheduler.unschedule(task["_id"])
+    deleted = repository.delete_tasks(chat_id=chat_id)
+    repository.delete_tasks(archived=True, chat_id=chat_id)
+    for rule_id in repository.delete_rules(chat_id):
+        reminder_scheduler.unschedule(rule_id)
+    repository.delete_chat_stats(chat_id)
+    query_cache.invalidate(chat_id)
+    return deleted
+
 
+def delete_all_entries(chat_id: int) -> int:
+    deleted = repository.delete_entries(chat_id)
+    query_cache.invalidate(chat_id)
+    return deleted
 
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
-)
-logger = logging.getLogger(__name__)
 
-# Подключение к MongoDB
-client = MongoClient("mongodb://localhost:27017/")
-db = client["task_planner"]
-entries_collection = db["entries"]
-tasks_collection = db["tasks"]
+def parse_task_ids(task_ids: list) -> list:
+    return [ObjectId(task_id) for task_id in task_ids if ObjectId.is_valid(task_id)]
 
 
-# Функция для формирования главного меню (клавиатура)
-def get_main_keyboard():
-    keyboard = [
-        ["Добавить запись", "Просмотреть записи"],
-        ["Добавить задачу", "Просмотреть задачи"],
-        ["Обновить задачу", "Удалить задачи за дату"],
-        ["Просмотреть все данные"],
-        ["Удалить все записи", "Удалить все задачи"],
-        ["Отмена"],
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+def set_tasks_status(task_ids: list, chat_id: int, new_status: str) -> int:
+    """Меняет статус выбранных задач чата одним запросом; возвращает число изменённых задач.
+
+    Задачи с таким статусом уже не трогаются, поэтому completed_at ставится только при переходе
+    в «выполнено». Предыдущие значения читаются одним запросом — для счётчиков статистики.
+    """
+    selection = {"ids": parse_task_ids(task_ids), "chat_id": chat_id, "status_ne": new_status}
+    tasks = repository.find_tasks(**selection)
+    if not tasks:
+        return 0
+    fields = {"status": new_status, "updated_at": datetime.now(timezone.utc)}
+    unset = ()
+    if new_status == "выполнено":
+        # Локальное время, как и у дедлайна
+        fields["completed_at"] = datetime.now().replace(microsecond=0)
+    else:
+        unset = ("completed_at",)
+    modified = repository.update_tasks(fields, unset, **selection)
+    query_cache.invalidate(chat_id)
+    deltas = {}
+    for task in tasks:
+        updated = {**task, **fields}
+        if unset:
+            updated.pop("completed_at", None)
+        count_task_stats(deltas, task, -1)
+        count_task_stats(deltas, updated)
+    apply_stats_deltas(deltas)
+    return modified
 
 
-# --------------- Функции работы с данными ---------------
-def add_entry(date_str: str, text: str):
-    entry = {"date": date_str, "text": text}
-    entries_collection.insert_one(entry)
+def delete_tasks(task_ids: list, chat_id: int) -> int:
+    """Удаляет выбранные задачи чата одним запросом."""
+    selection = {"ids": parse_task_ids(task_ids), "chat_id": chat_id}
+    deltas = {}
+    for task in repository.find_tasks(**selection):
+        reminder_scheduler.unschedule(task["_id"])
+        count_task_stats(deltas, task, -1)
+    deleted = repository.delete_tasks(**selection)
+    query_cache.invalidate(chat_id)
+    apply_stats_deltas(deltas)
+    return deleted
+
+
+def postpone_tasks(task_ids: list, chat_id: int, delta: timedelta) -> int:
+    """Сдвигает дедлайны выбранных задач чата на ``delta``.
+
+    Условие на прежний дедлайн не даёт сдвинуть задачу дважды, если её одновременно
+    изменили. Напоминания отправляются заново.
+    """
+    tasks = repository.find_tasks(ids=parse_task_ids(task_ids), chat_id=chat_id)
+    updated_at = datetime.now(timezone.utc)
+    changes = []
+    for task in tasks:
+        try:
+            deadline_dt = parse_deadline(task["deadline"])
+        except Exception:
+            continue
+        changes.append((task, {"deadline": deadline_dt + delta,
+                               "reminders": {"day": False, "hour": False, "on_time": False},
+                               "updated_at": updated_at}))
+    if not changes:
+        return 0
+    modified = repository.shift_deadlines(changes)
+    query_cache.invalidate(chat_id)
+    deltas = {}
+    for task, fields in changes:
+        updated = {**task, **fields}
+        schedule_task_reminders(updated)
+        count_task_stats(deltas, task, -1)
+        count_task_stats(deltas, updated)
+    apply_stats_deltas(deltas)
+    return modified
 
 
-def get_entries(date_str: str):
-    return list(entries_collection.find({"date": date_str}))
+def get_pending_tasks_by_ids(task_ids: list):
+    # Задачи, у которых все напоминания уже отправлены, в выборку не попадают
+    return repository.find_tasks(ids=task_ids, pending_reminders=True)
 
 
-def add_task(text: str, deadline: str, chat_id: int, status: str = "не выполнено", date_created: str = None):
-    if date_created is None:
-        date_created = date.today().isoformat()
-    task = {
+def claim_reminder_transitions(transitions: dict):
+    """Атомарно помечает напоминания отправленными и возвращает _id задач, которые удалось пометить.
+
+    Условие «флаг ещё не выставлен» гарантирует, что при нескольких экземплярах бота
+    каждое напоминание забирает ровно один из них.
+    """
+    return repository.claim_reminders(transitions)
+
+
+# --------------- Повторяющиеся задачи ---------------
+# Повторяющаяся задача хранится одним документом-правилом с cron-выражением
+# «минуты часы число месяц день_недели» (день недели 0 или 7 — воскресенье).
+# Вхождения не сохраняются: они вычисляются для показываемого окна и ближайшего
+# напоминания. В occurrence_states попадают только вхождения с изменённым статусом,
+# а о напоминаниях правило хранит одну отметку reminded_until.
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+# Насколько далеко ищется следующее вхождение (правило вроде «30 февраля» не срабатывает никогда)
+CRON_SEARCH_DAYS = 5 * 366
+# Пропущенные (например, во время простоя) напоминания старше этого срока не отправляются
+RECURRING_CATCHUP = timedelta(days=1)
+RULE_LIST_PROJECTION = {"text": 1, "cron": 1, "start": 1}
+
+
+class CronRule:
+    """Разобранное cron-выражение: *, числа, списки, диапазоны и шаги."""
+
+    def __init__(self, expr: str):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError("cron-выражение должно состоять из 5 полей")
+        fields = [self._parse_field(part, low, high) for part, (low, high) in zip(parts, CRON_FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = fields
+        self.weekdays = {day % 7 for day in weekdays}
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+        self.expr = " ".join(parts)
+
+    @staticmethod
+    def _parse_field(spec: str, low: int, high: int) -> list:
+        values = set()
+        for part in spec.split(","):
+            part, _, step = part.partition("/")
+            step = int(step) if step else 1
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (int(value) for value in part.split("-", 1))
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            if step < 1 or start < low or end > high or start > end:
+                raise ValueError(f"недопустимое значение поля: {spec}")
+            values.update(range(start, end + 1, step))
+        return sorted(values)
+
+    def matches_day(self, day: date) -> bool:
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self._any_day:
+            return in_weekdays
+        if self._any_weekday:
+            return in_days
+        # Как в cron: если заданы и число, и день недели, достаточно совпадения одного из них
+        return in_days or in_weekdays
+
+    def next_after(self, after: datetime):
+        """Ближайшее вхождение строго после ``after`` или None."""
+        day = after.date()
+        for _ in range(CRON_SEARCH_DAYS):
+            if self.matches_day(day):
+                for hour in self.hours:
+                    for minute in self.minutes:
+                        candidate = datetime(day.year, day.month, day.day, hour, minute)
+                        if candidate > after:
+                            return candidate
+            day += timedelta(days=1)
+        return None
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_cron(expr: str) -> CronRule:
+    return CronRule(expr)
+
+
+def rule_occurrences(rule: dict, after: datetime, until: datetime = None):
+    """Вхождения правила строго после ``after`` (и до ``until``), лениво, по одному."""
+    cron = parse_cron(rule["cron"])
+    current = max(after, rule["start"] - timedelta(seconds=1))
+    while True:
+        current = cron.next_after(current)
+        if current is None or (until is not None and current >= until):
+            return
+        yield current
+
+
+def rule_next_fire(rule: dict, since: datetime):
+    """Ближайшее напоминание правила после ``since``: минимум по видам напоминаний."""
+    fires = []
+    for kind, offset in REMINDER_OFFSETS:
+        occurrence = next(rule_occurrences(rule, since + offset), None)
+        if occurrence is not None:
+            fires.append(occurrence - offset)
+    return min(fires, default=None)
+
+
+def evaluate_rule_reminders(rule: dict, now: datetime):
+    """Наступившие с прошлой проверки напоминания правила.
+
+    Если их несколько (например, после простоя), остаётся только самое позднее
+    вхождение — его напоминания объединяются в одно сообщение. Возвращает
+    (вхождение, виды напоминаний) или (None, []).
+    """
+    since = max(rule["reminded_until"], now - RECURRING_CATCHUP)
+    due = {}
+    for kind, offset in REMINDER_OFFSETS:
+        for occurrence in rule_occurrences(rule, since + offset):
+            if occurrence - offset > now:
+                break
+            # Напоминания «за день» и «за час» для уже наступивших вхождений не нужны
+            if kind == "on_time" or occurrence > now:
+                due.setdefault(occurrence, []).append(kind)
+    if not due:
+        return None, []
+    occurrence = max(due)
+    return occurrence, due[occurrence]
+
+
+def occurrence_key(rule_id, occurrence: datetime) -> str:
+    return f"{rule_id}@{(occurrence - EPOCH) // timedelta(milliseconds=1)}"
+
+
+def occurrence_task(rule: dict, occurrence: datetime) -> dict:
+    """Вхождение в виде задачи — для текста напоминания и ключа outbox."""
+    return {"_id": occurrence_key(rule["_id"], occurrence), "chat_id": rule["chat_id"], "text": rule["text"],
+            "deadline": occurrence, "updated_at": rule.get("updated_at")}
+
+
+def schedule_rule_reminders(rule: dict):
+    if not partition_coordinator.owns(rule.get("chat_id")):
+        reminder_scheduler.unschedule(rule["_id"])
+        return
+    reminder_scheduler.schedule(rule["_id"], rule.get("next_fire"))
+
+
+def add_recurring_task(text: str, cron: str, start: datetime, chat_id: int) -> dict:
+    now = datetime.now()
+    rule = {
         "text": text,
-        "deadline": deadline,  # ISO-формат
-        "status": status,
-        "date_created": date_created,
+        "cron": parse_cron(cron).expr,
+        "start": start,
         "chat_id": chat_id,
-        "reminders": {"day": False, "hour": False, "on_time": False},
+        "date_created": date.today().isoformat(),
+        "reminded_until": now,
+        "updated_at": datetime.now(timezone.utc),
     }
-    tasks_collection.insert_one(task)
+    rule["next_fire"] = rule_next_fire(rule, now)
+    repository.add_rule(rule)
+    query_cache.invalidate(chat_id)
+    schedule_rule_reminders(rule)
+    return rule
 
 
-def get_tasks_by_date(date_str: str, chat_id: int):
-    return list(tasks_collection.find({"date_created": date_str, "chat_id": chat_id}))
+def get_recurring_rules(chat_id: int) -> list:
+    return query_cache.get_or_load(chat_id, ("recurring_rules",), lambda: repository.find_rules(chat_id))
 
 
-def get_tasks_by_chat(chat_id: int):
-    return list(tasks_collection.find({"chat_id": chat_id}))
+def get_recurring_page(chat_id: int, anchor: ObjectId = None, backward: bool = False, limit: int = PAGE_SIZE):
+    """Страница правил чата по возрастанию _id; устроена так же, как get_entries_page."""
+    return query_cache.get_or_load(chat_id, ("recurring_page", anchor, backward, limit),
+                                   lambda: _load_recurring_page(chat_id, anchor, backward, limit))
 
 
-def update_task(task_id: str, new_text: str = None, new_status: str = None):
-    update_fields = {}
-    if new_text is not None:
-        update_fields["text"] = new_text
-    if new_status is not None:
-        update_fields["status"] = new_status
-    if update_fields:
-        tasks_collection.update_one({"_id": ObjectId(task_id)}, {"$set": update_fields})
+def _load_recurring_page(chat_id: int, anchor: ObjectId, backward: bool, limit: int):
+    rules = repository.find_rules_page(chat_id, anchor, backward, limit + 1)
+    has_more = len(rules) > limit
+    rules = rules[:limit]
+    if backward:
+        rules.reverse()
+    return rules, has_more
 
 
-def delete_tasks_by_date(date_str: str, chat_id: int):
-    tasks_collection.delete_many({"date_created": date_str, "chat_id": chat_id})
+def get_occurrences(chat_id: int, start: datetime, end: datetime, limit: int = PAGE_SIZE) -> list:
+    """Вхождения правил чата в окне [start, end) со статусами, не больше ``limit``, по времени."""
+    occurrences = []
+    for rule in get_recurring_rules(chat_id):
+        for occurrence in itertools.islice(rule_occurrences(rule, start - timedelta(seconds=1), end), limit):
+            occurrences.append({"rule_id": rule["_id"], "text": rule["text"], "deadline": occurrence})
+    occurrences = sorted(occurrences, key=lambda item: item["deadline"])[:limit]
+    keys = [occurrence_key(item["rule_id"], item["deadline"]) for item in occurrences]
+    statuses = repository.find_occurrence_states(keys)
+    for key, item in zip(keys, occurrences):
+        item["status"] = statuses.get(key, "не выполнено")
+    return occurrences
+
+
+def toggle_occurrence_status(rule_id: ObjectId, occurrence: datetime, chat_id: int):
+    """Переключает статус вхождения; возвращает новый статус или None, если правила нет.
+
+    Состояние хранится только у выполненных вхождений, поэтому «не выполнено» — это удаление.
+    """
+    return repository.toggle_occurrence(rule_id, chat_id, occurrence_key(rule_id, occurrence), occurrence)
+
+
+def delete_recurring_task(rule_id: ObjectId, chat_id: int) -> bool:
+    if not repository.delete_rules(chat_id, rule_id):
+        return False
+    reminder_scheduler.unschedule(rule_id)
+    query_cache.invalidate(chat_id)
+    return True
 
 
-def delete_all_tasks():
-    return tasks_collection.delete_many({})
+def get_rules_by_ids(rule_ids: list) -> list:
+    return repository.find_rules(ids=rule_ids)
 
 
-def delete_all_entries():
-    return entries_collection.delete_many({})
+def get_done_occurrences(keys: list) -> set:
+    return {key for key, status in repository.find_occurrence_states(keys).items() if status == "выполнено"}
+
+
+def claim_rule_reminders(claims: dict) -> set:
+    """Сдвигает отметку reminded_until правил; как и claim_reminder_transitions, условие
+    (отметка не изменилась) гарантирует, что напоминание забирает ровно один экземпляр."""
+    return repository.claim_rule_reminders(claims)
+
+
+def reschedule_claimed(next_fires: dict, claimed: set):
+    """Ставит в расписание следующее напоминание задач (правил), отметку которых удалось выставить.
+
+    Остальные изменены другим экземпляром или пользователем — их напоминания перечитываются
+    через SWEEP_RETRY_DELAY.
+    """
+    retry_at = datetime.now() + SWEEP_RETRY_DELAY
+    for item_id, next_fire in next_fires.items():
+        reminder_scheduler.schedule(item_id, next_fire if item_id in claimed else retry_at)
+
+
+async def sweep_due_rules(rule_ids: list, now: datetime):
+    rules = await run_db(get_rules_by_ids, rule_ids)
+    if not rules:
+        return
+    claims = {}
+    next_fires = {}
+    due = {}
+    for rule in rules:
+        occurrence, kinds = evaluate_rule_reminders(rule, now)
+        next_fires[rule["_id"]] = rule_next_fire(rule, now)
+        claims[rule["_id"]] = (rule["reminded_until"], now, next_fires[rule["_id"]])
+        if occurrence is not None:
+            due[rule["_id"]] = occurrence_task(rule, occurrence), kinds
+    if due:
+        # Отмеченные выполненными вхождения не напоминаем
+        done = await run_db(get_done_occurrences, [task["_id"] for task, _ in due.values()])
+        items = [build_outbox_item(task, kinds) for task, kinds in due.values() if task["_id"] not in done]
+        # Сначала outbox, затем отметка в правиле и новое время в расписании — см. sweep_due_batch
+        await run_db(enqueue_reminders, items)
+        reminder_sender.notify()
+    claimed = await run_db(claim_rule_reminders, claims)
+    reschedule_claimed(next_fires, claimed)
 
 
 # --------------- Фоновая задача: Проверка дедлайнов ---------------
-async def check_deadlines(bot):
+async def check_deadlines():
+    started = time.perf_counter()
+    try:
+        await sweep_due_reminders()
+    finally:
+        metrics.observe("bot_sweep_seconds", time.perf_counter() - started)
+
+
+async def sweep_due_reminders():
+    """Помечает наступившие напоминания и ставит их в outbox; сама отправка — в ReminderSender."""
     now = datetime.now()
-    tasks = list(tasks_collection.find())
+    due_ids = reminder_scheduler.pop_due(now)
+    for start in range(0, len(due_ids), SCHEDULER_BATCH_SIZE):
+        try:
+            await sweep_due_batch(due_ids[start:start + SCHEDULER_BATCH_SIZE], now)
+        except Exception:
+            # pop_due уже убрал идентификаторы из расписания, а sync_reminder_schedule и change stream
+            # не увидят их без изменений в данных: эта пачка и все следующие повторяются через SWEEP_RETRY_DELAY
+            retry_at = datetime.now() + SWEEP_RETRY_DELAY
+            for item_id in due_ids[start:]:
+                reminder_scheduler.schedule(item_id, retry_at)
+            raise
+
+
+async def sweep_due_batch(batch: list, now: datetime):
+    """Обрабатывает пачку наступивших задач и правил повторяющихся задач."""
+    tasks = await run_db(get_pending_tasks_by_ids, batch)
+    metrics.inc("bot_sweep_tasks_scanned_total", len(tasks))
+    # Остальные идентификаторы в расписании — правила повторяющихся задач (или уже неактуальные задачи)
+    found = {task["_id"] for task in tasks}
+    rule_ids = [item for item in batch if item not in found]
+    if rule_ids:
+        await sweep_due_rules(rule_ids, now)
+    # Пишем только реально изменившиеся флаги, одной пачкой на batch
+    transitions = {}
+    next_fires = {}
     for task in tasks:
-        chat_id = task.get("chat_id")
-        if not chat_id:
+        changed, next_fire = evaluate_task_reminders(task, now)
+        if changed:
+            transitions[task["_id"]] = changed
+            next_fires[task["_id"]] = next_fire
+        else:
+            reminder_scheduler.schedule(task["_id"], next_fire)
+    if not transitions:
+        return
+    # Сообщения пишутся в outbox до отметки флагов, а следующее напоминание ставится в расписание
+    # только после неё: если запись в outbox или отметка не удалась, флаги не выставлены и задача
+    # повторяется через SWEEP_RETRY_DELAY (после падения процесса — при загрузке расписания).
+    # Ключ сообщения не зависит от того, сколько напоминаний слилось в него, поэтому повторная
+    # или конкурирующая постановка не создаёт дубликат (см. build_outbox_item).
+    items = [build_outbox_item(task, [field.split(".", 1)[1] for field in transitions[task["_id"]]])
+             for task in tasks if task["_id"] in transitions]
+    await run_db(enqueue_reminders, items)
+    reminder_sender.notify()
+    claimed = await run_db(claim_reminder_transitions, transitions)
+    reschedule_claimed(next_fires, claimed)
+    # Невыполненные задачи с наступившим дедлайном становятся просроченными
+    deltas = {}
+    for task in tasks:
+        if task["_id"] in claimed and "reminders.on_time" in transitions[task["_id"]]:
+            count_task_stats(deltas, task, -1)
+            count_task_stats(deltas, {**task, "reminders": {**task.get("reminders", {}), "on_time": True}})
+    if any(any(counters.values()) for counters in deltas.values()):
+        await run_db(apply_stats_deltas, deltas)
+
+
+def reminder_due_time(task: dict, kind: str) -> datetime:
+    """Положенное время напоминания: смещение от дедлайна, но не раньше последнего изменения задачи
+    (напоминание «за день» у задачи, созданной за час до дедлайна, не считается опоздавшим на сутки)."""
+    due = parse_deadline(task["deadline"]) - dict(REMINDER_OFFSETS)[kind]
+    updated_at = task.get("updated_at")
+    if updated_at is not None:
+        # updated_at хранится в UTC, дедлайны — в локальном времени
+        updated_local = updated_at.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+        due = max(due, updated_local)
+    return due
+
+
+def evaluate_task_reminders(task: dict, now: datetime):
+    """Определяет наступившие напоминания задачи.
+
+    Возвращает изменённые флаги в виде полей для $set (в порядке REMINDER_OFFSETS)
+    и время следующего напоминания.
+    """
+    chat_id = task.get("chat_id")
+    if not chat_id:
+        return {}, None
+    try:
+        deadline_dt = parse_deadline(task["deadline"])
+    except Exception:
+        return {}, None
+    reminders = dict(task.get("reminders", {"day": False, "hour": False, "on_time": False}))
+    changed = {}
+    if not reminders.get("day") and (deadline_dt - now) <= timedelta(days=1) and deadline_dt > now:
+        reminders["day"] = True
+        changed["reminders.day"] = True
+    if not reminders.get("hour") and (deadline_dt - now) <= timedelta(hours=1) and deadline_dt > now:
+        reminders["hour"] = True
+        changed["reminders.hour"] = True
+    if not reminders.get("on_time") and now >= deadline_dt:
+        reminders["on_time"] = True
+        changed["reminders.on_time"] = True
+    return changed, next_reminder_time(deadline_dt, reminders)
+
+
+def format_reminder_text(task: dict, kind: str) -> str:
+    deadline_dt = parse_deadline(task["deadline"])
+    if kind == "on_time":
+        return (
+            f"🚨 <b>Внимание!</b>\n"
+            f"Сейчас наступил дедлайн задачи: <b>{task['text']}</b>.\n"
+            f"Проверьте выполнение задачи!"
+        )
+    left = "осталось <b>1 день</b>" if kind == "day" else "остался <b>1 час</b>"
+    return (
+        f"⏰ <b>Напоминание!</b>\n"
+        f"До дедлайна задачи <b>{task['text']}</b> {left}.\n"
+        f"📅 Дедлайн: {deadline_dt.strftime('%d.%m.%Y %H:%M')}"
+    )
+
+
+async def deadline_loop(app: Application):
+    # Расписание загружается в coordination_loop, как только получены аренды разделов
+    while True:
+        await reminder_scheduler.wait_until_due()
+        try:
+            await check_deadlines()
+        except Exception as e:
+            metrics.inc("bot_sweep_errors_total")
+            logger.error(f"Ошибка при проверке дедлайнов: {e}")
+
+
+# --------------- Доставка напоминаний ---------------
+# Сколько попыток отправки делается, прежде чем сообщение помечается failed
+OUTBOX_MAX_ATTEMPTS = 8
+# Задержка перед повтором: OUTBOX_BACKOFF_BASE * 2^(попытка - 1), но не больше OUTBOX_BACKOFF_MAX (с)
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 900
+# Через сколько захваченные, но не доставленные сообщения возвращаются в работу
+OUTBOX_LEASE = timedelta(minutes=2)
+# Как часто проверять outbox без явного сигнала (сообщения других экземпляров, повторы)
+OUTBOX_POLL_INTERVAL = 5
+# Сколько хранятся доставленные и отброшенные сообщения и как часто (с) удаляются устаревшие
+# (в MongoDB их удаляет TTL-индекс, в SQLite — отправитель в перерывах между пачками)
+OUTBOX_RETENTION = 7 * 24 * 3600
+OUTBOX_PURGE_INTERVAL = 3600
+
+
+def build_outbox_item(task: dict, kinds: list) -> dict:
+    """Сообщение outbox для одной задачи.
+
+    Несколько наступивших разом напоминаний (например, после простоя бота) сливаются
+    в одно сообщение с текстом самого срочного из них. Ключ идемпотентности — _id задачи,
+    её дедлайн и этот самый срочный вид. Повтор после неудачной отметки флагов даёт тот же ключ;
+    если к повтору наступил более срочный вид, новое сообщение — только о нём, и прежние
+    напоминания не приходят второй раз. После переноса дедлайна ключи тоже новые.
+    """
+    kind = kinds[-1]
+    deadline_dt = parse_deadline(task["deadline"])
+    now = datetime.now(timezone.utc)
+    return {
+        "_id": f"{task['_id']}:{deadline_dt:%Y%m%dT%H%M}:{kind}",
+        "task_id": task["_id"],
+        "chat_id": task["chat_id"],
+        "kinds": kinds,
+        "text": format_reminder_text(task, kind),
+        "due_at": reminder_due_time(task, kind),
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt": now,
+        "created_at": now,
+    }
+
+
+def enqueue_reminders(items: list):
+    if items:
+        repository.enqueue_reminders(items)
+
+
+def claim_outbox_batch(limit: int) -> list:
+    """Атомарно забирает готовые к отправке сообщения outbox.
+
+    Готовы ожидающие сообщения, время повтора которых наступило, и захваченные,
+    у которых истекла аренда (next_attempt захваченного сообщения — конец аренды).
+    """
+    now = datetime.now(timezone.utc)
+    return repository.claim_outbox(limit, now, now + OUTBOX_LEASE)
+
+
+def finish_outbox_item(item: dict, status: str, error: str = None):
+    # Условие на метку захвата: сообщение, перехваченное после истечения аренды, не трогаем
+    repository.update_outbox_item(item, {"status": status, "error": error, "finished_at": datetime.now(timezone.utc)})
+
+
+def retry_outbox_item(item: dict, error: str) -> bool:
+    """Планирует повтор отправки; возвращает False, если попытки исчерпаны."""
+    attempts = item.get("attempts", 0) + 1
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        finish_outbox_item(item, "failed", error)
+        return False
+    delay = min(OUTBOX_BACKOFF_BASE * 2 ** (attempts - 1), OUTBOX_BACKOFF_MAX)
+    repository.update_outbox_item(item, {"status": "pending", "attempts": attempts, "error": error,
+                                         "next_attempt": datetime.now(timezone.utc) + timedelta(seconds=delay)})
+    return True
+
+
+def purge_outbox() -> int:
+    return repository.purge_outbox(datetime.now(timezone.utc) - timedelta(seconds=OUTBOX_RETENTION))
+
+
+class ReminderSender:
+    """Пул асинхронных отправителей сообщений из outbox напоминаний (reminder_outbox).
+
+    Диспетчер забирает пачку готовых сообщений и раздаёт её воркерам через очередь;
+    следующая пачка забирается, когда предыдущая разобрана, поэтому аренда не
+    истекает у сообщений, ждущих в памяти. Темп отправки ограничивает SendQueue.
+    """
+
+    def __init__(self, workers: int = REMINDER_SENDER_WORKERS):
+        self._workers = workers
+        self._wakeup = None
+
+    def notify(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self, bot):
+        self._wakeup = asyncio.Event()
+        queue = asyncio.Queue()
+        workers = [asyncio.create_task(self._worker(bot, queue)) for _ in range(self._workers)]
+        purge_at = time.monotonic()
+        try:
+            while True:
+                self._wakeup.clear()
+                try:
+                    items = await run_db(claim_outbox_batch, self._workers * 4)
+                    if not items and time.monotonic() >= purge_at:
+                        purge_at = time.monotonic() + OUTBOX_PURGE_INTERVAL
+                        await run_db(purge_outbox)
+                except Exception as e:
+                    logger.error(f"Ошибка при чтении outbox напоминаний: {e}")
+                    items = []
+                if not items:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=OUTBOX_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                for item in items:
+                    queue.put_nowait(item)
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self, bot, queue: asyncio.Queue):
+        while True:
+            item = await queue.get()
+            try:
+                await self._deliver(bot, item)
+            except Exception as e:
+                # Например, хранилище недоступно: сообщение вернётся в работу по истечении аренды
+                logger.error(f"Ошибка при доставке напоминания {item['_id']}: {e}")
+            finally:
+                queue.task_done()
+
+    async def _deliver(self, bot, item: dict):
+        try:
+            await bot.send_message(chat_id=item["chat_id"], text=item["text"], parse_mode="HTML",
+                                   rate_limit_args=PRIORITY_REMINDER)
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован или чат недоступен — повтор не поможет
+            logger.warning(f"Напоминание {item['_id']} не доставлено: {e}")
+            metrics.inc("bot_reminder_deliveries_total", outcome="failed")
+            await run_db(finish_outbox_item, item, "failed", str(e))
+            return
+        except Exception as e:
+            retried = await run_db(retry_outbox_item, item, str(e))
+            metrics.inc("bot_reminder_deliveries_total", outcome="retry" if retried else "failed")
+            logger.warning(f"Напоминание {item['_id']} не отправлено (попытка {item.get('attempts', 0) + 1}): {e}")
+            return
+        await run_db(finish_outbox_item, item, "sent")
+        metrics.inc("bot_reminder_deliveries_total", outcome="sent")
+        lag = (datetime.now() - item["due_at"]).total_seconds()
+        metrics.observe("bot_reminder_lag_seconds", max(lag, 0.0), kind=item["kinds"][-1])
+
+
+reminder_sender = ReminderSender()
+
+
+# --------------- Архив задач ---------------
+ARCHIVE_BATCH_SIZE = 1000
+
+
+def archive_thresholds(now: datetime) -> tuple:
+    """Границы переноса в архив: выполненные задачи, изменённые раньше первой (UTC), и задачи
+    с отправленным напоминанием о наступлении дедлайна, дедлайн которых раньше второй (локальное время)."""
+    retention = timedelta(days=ARCHIVE_AFTER_DAYS)
+    return now.astimezone(timezone.utc) - retention, now.replace(tzinfo=None) - retention
+
+
+def archive_filter(now: datetime) -> dict:
+    """Задачи, которые пора перенести в архив: выполненные или с отправленным напоминанием
+    о наступлении дедлайна, если с момента выполнения (дедлайна) прошло ARCHIVE_AFTER_DAYS."""
+    done_before, fired_before = archive_thresholds(now)
+    return {"$or": [
+        {"status": "выполнено", "updated_at": {"$lt": done_before}},
+        {"reminders.on_time": True, "deadline": {"$lt": fired_before}},
+    ]}
+
+
+def archive_tasks(batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Переносит подходящие задачи своих разделов в архив пачками; возвращает число перенесённых.
+
+    Как переносится пачка, решает хранилище (repository.archive_batch). Задачи, изменённые
+    во время переноса (например, статус вернули в «не выполнено»), остаются рабочими.
+    При ARCHIVE_PURGE_DAYS старые задачи архива удаляются.
+    """
+    partitions = partition_coordinator.partitions
+    if not partitions:
+        return 0
+    if ARCHIVE_PURGE_DAYS:
+        repository.purge_archive(datetime.now(timezone.utc) - timedelta(days=ARCHIVE_PURGE_DAYS))
+    moved = 0
+    while True:
+        tasks, kept = repository.archive_batch(datetime.now().astimezone(), partitions, batch_size)
+        if not tasks:
+            return moved
+        for task in tasks:
+            if task["_id"] not in kept:
+                reminder_scheduler.unschedule(task["_id"])
+        for chat_id in {task.get("chat_id") for task in tasks}:
+            query_cache.invalidate(chat_id)
+        moved += len(tasks) - len(kept)
+        if len(tasks) < batch_size or len(kept) == len(tasks):
+            return moved
+
+
+def ensure_archive_purge_index():
+    """TTL-индекс архива по archived_at; при ARCHIVE_PURGE_DAYS=0 удаляется."""
+    if not ARCHIVE_PURGE_DAYS:
+        if "purge" in tasks_archive_collection.index_information():
+            tasks_archive_collection.drop_index("purge")
+        return
+    ttl = int(ARCHIVE_PURGE_DAYS * 24 * 3600)
+    try:
+        tasks_archive_collection.create_index([("archived_at", 1)], name="purge", expireAfterSeconds=ttl)
+    except OperationFailure:
+        # Индекс уже есть с другим сроком — меняем срок на месте
+        db.command("collMod", tasks_archive_collection.name, index={"name": "purge", "expireAfterSeconds": ttl})
+
+
+async def archive_loop():
+    while True:
+        try:
+            moved = await run_db(archive_tasks, timeout=None)
+            if moved:
+                logger.info(f"Перенесено в архив задач: {moved}")
+        except Exception as e:
+            logger.error(f"Ошибка при переносе задач в архив: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+# --------------- Статистика ---------------
+# У каждого чата один документ chat_stats со счётчиками задач. К ним прибавляют изменения
+# (repository.inc_chat_stats) добавление, изменение и удаление задач, импорт и наступление дедлайна, поэтому /stats
+# читает один документ независимо от числа задач. Архивные задачи тоже учитываются.
+# rebuild_chat_stats пересчитывает счётчики по всем задачам хранилища и исправляет накопившиеся расхождения.
+STATS_PROJECTION = {"chat_id": 1, "status": 1, "deadline": 1, "date_created": 1, "completed_at": 1,
+                    "reminders.on_time": 1}
+# Сколько последних недель показывает /stats
+STATS_WEEKS = 8
+STATS_BATCH_SIZE = 1000
+
+
+def week_key(day: date) -> str:
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+
+def count_task_stats(deltas: dict, task: dict, sign: int = 1):
+    """Добавляет в ``deltas`` (chat_id -> поля для $inc) вклад задачи в статистику со знаком ``sign``.
+
+    Правила подсчёта совпадают с rebuild_chat_stats: выполнена в срок — completed_at не позже
+    дедлайна; просрочена — не выполнена и напоминание о наступлении дедлайна уже отправлено.
+    """
+    counters = deltas.setdefault(task.get("chat_id"), {})
+
+    def add(field):
+        counters[field] = counters.get(field, 0) + sign
+
+    add("total")
+    try:
+        add(f"weeks.{week_key(date.fromisoformat(task['date_created']))}.created")
+    except (KeyError, TypeError, ValueError):
+        pass
+    if task.get("status") == "выполнено":
+        add("completed")
+        completed_at = task.get("completed_at")
+        if isinstance(completed_at, datetime):
+            add(f"weeks.{week_key(completed_at)}.completed")
+            deadline_dt = task.get("deadline")
+            add("completed_on_time" if isinstance(deadline_dt, datetime) and completed_at <= deadline_dt
+                else "completed_late")
+    elif (task.get("reminders") or {}).get("on_time"):
+        add("overdue")
+
+
+def apply_stats_deltas(deltas: dict):
+    """Все чаты — одним обращением к хранилищу; нулевые изменения пропускаются."""
+    changes = {}
+    for chat_id, counters in deltas.items():
+        counters = {field: value for field, value in counters.items() if value}
+        if chat_id is not None and counters:
+            changes[chat_id] = counters
+    if changes:
+        repository.inc_chat_stats(changes)
+
+
+def get_chat_stats(chat_id: int):
+    return repository.find_chat_stats(chat_id)
+
+
+def chat_stats_doc(stats: dict, chat_id) -> dict:
+    """Документ счётчиков чата в ``stats`` (chat_id -> документ chat_stats); создаётся нулевым."""
+    return stats.setdefault(chat_id, {"_id": chat_id, "chat_id": chat_id, "total": 0, "completed": 0, "overdue": 0,
+                                      "completed_on_time": 0, "completed_late": 0, "weeks": {}})
+
+
+def add_week_stats(stats: dict, chat_id, day: str, field: str, value: int):
+    """Прибавляет ``value`` к счётчику ``field`` недели, в которую попадает день ``day`` (ГГГГ-ММ-ДД)."""
+    try:
+        weeks = chat_stats_doc(stats, chat_id)["weeks"].setdefault(week_key(date.fromisoformat(day)), {})
+    except (TypeError, ValueError):
+        return
+    weeks[field] = weeks.get(field, 0) + value
+
+
+def add_completed_stats(stats: dict, chat_id, day: str, completed: int, on_time: int):
+    """Учитывает ``completed`` задач, выполненных в день ``day``, из них ``on_time`` — в срок."""
+    add_week_stats(stats, chat_id, day, "completed", completed)
+    counters = chat_stats_doc(stats, chat_id)
+    counters["completed_on_time"] += on_time
+    counters["completed_late"] += completed - on_time
+
+
+def rebuild_chat_stats(partitions=None) -> int:
+    """Пересчитывает chat_stats по рабочим и архивным задачам чатов разделов ``partitions`` (None — всех).
+
+    Счётчики считает хранилище (repository.chat_stats). Документы заменяются целиком;
+    документы чатов, у которых задач не осталось, удаляются. Изменения, сделанные во время
+    пересчёта, могут потеряться — их исправит следующий пересчёт. Возвращает число пересчитанных чатов.
+    """
+    stats = repository.chat_stats(partitions)
+    docs = [doc for doc in stats.values() if doc["_id"] is not None]
+    repository.replace_chat_stats(docs, partitions)
+    return len(docs)
+
+
+async def stats_rebuild_loop():
+    while True:
+        await asyncio.sleep(STATS_REBUILD_INTERVAL)
+        partitions = partition_coordinator.partitions
+        if not partitions:
             continue
         try:
-            deadline_dt = datetime.fromisoformat(task["deadline"])
+            chats = await run_db(rebuild_chat_stats, partitions, timeout=None)
+            logger.info(f"Статистика пересчитана для чатов: {chats}")
+        except Exception as e:
+            logger.error(f"Ошибка при пересчёте статистики: {e}")
+
+
+# --------------- Хранение состояния диалогов ---------------
+class MongoPersistence(BasePersistence):
+    """Хранит состояния диалогов и user_data в MongoDB с отложенной записью.
+
+    Изменения копятся в памяти и раз в PERSISTENCE_FLUSH_INTERVAL уходят одним
+    bulk_write на коллекцию, поэтому обработка сообщений не ждёт базу. Документы
+    компактные (короткие имена полей), неактивное состояние удаляется TTL-индексом
+    через STATE_IDLE_TTL, а из памяти — методом expire_idle.
+    """
+
+    def __init__(self, flush_interval: float = PERSISTENCE_FLUSH_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=flush_interval,
+        )
+        self._dirty_conversations = {}
+        self._dirty_user_data = {}
+        self._last_active = {}
+
+    @staticmethod
+    def _conversation_id(name: str, key: tuple) -> str:
+        return f"{name}:{':'.join(map(str, key))}"
+
+    async def get_conversations(self, name: str):
+        docs = await run_db(lambda: list(conversations_collection.find({"n": name}, {"k": 1, "s": 1})), timeout=None)
+        return {tuple(doc["k"]): doc["s"] for doc in docs}
+
+    async def update_conversation(self, name: str, key: tuple, new_state):
+        self._dirty_conversations[(name, key)] = new_state
+
+    async def get_user_data(self):
+        docs = await run_db(lambda: list(user_data_collection.find({}, {"d": 1})), timeout=None)
+        now = time.monotonic()
+        for doc in docs:
+            self._last_active[doc["_id"]] = now
+        return {doc["_id"]: doc.get("d", {}) for doc in docs}
+
+    async def update_user_data(self, user_id: int, data: dict):
+        # Копия: словарь продолжает меняться обработчиками до записи в базу
+        self._dirty_user_data[user_id] = dict(data)
+        self._last_active[user_id] = time.monotonic()
+
+    async def drop_user_data(self, user_id: int):
+        self._dirty_user_data[user_id] = None
+        self._last_active.pop(user_id, None)
+
+    async def refresh_user_data(self, user_id: int, user_data: dict):
+        self._last_active[user_id] = time.monotonic()
+
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id: int, data):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        user_data, self._dirty_user_data = self._dirty_user_data, {}
+        if not conversations and not user_data:
+            return
+        try:
+            await run_db(write_persistent_state, conversations, user_data)
         except Exception:
-            continue
-        reminders = task.get("reminders", {"day": False, "hour": False, "on_time": False})
-        if not reminders.get("day") and (deadline_dt - now) <= timedelta(days=1) and deadline_dt > now:
-            message = (
-                f"⏰ <b>Напоминание!</b>\n"
-                f"До дедлайна задачи <b>{task['text']}</b> осталось <b>1 день</b>.\n"
-                f"📅 Дедлайн: {deadline_dt.strftime('%d.%m.%Y %H:%M')}"
-            )
-            await bot.send_message(chat_id=chat_id, text=message, parse_mode="HTML")
-            reminders["day"] = True
-        if not reminders.get("hour") and (deadline_dt - now) <= timedelta(hours=1) and deadline_dt > now:
-            message = (
-                f"⏰ <b>Напоминание!</b>\n"
-                f"До дедлайна задачи <b>{task['text']}</b> остался <b>1 час</b>.\n"
-                f"📅 Дедлайн: {deadline_dt.strftime('%d.%m.%Y %H:%M')}"
-            )
-            await bot.send_message(chat_id=chat_id, text=message, parse_mode="HTML")
-            reminders["hour"] = True
-        if not reminders.get("on_time") and now >= deadline_dt:
-            message = (
-                f"🚨 <b>Внимание!</b>\n"
-                f"Сейчас наступил дедлайн задачи: <b>{task['text']}</b>.\n"
-                f"Проверьте выполнение задачи!"
-            )
-            await bot.send_message(chat_id=chat_id, text=message, parse_mode="HTML")
-            reminders["on_time"] = True
-        tasks_collection.update_one({"_id": task["_id"]}, {"$set": {"reminders": reminders}})
+            # Несохранённое возвращается в очередь записи; изменения, пришедшие за время записи, новее
+            for key, state in conversations.items():
+                self._dirty_conversations.setdefault(key, state)
+            for user_id, data in user_data.items():
+                self._dirty_user_data.setdefault(user_id, data)
+            raise
 
+    def expire_idle(self, app: Application):
+        """Убирает из памяти user_data пользователей, неактивных дольше STATE_IDLE_TTL."""
+        deadline = time.monotonic() - STATE_IDLE_TTL
+        for user_id, last_active in list(self._last_active.items()):
+            if last_active < deadline:
+                del self._last_active[user_id]
+                app.drop_user_data(user_id)
 
-async def deadline_loop(app: Application):
+
+def write_persistent_state(conversations: dict, user_data: dict):
+    now = datetime.now(timezone.utc)
+    requests = []
+    for (name, key), state in conversations.items():
+        doc_id = MongoPersistence._conversation_id(name, key)
+        if state is None:
+            requests.append(DeleteOne({"_id": doc_id}))
+        else:
+            requests.append(ReplaceOne({"_id": doc_id}, {"n": name, "k": list(key), "s": state, "t": now}, upsert=True))
+    if requests:
+        conversations_collection.bulk_write(requests, ordered=False)
+    requests = []
+    for user_id, data in user_data.items():
+        if not data:
+            requests.append(DeleteOne({"_id": user_id}))
+        else:
+            requests.append(ReplaceOne({"_id": user_id}, {"d": data, "t": now}, upsert=True))
+    if requests:
+        user_data_collection.bulk_write(requests, ordered=False)
+
+
+async def persistence_flush_loop(app: Application):
     while True:
-        await check_deadlines(app.bot)
-        await asyncio.sleep(60)
+        await asyncio.sleep(PERSISTENCE_FLUSH_INTERVAL)
+        try:
+            await app.persistence.flush()
+            app.persistence.expire_idle(app)
+        except Exception as e:
+            logger.error(f"Ошибка при сохранении состояния диалогов: {e}")
 
 
 # --------------- Команда /start и главное меню ---------------
@@ -178,7 +3595,7 @@ async def add_entry_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def add_entry_receive_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     today = date.today().isoformat()
-    add_entry(today, text)
+    await run_db(add_entry, today, text, update.message.chat.id)
     await update.message.reply_text("✅ Запись успешно добавлена!", parse_mode="HTML", reply_markup=get_main_keyboard())
     return ConversationHandler.END
 
@@ -189,6 +3606,9 @@ add_entry_conv = ConversationHandler(
         ADD_ENTRY_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_entry_receive_text)]
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="add_entry",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
 # --------------- Диалог: Просмотреть записи ---------------
@@ -196,14 +3616,18 @@ VIEW_ENTRIES_DATE = 0
 
 
 async def view_entries_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📅 Введите дату (в формате ГГГГ-ММ-ДД), для которой хотите посмотреть записи:",
+    await update.message.reply_text("📅 Введите дату (в формате ГГГГ-ММ-ДД, или «сегодня», «вчера»), "
+                                    "для которой хотите посмотреть записи:",
                                     parse_mode="HTML")
     return VIEW_ENTRIES_DATE
 
 
 async def view_entries_receive_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    date_str = update.message.text
-    entries = get_entries(date_str)
+    date_str = update.message.text.strip()
+    relative = {"сегодня": 0, "вчера": -1}
+    if date_str.lower() in relative:
+        date_str = (date.today() + timedelta(days=relative[date_str.lower()])).isoformat()
+    entries = await run_db(get_entries, date_str, update.message.chat.id)
     if not entries:
         response = "❌ <b>Записей за указанную дату не найдено.</b>"
     else:
@@ -218,6 +3642,9 @@ view_entries_conv = ConversationHandler(
         VIEW_ENTRIES_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_entries_receive_date)]
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="view_entries",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
 # --------------- Диалог: Добавить задачу с выбором даты через ввод года, выбор месяца и числа ---------------
@@ -252,17 +3679,15 @@ async def add_task_receive_year(update: Update, context: ContextTypes.DEFAULT_TY
     return ADD_TASK_MONTH
 
 
-def generate_month_keyboard():
-    months = [
-        ("Январь", 1), ("Февраль", 2), ("Март", 3),
-        ("Апрель", 4), ("Май", 5), ("Июнь", 6),
-        ("Июль", 7), ("Август", 8), ("Сентябрь", 9),
-        ("Октябрь", 10), ("Ноябрь", 11), ("Декабрь", 12)
-    ]
+MONTH_NAMES = ("Январь", "Февраль", "Март", "Апрель", "Май", "Июнь",
+               "Июль", "Август", "Сентябрь", "Октябрь", "Ноябрь", "Декабрь")
+
+
+def generate_month_keyboard(prefix: str = "month_"):
     buttons = []
     row = []
-    for i, (name, month_num) in enumerate(months, start=1):
-        row.append(InlineKeyboardButton(text=name, callback_data=f"month_{month_num}"))
+    for i, name in enumerate(MONTH_NAMES, start=1):
+        row.append(InlineKeyboardButton(text=name, callback_data=f"{prefix}{i}"))
         if i % 3 == 0:
             buttons.append(row)
             row = []
@@ -289,15 +3714,23 @@ async def add_task_month_selected(update: Update, context: ContextTypes.DEFAULT_
         return ADD_TASK_MONTH
 
 
-def generate_day_keyboard(num_days):
+def generate_day_keyboard(num_days, prefix: str = "day_", labels: dict = None, first_weekday: int = None):
+    """Кнопки чисел месяца по 7 в ряд.
+
+    ``labels`` — подписи вместо номеров дней; с ``first_weekday`` (день недели 1-го числа,
+    0 — понедельник) сетка выравнивается по неделям пустыми кнопками.
+    """
     buttons = []
-    row = []
+    row = [] if first_weekday is None else [calendar_blank_button() for _ in range(first_weekday)]
     for day in range(1, num_days + 1):
-        row.append(InlineKeyboardButton(text=str(day), callback_data=f"day_{day}"))
-        if day % 7 == 0:
+        text = labels.get(day, str(day)) if labels else str(day)
+        row.append(InlineKeyboardButton(text=text, callback_data=f"{prefix}{day}"))
+        if len(row) == 7:
             buttons.append(row)
             row = []
     if row:
+        if first_weekday is not None:
+            row.extend(calendar_blank_button() for _ in range(7 - len(row)))
         buttons.append(row)
     return InlineKeyboardMarkup(buttons)
 
@@ -336,67 +3769,307 @@ async def add_task_receive_time(update: Update, context: ContextTypes.DEFAULT_TY
     except Exception as e:
         await update.message.reply_text("❌ Ошибка формирования даты. Попробуйте снова.", parse_mode="HTML")
         return ConversationHandler.END
-    deadline_iso = deadline_dt.isoformat()
     task_text = context.user_data.get("task_text")
     chat_id = update.message.chat.id
-    add_task(task_text, deadline_iso, chat_id)
+    await run_db(add_task, task_text, deadline_dt, chat_id)
     await update.message.reply_text("✅ Задача успешно добавлена!", parse_mode="HTML", reply_markup=get_main_keyboard())
     return ConversationHandler.END
 
 
-add_task_conv = ConversationHandler(
-    entry_points=[MessageHandler(filters.Regex("^Добавить задачу$"), add_task_start)],
+add_task_conv = ConversationHandler(
+    entry_points=[MessageHandler(filters.Regex("^Добавить задачу$"), add_task_start)],
+    states={
+        ADD_TASK_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_task_receive_text)],
+        ADD_TASK_YEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_task_receive_year)],
+        ADD_TASK_MONTH: [CallbackQueryHandler(add_task_month_selected, pattern="^month_")],
+        ADD_TASK_DAY: [CallbackQueryHandler(add_task_day_selected, pattern="^day_")],
+        ADD_TASK_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_task_receive_time)],
+    },
+    fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="add_task",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
+)
+
+# --------------- Диалог: Добавить повторяющуюся задачу ---------------
+# Состояния: 0 - текст, 1 - периодичность, 2 - первое выполнение, 3 - своё правило cron
+RECURRING_TEXT, RECURRING_FREQ, RECURRING_START, RECURRING_CRON = range(4)
+RECURRING_FREQUENCIES = (
+    ("daily", "Каждый день"),
+    ("weekly", "Каждую неделю"),
+    ("monthly", "Каждый месяц"),
+    ("cron", "Своё правило (cron)"),
+)
+
+
+def frequency_cron(freq: str, start: datetime) -> str:
+    """cron-выражение для периодичности с первым выполнением в ``start``."""
+    if freq == "weekly":
+        return f"{start.minute} {start.hour} * * {(start.weekday() + 1) % 7}"
+    if freq == "monthly":
+        return f"{start.minute} {start.hour} {start.day} * *"
+    return f"{start.minute} {start.hour} * * *"
+
+
+async def add_recurring_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("📝 Введите текст повторяющейся задачи:", parse_mode="HTML")
+    return RECURRING_TEXT
+
+
+async def add_recurring_receive_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["recurring_text"] = update.message.text
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=f"rfreq_{freq}")]
+                                     for freq, label in RECURRING_FREQUENCIES])
+    await update.message.reply_text("🔁 Как часто повторять задачу?", reply_markup=keyboard, parse_mode="HTML")
+    return RECURRING_FREQ
+
+
+async def add_recurring_freq_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    freq = query.data.split("_", 1)[1]
+    context.user_data["recurring_freq"] = freq
+    if freq == "cron":
+        await query.edit_message_text(
+            "⚙️ Введите правило в формате cron: <code>минуты часы число месяц день_недели</code>.\n"
+            "Например, <code>0 9 * * 1-5</code> — по будням в 9:00.",
+            parse_mode="HTML",
+        )
+        return RECURRING_CRON
+    await query.edit_message_text("📅 Введите дату и время первого выполнения в формате "
+                                  "<code>ГГГГ-ММ-ДД ЧЧ:ММ</code> (например, 2025-01-31 18:00):", parse_mode="HTML")
+    return RECURRING_START
+
+
+async def save_recurring_task(update: Update, context: ContextTypes.DEFAULT_TYPE, cron: str, start: datetime):
+    text = context.user_data.get("recurring_text")
+    rule = await run_db(add_recurring_task, text, cron, start, update.message.chat.id)
+    first = next(rule_occurrences(rule, datetime.now()), None)
+    first_str = first.strftime("%d.%m.%Y %H:%M") if first else "—"
+    await update.message.reply_text(f"✅ Повторяющаяся задача добавлена!\n⏭ Ближайшее выполнение: {first_str}",
+                                    parse_mode="HTML", reply_markup=get_main_keyboard())
+    return ConversationHandler.END
+
+
+async def add_recurring_receive_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        start = datetime.strptime(update.message.text.strip(), "%Y-%m-%d %H:%M")
+    except ValueError:
+        await update.message.reply_text(
+            "❌ Неверный формат. Введите дату и время в формате <code>ГГГГ-ММ-ДД ЧЧ:ММ</code>:", parse_mode="HTML"
+        )
+        return RECURRING_START
+    cron = frequency_cron(context.user_data.get("recurring_freq"), start)
+    return await save_recurring_task(update, context, cron, start)
+
+
+async def add_recurring_receive_cron(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    expr = update.message.text.strip()
+    now = datetime.now().replace(second=0, microsecond=0)
+    try:
+        if parse_cron(expr).next_after(now) is None:
+            raise ValueError("правило никогда не срабатывает")
+    except ValueError as e:
+        await update.message.reply_text(f"❌ Неверное правило ({html.escape(str(e))}). Попробуйте снова:",
+                                        parse_mode="HTML")
+        return RECURRING_CRON
+    return await save_recurring_task(update, context, expr, now)
+
+
+add_recurring_conv = ConversationHandler(
+    entry_points=[MessageHandler(filters.Regex("^Добавить повторяющуюся задачу$"), add_recurring_start)],
     states={
-        ADD_TASK_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_task_receive_text)],
-        ADD_TASK_YEAR: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_task_receive_year)],
-        ADD_TASK_MONTH: [CallbackQueryHandler(add_task_month_selected, pattern="^month_")],
-        ADD_TASK_DAY: [CallbackQueryHandler(add_task_day_selected, pattern="^day_")],
-        ADD_TASK_TIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_task_receive_time)],
+        RECURRING_TEXT: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_recurring_receive_text)],
+        RECURRING_FREQ: [CallbackQueryHandler(add_recurring_freq_selected, pattern="^rfreq_")],
+        RECURRING_START: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_recurring_receive_start)],
+        RECURRING_CRON: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_recurring_receive_cron)],
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="add_recurring",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
+
+# --------------- Команда: Повторяющиеся задачи ---------------
+# Список листается страницами build_page (вид ``c``); кнопка удаления несёт страницу, на которой
+# она показана: rdel:<_id правила>:<n|p>:<ключ страницы>, чтобы после удаления остаться на ней
+NO_RECURRING_TEXT = "❌ <b>Повторяющихся задач нет.</b>"
+
+
+def format_rule_line(rule: dict, now: datetime) -> str:
+    upcoming = next(rule_occurrences(rule, now), None)
+    upcoming_str = upcoming.strftime("%d.%m.%Y %H:%M") if upcoming else "—"
+    return f"📝 {shorten(rule['text'])} | ⚙️ <code>{rule['cron']}</code> | ⏭ {upcoming_str}"
+
+
+async def recurring_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text, markup = await build_page("c", update.message.chat.id)
+    await update.message.reply_text(text or NO_RECURRING_TEXT, parse_mode="HTML", reply_markup=markup)
+
+
+async def recurring_delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat.id
+    _, rule_id, direction, anchor = query.data.split(":", 3)
+    await run_db(delete_recurring_task, ObjectId(rule_id), chat_id)
+    text, markup = await build_page("c", chat_id, anchor or None, backward=direction == "p")
+    if text is None and anchor:
+        # Удалено последнее правило страницы — показываем начало списка
+        text, markup = await build_page("c", chat_id)
+    await query.edit_message_text(text or NO_RECURRING_TEXT, parse_mode="HTML", reply_markup=markup)
+
+
+# --------------- Календарь ---------------
+# callback_data: cal:m<год>-<месяц> — сетка месяца, cal:y<год> — выбор месяца,
+# cal:d<год>-<месяц>-<число> — открыть день, cal:v<вид> — список задач по дедлайну (см. build_page),
+# cal:- — пустая клетка
+CALENDAR_BLANK = "cal:-"
+WEEKDAY_NAMES = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+
+def calendar_blank_button(text: str = " "):
+    return InlineKeyboardButton(text=text, callback_data=CALENDAR_BLANK)
+
+
+def shift_month(year: int, month: int, delta: int) -> tuple:
+    index = year * 12 + month - 1 + delta
+    return index // 12, index % 12 + 1
+
+
+async def build_calendar(chat_id: int, year: int, month: int):
+    """Сетка месяца; у дней с задачами или записями подписано их число («число задачи/записи»)."""
+    counts = await run_db(get_month_counts, chat_id, year, month)
+    first_weekday, num_days = calendar.monthrange(year, month)
+    labels = {}
+    for day in range(1, num_days + 1):
+        tasks, entries = counts.get(date(year, month, day).isoformat(), (0, 0))
+        if tasks or entries:
+            labels[day] = f"{day} {tasks}/{entries}"
+    grid = generate_day_keyboard(num_days, f"cal:d{year}-{month}-", labels, first_weekday).inline_keyboard
+    prev_year, prev_month = shift_month(year, month, -1)
+    next_year, next_month = shift_month(year, month, 1)
+    rows = [
+        [InlineKeyboardButton("◀️", callback_data=f"cal:m{prev_year}-{prev_month}"),
+         InlineKeyboardButton(f"{MONTH_NAMES[month - 1]} {year}", callback_data=f"cal:y{year}"),
+         InlineKeyboardButton("▶️", callback_data=f"cal:m{next_year}-{next_month}")],
+        [calendar_blank_button(name) for name in WEEKDAY_NAMES],
+        *grid,
+        [InlineKeyboardButton("Сегодня", callback_data=f"cal:v{parse_task_view('сегодня', date.today())}"),
+         InlineKeyboardButton("7 дней", callback_data=f"cal:v{parse_task_view('неделя', date.today())}"),
+         InlineKeyboardButton("⚠️ Просрочено", callback_data="cal:vo")],
+    ]
+    text = (f"📅 <b>{MONTH_NAMES[month - 1]} {year}</b>\n"
+            f"У дней указано число задач и записей. Нажмите на день, чтобы открыть его.")
+    return text, InlineKeyboardMarkup(rows)
+
+
+def build_calendar_months(year: int):
+    rows = list(generate_month_keyboard(f"cal:m{year}-").inline_keyboard)
+    rows.append([InlineKeyboardButton(f"◀️ {year - 1}", callback_data=f"cal:y{year - 1}"),
+                 InlineKeyboardButton(f"{year + 1} ▶️", callback_data=f"cal:y{year + 1}")])
+    return f"📅 <b>{year}</b> — выберите месяц:", InlineKeyboardMarkup(rows)
+
+
+async def build_tasks_day_page(chat_id: int, date_str: str):
+    text, markup = await build_page(f"d{date_str}", chat_id)
+    if text is None:
+        # Старые задачи могли уже уйти в архив
+        text, markup = await build_page(f"a{date_str}", chat_id)
+    return text, markup
+
+
+async def build_calendar_day(chat_id: int, day: date):
+    """Задачи и записи дня с кнопкой возврата к календарю."""
+    date_str = day.isoformat()
+    text, markup = await build_tasks_day_page(chat_id, date_str)
+    lines = [text] if text else []
+    entries = await run_db(get_entries, date_str, chat_id)
+    if entries:
+        lines.append("<b>Записи:</b>")
+        lines.extend(format_entry_line(entry) for entry in entries[:PAGE_SIZE])
+        if len(entries) > PAGE_SIZE:
+            lines.append(f"… и ещё {len(entries) - PAGE_SIZE}")
+    if not lines:
+        lines.append(f"❌ <b>За {date_str} нет ни задач, ни записей.</b>")
+    rows = list(markup.inline_keyboard) if markup else []
+    rows.append([InlineKeyboardButton("📅 К календарю", callback_data=f"cal:m{day.year}-{day.month}")])
+    return "\n".join(lines), InlineKeyboardMarkup(rows)
+
+
+async def calendar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Листание календаря и открытие дня; работает и внутри диалога просмотра задач, и после него."""
+    query = update.callback_query
+    await query.answer()
+    data = query.data[len("cal:"):]
+    chat_id = query.message.chat.id
+    try:
+        if data.startswith("m"):
+            year, month = map(int, data[1:].split("-"))
+            text, markup = await build_calendar(chat_id, year, month)
+        elif data.startswith("y"):
+            text, markup = build_calendar_months(int(data[1:]))
+        elif data.startswith("d"):
+            day = date(*map(int, data[1:].split("-")))
+            text, markup = await build_calendar_day(chat_id, day)
+            await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+            return ConversationHandler.END
+        elif data.startswith("v"):
+            text, markup = await build_page(data[1:], chat_id)
+            await query.edit_message_text(text or "❌ <b>Задач не найдено.</b>", parse_mode="HTML",
+                                          reply_markup=markup)
+            return ConversationHandler.END
+        else:
+            return None
+    except ValueError:
+        return None
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+    return None
+
+
 # --------------- Диалог: Просмотреть задачи ---------------
 VIEW_TASKS_DATE = 0
 
 
 async def view_tasks_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("📅 Введите дату (в формате ГГГГ-ММ-ДД), для которой хотите посмотреть задачи:",
-                                    parse_mode="HTML")
+    today = date.today()
+    text, markup = await build_calendar(update.message.chat.id, today.year, today.month)
+    await update.message.reply_text(
+        f"{text}\nИли введите дату создания (ГГГГ-ММ-ДД), период по дедлайну (ГГГГ-ММ-ДД ГГГГ-ММ-ДД) "
+        f"либо одно из слов: сегодня, завтра, неделя, просрочено.",
+        parse_mode="HTML", reply_markup=markup,
+    )
     return VIEW_TASKS_DATE
 
 
 async def view_tasks_receive_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     date_str = update.message.text
     chat_id = update.message.chat.id
-    tasks = get_tasks_by_date(date_str, chat_id)
-    if not tasks:
-        response = "❌ <b>Задач за указанную дату не найдено.</b>"
+    view = parse_task_view(date_str, date.today())
+    if view is not None:
+        text, markup = await build_page(view, chat_id)
     else:
-        now = datetime.now()
-        response_lines = []
-        for task in tasks:
-            try:
-                deadline_dt = datetime.fromisoformat(task["deadline"])
-                time_remaining = deadline_dt - now
-                remaining_str = "Время истекло" if time_remaining.total_seconds() < 0 else \
-                str(time_remaining).split('.')[0]
-            except Exception:
-                remaining_str = "Ошибка в дедлайне"
-            response_lines.append(
-                f"🆔 <b>{task['_id']}</b> | 📝 {task['text']} | 📅 {deadline_dt.strftime('%d.%m.%Y %H:%M')} | 🔄 {task['status']} | ⏳ {remaining_str}"
-            )
-        response = "\n".join(response_lines)
-    await update.message.reply_text(response, parse_mode="HTML", reply_markup=get_main_keyboard())
+        text, markup = await build_tasks_day_page(chat_id, date_str)
+    if text is None:
+        not_found = "Задач не найдено." if view is not None else "Задач за указанную дату не найдено."
+        await update.message.reply_text(f"❌ <b>{not_found}</b>", parse_mode="HTML",
+                                        reply_markup=get_main_keyboard())
+    else:
+        await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
     return ConversationHandler.END
 
 
 view_tasks_conv = ConversationHandler(
     entry_points=[MessageHandler(filters.Regex("^Просмотреть задачи$"), view_tasks_start)],
     states={
-        VIEW_TASKS_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_tasks_receive_date)]
+        VIEW_TASKS_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, view_tasks_receive_date),
+                          CallbackQueryHandler(calendar_callback, pattern="^cal:")]
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="view_tasks",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
 # --------------- Диалог: Обновить задачу (с выбором из списка) ---------------
@@ -404,22 +4077,69 @@ view_tasks_conv = ConversationHandler(
 UPDATE_TASK_SELECT, UPDATE_TASK_TEXT_OPTION, UPDATE_TASK_TEXT_INPUT, UPDATE_TASK_STATUS = range(4)
 
 
+# Длина текста задачи на кнопке выбора
+PICKER_BUTTON_TEXT_LIMIT = 40
+
+
+async def build_task_picker(chat_id: int, mode: str, anchor: str = None, backward: bool = False,
+                            prefix: str = "upd", selected: set = None):
+    """Страница списка задач для выбора: ``mode`` ``a`` — все задачи, ``p`` — только невыполненные.
+
+    Навигация и переключение фильтра передаются в callback_data вида ``<prefix>pg:<mode>:<n|p>:<ключ>``,
+    поэтому на каждое нажатие читается не больше одной страницы. Нажатие на задачу даёт
+    ``<prefix>_<_id>``; с ``selected`` у задач показываются отметки множественного выбора.
+    """
+    tasks, has_more = await run_db(get_tasks_by_chat, chat_id, mode == "p",
+                                   anchor and decode_task_anchor(anchor), backward)
+    buttons = []
+    for task in tasks:
+        deadline_dt = parse_deadline(task["deadline"])
+        text = task["text"]
+        if len(text) > PICKER_BUTTON_TEXT_LIMIT:
+            text = text[:PICKER_BUTTON_TEXT_LIMIT - 1] + "…"
+        mark = "📝" if selected is None else "☑️" if str(task["_id"]) in selected else "⬜"
+        button_text = f"{mark} {text} (📅 {deadline_dt.strftime('%d.%m.%Y %H:%M')})"
+        buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"{prefix}_{task['_id']}")])
+    if tasks:
+        has_prev = has_more if backward else anchor is not None
+        has_next = anchor is not None if backward else has_more
+        nav = []
+        if has_prev:
+            nav.append(InlineKeyboardButton("◀️ Назад",
+                                            callback_data=f"{prefix}pg:{mode}:p:{encode_task_anchor(tasks[0])}"))
+        if has_next:
+            nav.append(InlineKeyboardButton("Вперёд ▶️",
+                                            callback_data=f"{prefix}pg:{mode}:n:{encode_task_anchor(tasks[-1])}"))
+        if nav:
+            buttons.append(nav)
+    if mode == "p":
+        buttons.append([InlineKeyboardButton("📋 Все задачи", callback_data=f"{prefix}pg:a:n:")])
+    else:
+        buttons.append([InlineKeyboardButton("🔎 Только невыполненные", callback_data=f"{prefix}pg:p:n:")])
+    return tasks, InlineKeyboardMarkup(buttons)
+
+
 async def update_task_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat.id
-    tasks = get_tasks_by_chat(chat_id)
+    tasks, reply_markup = await build_task_picker(chat_id, "a")
     if not tasks:
         await update.message.reply_text("❌ Нет задач для обновления.", reply_markup=get_main_keyboard())
         return ConversationHandler.END
-    buttons = []
-    for task in tasks:
-        deadline_dt = datetime.fromisoformat(task["deadline"])
-        button_text = f"📝 {task['text']} (📅 {deadline_dt.strftime('%d.%m.%Y %H:%M')})"
-        buttons.append([InlineKeyboardButton(text=button_text, callback_data=f"upd_{task['_id']}")])
-    reply_markup = InlineKeyboardMarkup(buttons)
     await update.message.reply_text("Выберите задачу для обновления:", reply_markup=reply_markup)
     return UPDATE_TASK_SELECT
 
 
+async def update_task_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, mode, direction, anchor = query.data.split(":", 3)
+    tasks, reply_markup = await build_task_picker(query.message.chat.id, mode, anchor or None,
+                                                  backward=direction == "p")
+    text = "Выберите задачу для обновления:" if tasks else "❌ Нет задач для обновления."
+    await query.edit_message_text(text, reply_markup=reply_markup)
+    return UPDATE_TASK_SELECT
+
+
 async def update_task_select(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -478,7 +4198,7 @@ async def update_task_status_handler(update: Update, context: ContextTypes.DEFAU
         new_text = context.user_data.get("update_task_new_text")
         logger.info(f"Обновляем задачу {task_id}: новый текст: {new_text}, новый статус: {new_status}")
         try:
-            update_task(task_id, new_text, new_status)
+            await run_db(update_task, task_id, new_text, new_status)
             await query.edit_message_text("✅ Задача успешно обновлена!")
         except Exception as e:
             logger.error(f"Ошибка при обновлении задачи {task_id}: {e}")
@@ -490,12 +4210,145 @@ async def update_task_status_handler(update: Update, context: ContextTypes.DEFAU
 update_task_conv = ConversationHandler(
     entry_points=[MessageHandler(filters.Regex("^Обновить задачу$"), update_task_start)],
     states={
-        UPDATE_TASK_SELECT: [CallbackQueryHandler(update_task_select, pattern="^upd_")],
+        UPDATE_TASK_SELECT: [
+            CallbackQueryHandler(update_task_select, pattern="^upd_"),
+            CallbackQueryHandler(update_task_page, pattern="^updpg:"),
+        ],
         UPDATE_TASK_TEXT_OPTION: [CallbackQueryHandler(update_task_text_option, pattern="^(text_change|text_keep)$")],
         UPDATE_TASK_TEXT_INPUT: [MessageHandler(filters.TEXT & ~filters.COMMAND, update_task_receive_text)],
         UPDATE_TASK_STATUS: [CallbackQueryHandler(update_task_status_handler, pattern="^status_")],
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="update_task",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
+)
+
+# --------------- Диалог: Обновить несколько задач ---------------
+# Выбранные _id и текущая страница списка хранятся в user_data (bulk_selected, bulk_page),
+# в callback_data — только нажатая задача или действие
+BULK_SELECT = 0
+# Варианты переноса дедлайна: подпись кнопки и сдвиг в часах
+BULK_POSTPONE_OPTIONS = (("+1 час", 1), ("+1 день", 24), ("+1 неделя", 7 * 24))
+
+
+async def build_bulk_picker(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    selected = set(context.user_data.get("bulk_selected", []))
+    mode, direction, anchor = context.user_data.get("bulk_page", ("a", "n", ""))
+    tasks, markup = await build_task_picker(chat_id, mode, anchor or None, direction == "p",
+                                            prefix="bulk", selected=selected)
+    rows = list(markup.inline_keyboard)
+    rows.append([InlineKeyboardButton("✅ выполнено", callback_data="bact:done"),
+                 InlineKeyboardButton("❌ не выполнено", callback_data="bact:undone")])
+    rows.append([InlineKeyboardButton("⏩ Отложить", callback_data="bact:postpone"),
+                 InlineKeyboardButton("🗑 Удалить", callback_data="bact:delete")])
+    text = f"Отметьте задачи и выберите действие. Выбрано: {len(selected)}"
+    return tasks, text, InlineKeyboardMarkup(rows)
+
+
+async def bulk_tasks_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["bulk_selected"] = []
+    context.user_data["bulk_page"] = ("a", "n", "")
+    tasks, text, markup = await build_bulk_picker(context, update.message.chat.id)
+    if not tasks:
+        await update.message.reply_text("❌ Нет задач для обновления.", reply_markup=get_main_keyboard())
+        return ConversationHandler.END
+    await update.message.reply_text(text, reply_markup=markup)
+    return BULK_SELECT
+
+
+async def bulk_tasks_toggle(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    task_id = query.data[len("bulk_"):]
+    selected = list(context.user_data.get("bulk_selected", []))
+    if task_id in selected:
+        selected.remove(task_id)
+    else:
+        selected.append(task_id)
+    context.user_data["bulk_selected"] = selected
+    _, text, markup = await build_bulk_picker(context, query.message.chat.id)
+    await query.edit_message_text(text, reply_markup=markup)
+    return BULK_SELECT
+
+
+async def bulk_tasks_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, mode, direction, anchor = query.data.split(":", 3)
+    context.user_data["bulk_page"] = (mode, direction, anchor)
+    _, text, markup = await build_bulk_picker(context, query.message.chat.id)
+    await query.edit_message_text(text, reply_markup=markup)
+    return BULK_SELECT
+
+
+async def bulk_tasks_action(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Действие над выбранными задачами: одна операция MongoDB на всё выделение."""
+    query = update.callback_query
+    action = query.data.split(":", 1)[1]
+    selected = context.user_data.get("bulk_selected", [])
+    chat_id = query.message.chat.id
+    if action == "back":
+        await query.answer()
+        _, text, markup = await build_bulk_picker(context, chat_id)
+        await query.edit_message_text(text, reply_markup=markup)
+        return BULK_SELECT
+    if not selected:
+        await query.answer("Сначала отметьте задачи.")
+        return BULK_SELECT
+    await query.answer()
+    if action == "postpone":
+        rows = [[InlineKeyboardButton(label, callback_data=f"bact:postpone_{hours}")
+                 for label, hours in BULK_POSTPONE_OPTIONS],
+                [InlineKeyboardButton("◀️ Назад", callback_data="bact:back")]]
+        await query.edit_message_text(f"На сколько отложить дедлайн задач ({len(selected)})?",
+                                      reply_markup=InlineKeyboardMarkup(rows))
+        return BULK_SELECT
+    if action == "delete":
+        rows = [[InlineKeyboardButton("🗑 Да, удалить", callback_data="bact:delete_confirm"),
+                 InlineKeyboardButton("◀️ Назад", callback_data="bact:back")]]
+        await query.edit_message_text(f"⚠️ Удалить выбранные задачи ({len(selected)})?",
+                                      reply_markup=InlineKeyboardMarkup(rows))
+        return BULK_SELECT
+    try:
+        if action == "done":
+            count = await run_db(set_tasks_status, selected, chat_id, "выполнено")
+            result = f"✅ Отмечено выполненными задач: {count}."
+        elif action == "undone":
+            count = await run_db(set_tasks_status, selected, chat_id, "не выполнено")
+            result = f"✅ Отмечено невыполненными задач: {count}."
+        elif action == "delete_confirm":
+            count = await run_db(delete_tasks, selected, chat_id)
+            result = f"✅ Удалено задач: {count}."
+        elif action.startswith("postpone_"):
+            hours = int(action[len("postpone_"):])
+            count = await run_db(postpone_tasks, selected, chat_id, timedelta(hours=hours))
+            result = f"✅ Дедлайн отложен у задач: {count}."
+        else:
+            return BULK_SELECT
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении задач {selected}: {e}")
+        await query.edit_message_text("❌ Ошибка при обновлении задач.")
+        return ConversationHandler.END
+    context.user_data.pop("bulk_selected", None)
+    context.user_data.pop("bulk_page", None)
+    await query.edit_message_text(result)
+    return ConversationHandler.END
+
+
+bulk_tasks_conv = ConversationHandler(
+    entry_points=[MessageHandler(filters.Regex("^Обновить несколько задач$"), bulk_tasks_start)],
+    states={
+        BULK_SELECT: [
+            CallbackQueryHandler(bulk_tasks_toggle, pattern="^bulk_"),
+            CallbackQueryHandler(bulk_tasks_page, pattern="^bulkpg:"),
+            CallbackQueryHandler(bulk_tasks_action, pattern="^bact:"),
+        ],
+    },
+    fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="bulk_tasks",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
 # --------------- Диалог: Удалить задачи за дату ---------------
@@ -511,7 +4364,7 @@ async def delete_tasks_date_start(update: Update, context: ContextTypes.DEFAULT_
 async def delete_tasks_date_receive(update: Update, context: ContextTypes.DEFAULT_TYPE):
     date_str = update.message.text
     chat_id = update.message.chat.id
-    delete_tasks_by_date(date_str, chat_id)
+    await run_db(delete_tasks_by_date, date_str, chat_id)
     await update.message.reply_text("✅ Все задачи за указанную дату удалены.", parse_mode="HTML",
                                     reply_markup=get_main_keyboard())
     return ConversationHandler.END
@@ -523,6 +4376,9 @@ delete_tasks_conv = ConversationHandler(
         DELETE_TASKS_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_tasks_date_receive)]
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="delete_tasks",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
 # --------------- Диалог: Удалить все записи ---------------
@@ -539,8 +4395,8 @@ async def delete_all_entries_start(update: Update, context: ContextTypes.DEFAULT
 
 async def delete_all_entries_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text.lower() == "да":
-        result = delete_all_entries()
-        await update.message.reply_text(f"✅ Удалено записей: {result.deleted_count}.", parse_mode="HTML",
+        deleted = await run_db(delete_all_entries, update.message.chat.id)
+        await update.message.reply_text(f"✅ Удалено записей: {deleted}.", parse_mode="HTML",
                                         reply_markup=get_main_keyboard())
     else:
         await update.message.reply_text("❌ Операция отменена.", parse_mode="HTML", reply_markup=get_main_keyboard())
@@ -553,6 +4409,9 @@ delete_all_entries_conv = ConversationHandler(
         CONFIRM_DELETE_ALL_ENTRIES: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_all_entries_confirm)]
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="delete_all_entries",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
 # --------------- Диалог: Удалить все задачи ---------------
@@ -569,8 +4428,8 @@ async def delete_all_tasks_start(update: Update, context: ContextTypes.DEFAULT_T
 
 async def delete_all_tasks_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.text.lower() == "да":
-        result = delete_all_tasks()
-        await update.message.reply_text(f"✅ Удалено задач: {result.deleted_count}.", parse_mode="HTML",
+        deleted = await run_db(delete_all_tasks, update.message.chat.id)
+        await update.message.reply_text(f"✅ Удалено задач: {deleted}.", parse_mode="HTML",
                                         reply_markup=get_main_keyboard())
     else:
         await update.message.reply_text("❌ Операция отменена.", parse_mode="HTML", reply_markup=get_main_keyboard())
@@ -583,45 +4442,674 @@ delete_all_tasks_conv = ConversationHandler(
         CONFIRM_DELETE_ALL_TASKS: [MessageHandler(filters.TEXT & ~filters.COMMAND, delete_all_tasks_confirm)]
     },
     fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="delete_all_tasks",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
 )
 
 
+# --------------- Постраничный просмотр ---------------
+# Длинные тексты обрезаются, чтобы страница из PAGE_SIZE строк помещалась в одно сообщение (4096 символов)
+ITEM_TEXT_LIMIT = 250
+EPOCH = datetime(1970, 1, 1)
+
+
+def shorten(text: str) -> str:
+    text = text or ""
+    if len(text) > ITEM_TEXT_LIMIT:
+        text = text[:ITEM_TEXT_LIMIT - 1] + "…"
+    return html.escape(text)
+
+
+def format_entry_line(entry: dict) -> str:
+    return f"📅 <b>{entry.get('date', 'N/A')}</b> — ✏️ {shorten(entry.get('text', ''))}"
+
+
+def format_task_line(task: dict, now: datetime) -> str:
+    try:
+        deadline_dt = parse_deadline(task["deadline"])
+        time_remaining = deadline_dt - now
+        remaining_str = "Время истекло" if time_remaining.total_seconds() < 0 else \
+            str(time_remaining).split('.')[0]
+        deadline_str = deadline_dt.strftime('%d.%m.%Y %H:%M')
+    except Exception:
+        remaining_str = "Ошибка в дедлайне"
+        deadline_str = "N/A"
+    return (f"🆔 <b>{task['_id']}</b> | 📝 {shorten(task.get('text'))} | 📅 {deadline_str} | "
+            f"🔄 {task.get('status')} | ⏳ {remaining_str}")
+
+
+def encode_task_anchor(task: dict) -> str:
+    # Ключ страницы задач: дедлайн в миллисекундах и _id (помещается в 64 байта callback_data)
+    ms = (task["deadline"] - EPOCH) // timedelta(milliseconds=1)
+    return f"{ms}_{task['_id']}"
+
+
+def decode_task_anchor(anchor: str) -> tuple:
+    ms, task_id = anchor.split("_")
+    return EPOCH + timedelta(milliseconds=int(ms)), ObjectId(task_id)
+
+
+def page_view_title(view: str) -> str:
+    if view == "e":
+        return "<b>Записи:</b>"
+    if view == "a":
+        return "<b>🗄 Архив задач:</b>"
+    if view.startswith("a"):
+        return f"<b>🗄 Архив задач за {html.escape(view[1:])}:</b>"
+    if view.startswith("d"):
+        return f"<b>Задачи за {html.escape(view[1:])}:</b>"
+    if view == "o":
+        return "<b>⚠️ Просроченные задачи:</b>"
+    if view == "c":
+        return "🔁 <b>Повторяющиеся задачи:</b>"
+    if view.startswith("r"):
+        start, end = decode_range_view(view)
+        return (f"<b>Задачи с дедлайном с {start.strftime('%d.%m.%Y')} "
+                f"по {(end - timedelta(days=1)).strftime('%d.%m.%Y')}:</b>")
+    return "<b>Задачи:</b>"
+
+
+def range_view(first: date, last: date) -> str:
+    # Дни хранятся без разделителей, чтобы callback_data с ключом страницы уложилась в 64 байта
+    return f"r{first.strftime('%Y%m%d')}{last.strftime('%Y%m%d')}"
+
+
+def decode_range_view(view: str) -> tuple:
+    """Границы [start, end) дедлайнов для вида ``r<первый день><последний день>``."""
+    start = datetime.strptime(view[1:9], "%Y%m%d")
+    end = datetime.strptime(view[9:17], "%Y%m%d") + timedelta(days=1)
+    return start, end
+
+
+RANGE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})\s*(?:\s|—|–|-|\.\.)\s*(\d{4}-\d{2}-\d{2})$")
+
+
+def parse_task_view(text: str, today: date):
+    """Вид списка задач по запросу пользователя: «сегодня», «завтра», «неделя» (7 дней начиная
+    с сегодняшнего), «просрочено» или период «ГГГГ-ММ-ДД ГГГГ-ММ-ДД» — всё по дедлайну.
+    Для остального (в том числе одной даты — она ищется по дате создания) возвращает None."""
+    text = text.strip().lower()
+    if text == "просрочено":
+        return "o"
+    days = {"сегодня": (0, 0), "завтра": (1, 1), "неделя": (0, 6)}
+    if text in days:
+        first, last = days[text]
+        return range_view(today + timedelta(days=first), today + timedelta(days=last))
+    match = RANGE_PATTERN.match(text)
+    if not match:
+        return None
+    try:
+        first, last = sorted(date.fromisoformat(value) for value in match.groups())
+    except ValueError:
+        return None
+    return range_view(first, last)
+
+
+async def build_page(view: str, chat_id: int, anchor: str = None, backward: bool = False):
+    """Формирует текст и кнопки навигации одной страницы.
+
+    Виды: ``e`` — записи, ``t`` — задачи чата, ``d<дата>`` — задачи за дату создания,
+    ``a`` и ``a<дата>`` — то же из архива, ``r<день><день>`` — задачи с дедлайном в периоде,
+    ``o`` — просроченные невыполненные задачи, ``c`` — правила повторяющихся задач с кнопками
+    удаления. Под страницами рабочих задач есть кнопка перехода к архиву, а на первой странице
+    даты — вхождения повторяющихся задач в этот день.
+    Возвращает (None, None), если страница пуста.
+    """
+    recurring_lines, recurring_rows = [], []
+    if view.startswith("d") and anchor is None and not backward:
+        recurring_lines, recurring_rows = await build_recurring_block(chat_id, view[1:])
+    if view == "e":
+        items, has_more = await run_db(get_entries_page, chat_id, anchor and ObjectId(anchor), backward)
+        lines = [format_entry_line(entry) for entry in items]
+        keys = [str(entry["_id"]) for entry in items[:1] + items[-1:]]
+    elif view == "c":
+        items, has_more = await run_db(get_recurring_page, chat_id, anchor and ObjectId(anchor), backward)
+        now = datetime.now()
+        lines = [format_rule_line(rule, now) for rule in items]
+        keys = [str(rule["_id"]) for rule in items[:1] + items[-1:]]
+        page = f"{'p' if backward else 'n'}:{anchor or ''}"
+        recurring_rows = [[InlineKeyboardButton(f"🗑 {rule['text'][:PICKER_BUTTON_TEXT_LIMIT]}",
+                                                callback_data=f"rdel:{rule['_id']}:{page}")] for rule in items]
+    else:
+        task_anchor = anchor and decode_task_anchor(anchor)
+        if view.startswith("d"):
+            items, has_more = await run_db(get_tasks_by_date, view[1:], chat_id, task_anchor, backward)
+        elif view.startswith("r"):
+            start, end = decode_range_view(view)
+            items, has_more = await run_db(get_tasks_by_deadline, chat_id, start, end, task_anchor, backward)
+        elif view == "o":
+            items, has_more = await run_db(get_overdue_tasks, chat_id, datetime.now(), task_anchor, backward)
+        elif view.startswith("a"):
+            items, has_more = await run_db(get_archived_tasks, chat_id, view[1:] or None, task_anchor, backward)
+        else:
+            items, has_more = await run_db(get_tasks_by_chat, chat_id, False, task_anchor, backward)
+        now = datetime.now()
+        lines = [format_task_line(task, now) for task in items]
+        keys = [encode_task_anchor(task) for task in items[:1] + items[-1:]]
+    if not items and not recurring_lines:
+        return None, None
+    has_prev = has_more if backward else anchor is not None
+    has_next = anchor is not None if backward else has_more
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"pg:{view}:p:{keys[0]}"))
+    if has_next:
+        buttons.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"pg:{view}:n:{keys[-1]}"))
+    rows = [buttons] if buttons else []
+    rows.extend(recurring_rows)
+    if view == "t" or view.startswith("d"):
+        rows.append([InlineKeyboardButton("🗄 Архив", callback_data=f"pg:a{view[1:]}:n:")])
+    markup = InlineKeyboardMarkup(rows) if rows else None
+    return "\n".join([page_view_title(view), *lines, *recurring_lines]), markup
+
+
+async def build_recurring_block(chat_id: int, date_str: str):
+    """Строки и кнопки отметки вхождений повторяющихся задач за день ``date_str``."""
+    try:
+        day_start = datetime.combine(date.fromisoformat(date_str), datetime.min.time())
+    except ValueError:
+        return [], []
+    occurrences = await run_db(get_occurrences, chat_id, day_start, day_start + timedelta(days=1))
+    if not occurrences:
+        return [], []
+    lines = ["🔁 <b>Повторяющиеся:</b>"]
+    rows = []
+    for item in occurrences:
+        time_str = item["deadline"].strftime("%H:%M")
+        lines.append(f"🕒 <b>{time_str}</b> | 📝 {shorten(item['text'])} | 🔄 {item['status']}")
+        mark = "↩️" if item["status"] == "выполнено" else "✅"
+        label = item["text"][:PICKER_BUTTON_TEXT_LIMIT]
+        ms = (item["deadline"] - EPOCH) // timedelta(milliseconds=1)
+        rows.append([InlineKeyboardButton(f"{mark} {time_str} {label}", callback_data=f"occ:{item['rule_id']}:{ms}")])
+    return lines, rows
+
+
+async def page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    _, view, direction, anchor = query.data.split(":", 3)
+    text, markup = await build_page(view, query.message.chat.id, anchor or None, backward=direction == "p")
+    if text is None:
+        await query.edit_message_text("❌ <b>Больше ничего нет.</b>", parse_mode="HTML")
+        return
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+
+
+async def occurrence_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Отметка вхождения повторяющейся задачи выполненным (или снятие отметки)."""
+    query = update.callback_query
+    await query.answer()
+    _, rule_id, ms = query.data.split(":")
+    occurrence = EPOCH + timedelta(milliseconds=int(ms))
+    chat_id = query.message.chat.id
+    status = await run_db(toggle_occurrence_status, ObjectId(rule_id), occurrence, chat_id)
+    if status is None:
+        await query.edit_message_text("❌ <b>Повторяющаяся задача не найдена.</b>", parse_mode="HTML")
+        return
+    text, markup = await build_page(f"d{occurrence.date().isoformat()}", chat_id)
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+
+
 # --------------- Команда: Просмотреть все данные (без диалога) ---------------
 async def view_all_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    all_entries = list(entries_collection.find())
-    all_tasks = list(tasks_collection.find())
+    chat_id = update.message.chat.id
+    await update.message.reply_text("<b>ВСЕ ДАННЫЕ:</b>", parse_mode="HTML", reply_markup=get_main_keyboard())
+    for view, empty_text in (("e", "<b>Записи:</b>\n  Нет записей."), ("t", "<b>Задачи:</b>\n  Нет задач.")):
+        text, markup = await build_page(view, chat_id)
+        await update.message.reply_text(text or empty_text, parse_mode="HTML", reply_markup=markup)
 
-    response_parts = ["<b>ВСЕ ДАННЫЕ:</b>"]
-    response_parts.append("\n<b>Записи:</b>")
-    if not all_entries:
-        response_parts.append("  Нет записей.")
-    else:
-        for entry in all_entries:
-            response_parts.append(f"  📅 <b>{entry.get('date', 'N/A')}</b> — ✏️ {entry.get('text', '')}")
 
-    response_parts.append("\n<b>Задачи:</b>")
-    if not all_tasks:
-        response_parts.append("  Нет задач.")
+# --------------- Команда: Статистика ---------------
+def format_chat_stats(stats: dict, today: date) -> str:
+    total = stats.get("total", 0)
+    completed = stats.get("completed", 0)
+    rated = stats.get("completed_on_time", 0) + stats.get("completed_late", 0)
+    lines = [
+        "📊 <b>Статистика задач:</b>",
+        f"Всего: {total}",
+        f"✅ Выполнено: {completed}",
+        f"❌ Не выполнено: {total - completed}, из них просрочено: {stats.get('overdue', 0)}",
+    ]
+    if rated:
+        lines.append(f"⏱ Выполнено в срок: {round(100 * stats.get('completed_on_time', 0) / rated)}%")
+    lines.append("\n<b>По неделям</b> (создано / выполнено):")
+    weeks = stats.get("weeks", {})
+    for back in range(STATS_WEEKS - 1, -1, -1):
+        monday = today - timedelta(days=today.weekday() + 7 * back)
+        counters = weeks.get(week_key(monday), {})
+        lines.append(f"{monday.strftime('%d.%m')}–{(monday + timedelta(days=6)).strftime('%d.%m')}: "
+                     f"{counters.get('created', 0)} / {counters.get('completed', 0)}")
+    return "\n".join(lines)
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    stats = await run_db(get_chat_stats, update.message.chat.id)
+    if not stats or not stats.get("total"):
+        await update.message.reply_text("❌ <b>Задач пока нет.</b>", parse_mode="HTML",
+                                        reply_markup=get_main_keyboard())
+        return
+    await update.message.reply_text(format_chat_stats(stats, date.today()), parse_mode="HTML",
+                                    reply_markup=get_main_keyboard())
+
+
+# --------------- Диалог: Поиск ---------------
+SEARCH_QUERY = 0
+
+
+async def build_search_page(chat_id: int, search_query: str, offset: int = 0):
+    """Страница результатов поиска; возвращает (None, None), если совпадений нет."""
+    items, has_more = await run_db(search_items, chat_id, search_query, offset)
+    if not items:
+        return None, None
+    now = datetime.now()
+    lines = [format_entry_line(doc) if kind == "e" else format_task_line(doc, now) for kind, doc in items]
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton("◀️ Назад", callback_data=f"srch:{max(offset - PAGE_SIZE, 0)}"))
+    if has_more and offset + PAGE_SIZE < SEARCH_MAX_RESULTS:
+        buttons.append(InlineKeyboardButton("Вперёд ▶️", callback_data=f"srch:{offset + PAGE_SIZE}"))
+    markup = InlineKeyboardMarkup([buttons]) if buttons else None
+    return "\n".join([f"<b>🔎 Найдено по запросу «{shorten(search_query)}»:</b>", *lines]), markup
+
+
+async def search_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text("🔎 Введите слова для поиска по записям и задачам:", parse_mode="HTML")
+    return SEARCH_QUERY
+
+
+async def search_receive_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    search_query = update.message.text.strip()
+    # Запрос запоминается для листания: в callback_data он может не поместиться
+    context.user_data["search_query"] = search_query
+    text, markup = await build_search_page(update.message.chat.id, search_query)
+    if text is None:
+        await update.message.reply_text("❌ <b>Ничего не найдено.</b>", parse_mode="HTML",
+                                        reply_markup=get_main_keyboard())
     else:
-        now = datetime.now()
-        for task in all_tasks:
-            try:
-                deadline_dt = datetime.fromisoformat(task["deadline"])
-                time_remaining = deadline_dt - now
-                remaining_str = "Время истекло" if time_remaining.total_seconds() < 0 else \
-                str(time_remaining).split('.')[0]
-            except Exception:
-                remaining_str = "Ошибка в дедлайне"
-            response_parts.append(
-                f"  🆔 <b>{task.get('_id')}</b> | 📝 {task.get('text')} | 📅 {datetime.fromisoformat(task.get('deadline')).strftime('%d.%m.%Y %H:%M')} | 🔄 {task.get('status')} | ⏳ {remaining_str}"
+        await update.message.reply_text(text, parse_mode="HTML", reply_markup=markup)
+    return ConversationHandler.END
+
+
+async def search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    search_query = context.user_data.get("search_query")
+    if not search_query:
+        await query.edit_message_text("❌ <b>Поиск устарел, начните его заново.</b>", parse_mode="HTML")
+        return
+    offset = int(query.data.split(":", 1)[1])
+    text, markup = await build_search_page(query.message.chat.id, search_query, offset)
+    if text is None:
+        await query.edit_message_text("❌ <b>Больше ничего нет.</b>", parse_mode="HTML")
+        return
+    await query.edit_message_text(text, parse_mode="HTML", reply_markup=markup)
+
+
+search_conv = ConversationHandler(
+    entry_points=[MessageHandler(filters.Regex("^Поиск$"), search_start)],
+    states={
+        SEARCH_QUERY: [MessageHandler(filters.TEXT & ~filters.COMMAND, search_receive_query)]
+    },
+    fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="search",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
+)
+
+
+# --------------- Экспорт и импорт ---------------
+# Формат файла: одна запись на строку (JSONL) или CSV с этими колонками
+EXPORT_FIELDS = ("type", "date", "text", "deadline", "status", "date_created")
+TASK_EXPORT_PROJECTION = {"text": 1, "deadline": 1, "status": 1, "date_created": 1}
+IMPORT_BATCH_SIZE = 1000
+# Как часто (с) обновлять сообщение о ходе импорта
+IMPORT_PROGRESS_INTERVAL = 3
+TASK_STATUSES = ("не выполнено", "выполнено")
+
+
+def export_records(chat_id: int):
+    """Записи и задачи чата (включая архив) для выгрузки; читаются курсором, в памяти не накапливаются."""
+    for entry in repository.iter_entries(chat_id):
+        yield {"type": "entry", "date": entry.get("date"), "text": entry.get("text")}
+    for task in repository.iter_tasks(chat_id):
+        try:
+            deadline = parse_deadline(task["deadline"]).isoformat()
+        except Exception:
+            deadline = None
+        yield {"type": "task", "text": task.get("text"), "deadline": deadline, "status": task.get("status"),
+               "date_created": task.get("date_created")}
+
+
+def export_chat_data(chat_id: int, fmt: str, path: str) -> int:
+    """Выгружает данные чата в файл ``path`` (jsonl или csv) и возвращает число строк."""
+    count = 0
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            writer = csv.DictWriter(f, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        for record in export_records(chat_id):
+            if fmt == "csv":
+                writer.writerow(record)
+            else:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def read_import_records(f, fmt: str):
+    """Построчно разбирает загруженный файл; нераспознанные строки отдаются как None."""
+    if fmt == "csv":
+        yield from csv.DictReader(f)
+        return
+    for line in f:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield record if isinstance(record, dict) else None
+
+
+def read_import_batch(records, size: int = IMPORT_BATCH_SIZE) -> list:
+    return list(itertools.islice(records, size))
+
+
+def parse_import_record(record, now: datetime):
+    """Проверяет строку файла и возвращает ("e" | "t", документ) или None."""
+    if not record:
+        return None
+    text = (record.get("text") or "").strip()
+    if not text:
+        return None
+    try:
+        if record.get("type") == "entry":
+            return "e", {"date": date.fromisoformat(record["date"]).isoformat(), "text": text}
+        if record.get("type") != "task":
+            return None
+        deadline_dt = datetime.fromisoformat(record["deadline"])
+        date_created = date.fromisoformat(record.get("date_created") or date.today().isoformat()).isoformat()
+    except (KeyError, TypeError, ValueError):
+        return None
+    if deadline_dt.tzinfo is not None:
+        deadline_dt = deadline_dt.astimezone().replace(tzinfo=None)
+    # Точность BSON datetime — миллисекунды; без округления не сработает поиск дубликатов
+    deadline_dt = deadline_dt.replace(microsecond=deadline_dt.microsecond // 1000 * 1000)
+    status = record.get("status") if record.get("status") in TASK_STATUSES else TASK_STATUSES[0]
+    return "t", {
+        "text": text,
+        "deadline": deadline_dt,
+        "status": status,
+        "date_created": date_created,
+        # Напоминания, время которых уже прошло, повторно не отправляются
+        "reminders": {kind: deadline_dt - offset <= now for kind, offset in REMINDER_OFFSETS},
+    }
+
+
+def import_records(records: list, chat_id: int) -> dict:
+    """Записывает пачку строк файла в базу, пропуская дубликаты уже имеющихся данных.
+
+    Дубликатом считается задача чата (в том числе архивная) с тем же текстом и дедлайном или запись чата
+    с той же датой и текстом. Существующие данные ищутся одним запросом на коллекцию по индексам
+    chat_deadline и chat_date. Возвращает счётчики added, duplicates и invalid.
+    """
+    now = datetime.now()
+    result = {"added": 0, "duplicates": 0, "invalid": 0}
+    entries, tasks = {}, {}
+    for record in records:
+        parsed = parse_import_record(record, now)
+        if parsed is None:
+            result["invalid"] += 1
+            continue
+        kind, doc = parsed
+        if kind == "e":
+            key, target = (doc["date"], doc["text"]), entries
+        else:
+            key, target = (doc["deadline"], doc["text"]), tasks
+        if key in target:
+            result["duplicates"] += 1
+        else:
+            target[key] = doc
+    if entries:
+        dates = list({doc["date"] for doc in entries.values()})
+        for entry in repository.find_entries(chat_id, dates):
+            if entries.pop((entry["date"], entry.get("text")), None) is not None:
+                result["duplicates"] += 1
+    if tasks:
+        deadlines = list({doc["deadline"] for doc in tasks.values()})
+        for archived in (False, True):
+            for task in repository.find_tasks(archived=archived, chat_id=chat_id, deadlines=deadlines):
+                if tasks.pop((task["deadline"], task.get("text")), None) is not None:
+                    result["duplicates"] += 1
+    if entries:
+        repository.add_entries([{**doc, "chat_id": chat_id} for doc in entries.values()])
+        query_cache.invalidate(chat_id)
+    if tasks:
+        updated_at = datetime.now(timezone.utc)
+        docs = [{**doc, "chat_id": chat_id, "updated_at": updated_at} for doc in tasks.values()]
+        repository.add_tasks(docs)
+        query_cache.invalidate(chat_id)
+        deltas = {}
+        for doc in docs:
+            schedule_task_reminders(doc)
+            count_task_stats(deltas, doc)
+        apply_stats_deltas(deltas)
+    result["added"] = len(entries) + len(tasks)
+    return result
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/export [csv] — выгрузка записей и задач чата файлом (по умолчанию JSONL)."""
+    chat_id = update.message.chat.id
+    fmt = "csv" if context.args and context.args[0].lower() == "csv" else "jsonl"
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        count = await run_db(export_chat_data, chat_id, fmt, path, timeout=None)
+        if not count:
+            await update.message.reply_text("❌ <b>Нет данных для выгрузки.</b>", parse_mode="HTML",
+                                            reply_markup=get_main_keyboard())
+            return
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f"task_planner_{chat_id}_{date.today().isoformat()}.{fmt}",
+                caption=f"📦 Выгружено строк: {count}",
+                reply_markup=get_main_keyboard(),
             )
-    await update.message.reply_text("\n".join(response_parts), parse_mode="HTML", reply_markup=get_main_keyboard())
+    finally:
+        os.remove(path)
+
+
+# --------------- Диалог: Импорт ---------------
+IMPORT_FILE = 0
+IMPORT_RUNNING_TITLE = "⏳ <b>Идёт импорт...</b>"
+
+
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📥 Отправьте файл .jsonl или .csv в формате выгрузки /export.\n"
+        "Записи и задачи, которые уже есть, будут пропущены.",
+        parse_mode="HTML",
+    )
+    return IMPORT_FILE
+
+
+def format_import_progress(title: str, totals: dict) -> str:
+    return (f"{title}\nДобавлено: {totals['added']}\nДубликатов пропущено: {totals['duplicates']}\n"
+            f"Нераспознанных строк: {totals['invalid']}")
+
+
+async def import_receive_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat.id
+    document = update.message.document
+    fmt = "csv" if (document.file_name or "").lower().endswith(".csv") else "jsonl"
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    totals = {"added": 0, "duplicates": 0, "invalid": 0}
+    try:
+        tg_file = await document.get_file()
+        await tg_file.download_to_drive(path)
+        progress = await update.message.reply_text(format_import_progress(IMPORT_RUNNING_TITLE, totals),
+                                                   parse_mode="HTML")
+        last_report = time.monotonic()
+        # Файл читается пачками, поэтому память не зависит от его размера
+        with open(path, encoding="utf-8-sig", errors="replace", newline="") as f:
+            records = read_import_records(f, fmt)
+            while True:
+                batch = await run_db(read_import_batch, records)
+                if not batch:
+                    break
+                result = await run_db(import_records, batch, chat_id)
+                for key, value in result.items():
+                    totals[key] += value
+                if time.monotonic() - last_report >= IMPORT_PROGRESS_INTERVAL:
+                    await progress.edit_text(format_import_progress(IMPORT_RUNNING_TITLE, totals), parse_mode="HTML")
+                    last_report = time.monotonic()
+    except Exception as e:
+        logger.error(f"Ошибка при импорте файла в чате {chat_id}: {e}")
+        await update.message.reply_text(format_import_progress("❌ <b>Импорт прерван.</b>", totals),
+                                        parse_mode="HTML", reply_markup=get_main_keyboard())
+        return ConversationHandler.END
+    finally:
+        os.remove(path)
+    await update.message.reply_text(format_import_progress("✅ <b>Импорт завершён.</b>", totals),
+                                    parse_mode="HTML", reply_markup=get_main_keyboard())
+    return ConversationHandler.END
+
+
+import_conv = ConversationHandler(
+    entry_points=[CommandHandler("import", import_start)],
+    states={
+        IMPORT_FILE: [MessageHandler(filters.Document.ALL, import_receive_file)]
+    },
+    fallbacks=[CommandHandler("cancel", cancel), MessageHandler(filters.Regex("^Отмена$"), cancel)],
+    name="import",
+    persistent=PERSISTENCE_ENABLED,
+    conversation_timeout=CONVERSATION_TIMEOUT,
+)
+
+
+# --------------- Встроенный HTTP-сервер ---------------
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class HttpRequest:
+    def __init__(self, method: str, path: str, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+
+async def write_http_response(writer, status: int, content_type: str, body: bytes, keep_alive: bool):
+    head = (
+        f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+
+async def start_http_server(host: str, port: int, routes: dict):
+    """Минимальный HTTP/1.1-сервер на asyncio с keep-alive.
+
+    ``routes`` — словарь {(метод, путь): async handler(HttpRequest) -> (статус, content-type, тело)}.
+    """
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                except ValueError:
+                    await write_http_response(writer, 400, "text/plain", b"Bad Request", False)
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await write_http_response(writer, 400, "text/plain", b"Bad Request", False)
+                    break
+                if length > HTTP_MAX_BODY:
+                    await write_http_response(writer, 413, "text/plain", b"Payload Too Large", False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                path = target.split("?", 1)[0]
+                handler = routes.get((method, path))
+                if handler is None:
+                    status = 405 if any(route_path == path for _, route_path in routes) else 404
+                    content_type, payload = "text/plain", HTTP_REASONS[status].encode()
+                else:
+                    try:
+                        status, content_type, payload = await handler(HttpRequest(method, path, headers, body))
+                    except Exception as e:
+                        logger.error(f"Ошибка при обработке HTTP-запроса {method} {path}: {e}")
+                        status, content_type, payload = 500, "text/plain", b"Internal Server Error"
+                await write_http_response(writer, status, content_type, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_connection, host, port)
+
+
+def make_webhook_handler(app: Application):
+    async def handle_webhook(request: HttpRequest):
+        if WEBHOOK_SECRET and request.headers.get("x-telegram-bot-api-secret-token") != WEBHOOK_SECRET:
+            return 403, "text/plain", b"Forbidden"
+        try:
+            update = Update.de_json(json.loads(request.body), app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, "text/plain", b"Bad Request"
+        # Обработка идёт в фоне через очередь приложения, Telegram сразу получает ответ
+        await app.update_queue.put(update)
+        return 200, "text/plain", b"OK"
+
+    return handle_webhook
+
+
+async def start_webhook_server(app: Application):
+    server = await start_http_server(WEBHOOK_LISTEN, WEBHOOK_PORT, {("POST", WEBHOOK_PATH): make_webhook_handler(app)})
+    if WEBHOOK_URL:
+        await app.bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                                  max_connections=min(HANDLER_CONCURRENCY, 100))
+    logger.info(f"Webhook-сервер слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return server
 
 
 # --------------- Основная функция ---------------
-async def main():
-    TOKEN = "7757802683:AAEAL6v68Jq9eoVSQwOWbKSSoJh5TNJu4sA"  # Замените на свой токен от BotFather
-    app = Application.builder().token(TOKEN).build()
+def build_application(update_processor: BaseUpdateProcessor = None) -> Application:
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(update_processor or ChatOrderedUpdateProcessor(HANDLER_CONCURRENCY))
+        .rate_limiter(send_queue)
+    )
+    if PERSISTENCE_ENABLED:
+        builder = builder.persistence(MongoPersistence())
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    app = builder.build()
 
     # Регистрируем обработчики диалогов и команд
     app.add_handler(CommandHandler("start", start_command))
@@ -629,27 +5117,118 @@ async def main():
     app.add_handler(view_entries_conv)
     app.add_handler(add_task_conv)
     app.add_handler(view_tasks_conv)
+    app.add_handler(add_recurring_conv)
     app.add_handler(update_task_conv)
+    app.add_handler(bulk_tasks_conv)
     app.add_handler(delete_tasks_conv)
     app.add_handler(delete_all_entries_conv)
     app.add_handler(delete_all_tasks_conv)
+    app.add_handler(search_conv)
+    app.add_handler(import_conv)
+    app.add_handler(CommandHandler("export", export_command))
     app.add_handler(MessageHandler(filters.Regex("^Просмотреть все данные$"), view_all_data))
+    app.add_handler(CallbackQueryHandler(page_callback, pattern="^pg:"))
+    app.add_handler(CallbackQueryHandler(search_page_callback, pattern="^srch:"))
+    app.add_handler(CallbackQueryHandler(calendar_callback, pattern="^cal:"))
+    app.add_handler(MessageHandler(filters.Regex("^Повторяющиеся задачи$"), recurring_list))
+    app.add_handler(CommandHandler("recurring", recurring_list))
+    app.add_handler(MessageHandler(filters.Regex("^Статистика$"), stats_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CallbackQueryHandler(occurrence_callback, pattern="^occ:"))
+    app.add_handler(CallbackQueryHandler(recurring_delete_callback, pattern="^rdel:"))
     app.add_handler(CommandHandler("cancel", cancel))
+    for handlers in app.handlers.values():
+        instrument_handlers(handlers)
+    return app
 
-    # Фоновая задача проверки дедлайнов
-    app.create_task(deadline_loop(app))
 
-    # Запускаем polling без закрытия event loop
-    await app.run_polling(close_loop=False)
+async def serve(app: Application, stop_event: asyncio.Event, receive_updates: bool = True):
+    """Запускает приложение с фоновыми задачами и работает до установки ``stop_event``.
+
+    С ``receive_updates=False`` обновления не запрашиваются у Telegram — их кладут
+    в ``app.update_queue`` напрямую (так делает нагрузочный тест bench.py).
+    """
+    ensure_indexes()
+    start_cache_invalidation_listener()
+    task_change_watcher.start()
+    async with app:
+        await app.start()
+        # Фоновая задача проверки дедлайнов
+        coordination_task = app.create_task(coordination_loop())
+        deadline_task = app.create_task(deadline_loop(app))
+        sender_task = app.create_task(reminder_sender.run(app.bot))
+        archive_task = app.create_task(archive_loop()) if ARCHIVE_AFTER_DAYS > 0 else None
+        stats_task = app.create_task(stats_rebuild_loop()) if STATS_REBUILD_INTERVAL > 0 else None
+        flush_task = app.create_task(persistence_flush_loop(app)) if app.persistence else None
+        server = None
+        metrics_server = None
+        try:
+            if METRICS_PORT:
+                metrics_server = await start_http_server(METRICS_LISTEN, METRICS_PORT,
+                                                         {("GET", "/metrics"): metrics_endpoint})
+                logger.info(f"Метрики доступны на http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+            if receive_updates and RUN_MODE == "webhook":
+                server = await start_webhook_server(app)
+            elif receive_updates:
+                await app.updater.start_polling()
+            await stop_event.wait()
+        finally:
+            logger.info("Останавливаем бота...")
+            if server is not None:
+                # Новые обновления больше не принимаются, уже принятые будут обработаны в app.stop()
+                server.close()
+                await server.wait_closed()
+            elif app.updater.running:
+                await app.updater.stop()
+            if metrics_server is not None:
+                metrics_server.close()
+            deadline_task.cancel()
+            sender_task.cancel()
+            if archive_task is not None:
+                archive_task.cancel()
+            if stats_task is not None:
+                stats_task.cancel()
+            coordination_task.cancel()
+            if flush_task is not None:
+                flush_task.cancel()
+            task_change_watcher.stop()
+            await app.stop()
+            await run_db(partition_coordinator.release_all)
+
+
+async def main():
+    app = build_application()
+
+    # Корректная остановка по SIGINT/SIGTERM (на Windows — по KeyboardInterrupt)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await serve(app, stop_event)
+    db_executor.shutdown(wait=False)
 
 
 if __name__ == "__main__":
-    import asyncio
+    # Одноразовые служебные команды: python bot.py migrate | rebuild-stats | backfill-entries <chat_id>
+    if sys.argv[1:] == ["migrate"]:
+        ensure_indexes()
+        migrate_deadlines()
+        sys.exit(0)
+    if sys.argv[1:2] == ["backfill-entries"] and len(sys.argv) == 3:
+        ensure_indexes()
+        backfill_entry_chats(int(sys.argv[2]))
+        sys.exit(0)
+    if sys.argv[1:] == ["rebuild-stats"]:
+        logger.info(f"Статистика пересчитана для чатов: {rebuild_chat_stats()}")
+        sys.exit(0)
 
+    if not BOT_TOKEN:
+        sys.exit("Не задан BOT_TOKEN: укажите в этой переменной окружения токен бота от BotFather")
     try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-    loop.create_task(main())
-    loop.run_forever()
\ No newline at end of file
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
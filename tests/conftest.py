@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+
+# Тесты идут на встроенной базе SQLite: сервер MongoDB не нужен, а недоступный MONGO_URI
+# сразу покажет случайное обращение к нему
+os.environ["STORAGE_BACKEND"] = "sqlite"
+os.environ["SQLITE_PATH"] = os.path.join(tempfile.mkdtemp(), "task_planner.db")
+os.environ["MONGO_URI"] = "mongodb://127.0.0.1:1/?serverSelectionTimeoutMS=200"
+os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
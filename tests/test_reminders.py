@@ -0,0 +1,165 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import bot
+
+CHAT_ID = 7
+
+
+@pytest.fixture(autouse=True)
+def repository(tmp_path, monkeypatch):
+    repo = bot.SqliteRepository(str(tmp_path / "bot.db"))
+    repo.ensure_schema()
+    monkeypatch.setattr(bot, "repository", repo)
+    bot.query_cache.invalidate_all(publish=False)
+    bot.reminder_scheduler.clear()
+    bot.partition_coordinator.rebalance()
+    yield repo
+    bot.reminder_scheduler.clear()
+
+
+def add_tasks(*deadlines):
+    for number, deadline in enumerate(deadlines):
+        bot.add_task(f"задача {number}", deadline.replace(second=0, microsecond=0), CHAT_ID)
+    return [task["_id"] for task in bot.repository.find_tasks(chat_id=CHAT_ID)]
+
+
+def outbox_ids():
+    return sorted(item["_id"] for item in bot.claim_outbox_batch(100))
+
+
+def fail_once(monkeypatch, name):
+    original = getattr(bot, name)
+    calls = []
+
+    def flaky(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError("хранилище недоступно")
+        return original(*args)
+
+    monkeypatch.setattr(bot, name, flaky)
+    return calls
+
+
+def test_pop_due_returns_each_due_id_once():
+    scheduler = bot.ReminderScheduler()
+    now = datetime.now()
+    scheduler.schedule("a", now - timedelta(minutes=5))
+    scheduler.schedule("b", now + timedelta(hours=1))
+    # Перенос оставляет в куче устаревший элемент — он не должен сработать
+    scheduler.schedule("c", now - timedelta(minutes=1))
+    scheduler.schedule("c", now - timedelta(seconds=1))
+    assert scheduler.pop_due(now) == ["a", "c"]
+    assert scheduler.pop_due(now) == []
+    assert len(scheduler) == 1
+    assert scheduler.next_fire_time() == now + timedelta(hours=1)
+
+
+def test_sweep_enqueues_merged_reminder_and_schedules_the_next_one():
+    deadline = datetime.now() + timedelta(minutes=30)
+    [task_id] = add_tasks(deadline)
+    asyncio.run(bot.sweep_due_reminders())
+    [item] = bot.claim_outbox_batch(100)
+    assert item["kinds"] == ["day", "hour"]
+    assert item["_id"].startswith(f"{task_id}:") and item["_id"].endswith(":hour")
+    [task] = bot.repository.find_tasks(ids=[task_id])
+    assert task["reminders"] == {"day": True, "hour": True, "on_time": False}
+    assert bot.reminder_scheduler.next_fire_time() == deadline.replace(second=0, microsecond=0)
+
+
+def test_enqueue_is_idempotent():
+    [task_id] = add_tasks(datetime.now() + timedelta(minutes=30))
+    [task] = bot.repository.find_tasks(ids=[task_id])
+    bot.enqueue_reminders([bot.build_outbox_item(task, ["day", "hour"])])
+    bot.enqueue_reminders([bot.build_outbox_item(task, ["hour"])])
+    assert len(outbox_ids()) == 1
+
+
+def test_failed_batch_reschedules_it_and_all_later_batches(monkeypatch):
+    monkeypatch.setattr(bot, "SCHEDULER_BATCH_SIZE", 2)
+    task_ids = add_tasks(*[datetime.now() - timedelta(minutes=1)] * 5)
+    fail_once(monkeypatch, "get_pending_tasks_by_ids")
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.sweep_due_reminders())
+    # Ничего не обработано, но и не потеряно: все задачи ждут повтора
+    assert len(bot.reminder_scheduler) == 5
+    assert bot.reminder_scheduler.next_fire_time() > datetime.now() + bot.SWEEP_RETRY_DELAY / 2
+    retry_at = datetime.now() + bot.SWEEP_RETRY_DELAY
+    due = bot.reminder_scheduler.pop_due(retry_at)
+    assert sorted(due) == sorted(task_ids)
+    for start in range(0, len(due), bot.SCHEDULER_BATCH_SIZE):
+        asyncio.run(bot.sweep_due_batch(due[start:start + bot.SCHEDULER_BATCH_SIZE], retry_at))
+    assert len(outbox_ids()) == 5
+
+
+def test_failure_in_a_later_batch_keeps_the_processed_ones(monkeypatch):
+    monkeypatch.setattr(bot, "SCHEDULER_BATCH_SIZE", 2)
+    add_tasks(*[datetime.now() - timedelta(minutes=1)] * 5)
+    original = bot.get_pending_tasks_by_ids
+    calls = []
+
+    def fail_second(task_ids):
+        calls.append(task_ids)
+        if len(calls) == 2:
+            raise RuntimeError("хранилище недоступно")
+        return original(task_ids)
+
+    monkeypatch.setattr(bot, "get_pending_tasks_by_ids", fail_second)
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.sweep_due_reminders())
+    assert len(outbox_ids()) == 2
+    assert len(bot.reminder_scheduler) == 3
+
+
+def test_claim_failure_retries_without_duplicates(monkeypatch):
+    deadline = datetime.now() + timedelta(minutes=30)
+    [task_id] = add_tasks(deadline)
+    fail_once(monkeypatch, "claim_reminder_transitions")
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.sweep_due_reminders())
+    [task] = bot.repository.find_tasks(ids=[task_id])
+    assert task["reminders"] == {"day": False, "hour": False, "on_time": False}
+    # Задача ждёт повтора, а не следующего напоминания в момент дедлайна
+    assert bot.reminder_scheduler.next_fire_time() < deadline - timedelta(minutes=20)
+    retry_at = datetime.now() + bot.SWEEP_RETRY_DELAY
+    asyncio.run(bot.sweep_due_batch(bot.reminder_scheduler.pop_due(retry_at), retry_at))
+    [task] = bot.repository.find_tasks(ids=[task_id])
+    assert task["reminders"] == {"day": True, "hour": True, "on_time": False}
+    [item_id] = outbox_ids()
+    assert item_id.endswith(":hour")
+
+
+def test_claim_failure_past_the_deadline_sends_only_the_new_reminder(monkeypatch):
+    deadline = datetime.now() + timedelta(minutes=30)
+    [task_id] = add_tasks(deadline)
+    fail_once(monkeypatch, "claim_reminder_transitions")
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.sweep_due_reminders())
+    # Повтор пришёлся уже на дедлайн: к «за день» и «за час» добавился on_time
+    later = deadline + timedelta(minutes=1)
+    asyncio.run(bot.sweep_due_batch(bot.reminder_scheduler.pop_due(later), later))
+    items = bot.claim_outbox_batch(100)
+    assert sorted(item["kinds"][-1] for item in items) == ["hour", "on_time"]
+    assert len(bot.reminder_scheduler) == 0
+
+
+def test_rule_claim_failure_is_retried_without_duplicates(monkeypatch):
+    rule = bot.add_recurring_task("правило", "*/5 * * * *", datetime.now() - timedelta(hours=1), CHAT_ID)
+    # Отметка на 10 минут назад: с тех пор наступило хотя бы одно вхождение
+    bot.repository.claim_rule_reminders(
+        {rule["_id"]: (rule["reminded_until"], datetime.now() - timedelta(minutes=10), None)})
+    bot.reminder_scheduler.schedule(rule["_id"], datetime.now() - timedelta(seconds=1))
+    fail_once(monkeypatch, "claim_rule_reminders")
+    now = datetime.now()
+    with pytest.raises(RuntimeError):
+        asyncio.run(bot.sweep_due_reminders())
+    assert len(outbox_ids()) == 1
+    assert bot.reminder_scheduler.next_fire_time() > now + bot.SWEEP_RETRY_DELAY / 2
+    due = bot.reminder_scheduler.pop_due(now + bot.SWEEP_RETRY_DELAY * 2)
+    assert due == [rule["_id"]]
+    asyncio.run(bot.sweep_due_batch(due, now))
+    assert outbox_ids() == []
+    assert bot.reminder_scheduler.next_fire_time() > now